@@ -0,0 +1,313 @@
+"""Per-stage latency benchmark for the save and ask pipelines.
+
+Drives api.prepare_doc + api.insert_docs (save) and embedding + retrieval +
+generation (ask) against the local stand-ins in stubs.py. Runs every
+combination of corpus size and concurrency and reports p50/p95/p99 per stage
+and overall throughput. Results are written as JSON. --baseline compares a run
+against a previous results file.
+
+    cd rag_service
+    python bench/run_bench.py --corpus-sizes 100,1000 --concurrency 1,8 --requests 40
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from stubs import FakeCollection, FakeS3Client, OpenAIStub, stub_embedding
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+WORDS = (
+    "kafka queue consumer offset replay startup idea customer pain data "
+    "engineering pipeline conference meetup linkedin founder python flask "
+    "telegram note vector search embedding lesson life travel book podcast "
+    "spark airflow dbt warehouse lake schema contract analysis slide deck"
+).split()
+
+
+def summarise(durations_ms):
+    values = np.asarray(durations_ms, dtype=np.float64)
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 2),
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p95": round(float(np.percentile(values, 95)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+    }
+
+
+FIRST_NAMES = "Priya Tomasz Aiko Diego Nkechi Lars Mei Rahul Sofia Omar".split()
+LAST_NAMES = "Raman Kowalski Tanaka Alvarez Obi Eriksen Lin Mehta Rossi Haddad".split()
+
+
+def random_note(rng, n_words=40):
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def person(j):
+    return f"{FIRST_NAMES[j % 10]} {LAST_NAMES[(j // 10) % 10]}"
+
+
+def name_for(i):
+    # Every 10th note mentions someone, the kind of thing asked about by name
+    return person(i // 10) if i % 10 == 0 else None
+
+
+def seed_corpus(collection, size, rng, domains):
+    docs = []
+    for i in range(size):
+        text = random_note(rng)
+        if name_for(i):
+            text = f"Met {name_for(i)} today. {text}"
+        docs.append(
+            {
+                "_id": uuid.uuid4(),
+                "message_id": i,
+                "update_ts": "2024-07-21 12:00:00",
+                "domain": rng.choice(domains),
+                "cleaned_title": text[:20],
+                "cleaned_summary": "This document describes " + text[:80],
+                "cleaned_content": text,
+                "cleaned_concat": text,
+                "raw_content": text,
+                "reference_url": f"https://bench.local/{i}.html",
+                "$vector": stub_embedding(text).tolist(),
+            }
+        )
+    collection.seed(docs)
+    return docs
+
+
+def run_scenario(func, n_requests, concurrency, tracing):
+    tracing.reset()
+    latencies = []
+
+    def timed(i):
+        start = time.perf_counter()
+        func(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(n_requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "throughput_rps": round(n_requests / elapsed, 2),
+        "overall": summarise(latencies),
+        "stages": {
+            name: summarise(values)
+            for name, values in sorted(tracing.samples().items())
+        },
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+    key = lambda r: (r["pipeline"], r["corpus_size"], r["concurrency"])
+    previous = {key(r): r for r in baseline["results"]}
+    print(f"\nCompared to {baseline_path}:")
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        for stat in ("p50", "p95"):
+            old, new = before["overall"][stat], result["overall"][stat]
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"  {key(result)} overall {stat}: {old} -> {new} ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus-sizes", default="100,1000")
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=40, help="per scenario")
+    parser.add_argument("--pipelines", default="save,ask")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--embed-latency-ms", type=float, default=80)
+    parser.add_argument("--astra-latency-ms", type=float, default=40)
+    parser.add_argument("--s3-latency-ms", type=float, default=60)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--local-index", action="store_true")
+    parser.add_argument(
+        "--local-index-dim",
+        type=int,
+        default=1536,
+        help="< 1536 uses a ReducedVectorIndex with a full-vector rerank",
+    )
+    parser.add_argument("--router", action="store_true")
+    parser.add_argument("--lexical", action="store_true")
+    parser.add_argument(
+        "--name-query-ratio", type=float, default=0.0, help="asks about a person"
+    )
+    parser.add_argument(
+        "--save-batch", type=int, default=1, help="coalesce up to N saves per batch"
+    )
+    parser.add_argument("--save-batch-wait-ms", type=float, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="defaults to bench/results/bench_<ts>.json")
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    stub = OpenAIStub(
+        llm_latency_ms=args.llm_latency_ms,
+        embed_latency_ms=args.embed_latency_ms,
+        jitter_ms=args.jitter_ms,
+    ).start()
+    os.environ.update(
+        OPENAI_BASE_URL=stub.base_url,
+        OPENAI_API_BASE=stub.base_url,
+        OPENAI_API_KEY="bench",
+        EMBEDDING_CHECK_CTX_LENGTH="false",
+        EMBEDDING_CACHE_SIZE="0",
+        # The stub has no rate limits; the limiter would only slow the runs down
+        OPENAI_CHAT_RPM="0",
+        OPENAI_CHAT_TPM="0",
+        OPENAI_EMBED_RPM="0",
+        OPENAI_EMBED_TPM="0",
+    )
+    os.environ.setdefault("PUBLIC_S3_NAME", "bench-bucket")
+    os.environ.setdefault("RUN_ENV", "BENCH")
+    sys.path.insert(0, SRC_DIR)
+
+    import api
+    import batcher
+    import clients
+    import domain_router
+    import lexical_index
+    import llm_helper
+    import tracing
+    import vector_index
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    clients.set_client("s3", FakeS3Client(args.s3_latency_ms, args.jitter_ms))
+
+    rng = random.Random(args.seed)
+    results = []
+    for corpus_size in [int(n) for n in args.corpus_sizes.split(",")]:
+        collection = FakeCollection(args.astra_latency_ms, args.jitter_ms)
+        corpus = seed_corpus(collection, corpus_size, rng, api.DOMAIN_TAGS)
+        index = router = lexical = None
+        mirrors = []
+        if args.local_index:
+            if args.local_index_dim < 1536:
+                index = vector_index.ReducedVectorIndex(dim=args.local_index_dim)
+            else:
+                index = vector_index.LocalVectorIndex()
+            index.build(corpus)
+            mirrors.append(index)
+        if args.router:
+            router = domain_router.DomainRouter()
+            router.build(corpus)
+            mirrors.append(router)
+        if args.lexical:
+            lexical = lexical_index.LexicalIndex()
+            lexical.build(corpus)
+            mirrors.append(lexical)
+
+        save_batcher = None
+        if args.save_batch > 1:
+            executor = ThreadPoolExecutor(max_workers=args.save_batch * 2)
+
+            def save_batch(messages):
+                docs = api.prepare_docs(messages, executor, router=router)
+                ready = [doc for doc in docs if not isinstance(doc, Exception)]
+                api.insert_docs(collection, ready, mirrors=mirrors)
+                return docs
+
+            save_batcher = batcher.MicroBatcher(
+                save_batch,
+                max_items=args.save_batch,
+                max_wait=args.save_batch_wait_ms / 1000,
+            )
+
+        def save(i):
+            if save_batcher is not None:
+                save_batcher.submit((f"bench-{i}", random_note(rng))).result()
+                return
+            doc = api.prepare_doc(f"bench-{i}", random_note(rng), router=router)
+            api.insert_docs(collection, [doc], mirrors=mirrors)
+
+        def ask(i):
+            if rng.random() < args.name_query_ratio:
+                text = (
+                    f"what did I note about {person(rng.randrange(corpus_size // 10))}"
+                )
+            else:
+                text = f"what did I note about {random_note(rng, 6)}"
+            docs = api.lexical_fast_path(lexical, text, 3)
+            if not docs:
+                with tracing.span("ask.embed"):
+                    embedding = llm_helper.vectorize_text(
+                        text, llm_helper.initialize_embeddings()
+                    )
+                docs = api.retrieve_hybrid_search(
+                    text,
+                    3,
+                    collection,
+                    index=index,
+                    embedding=embedding,
+                    router=router,
+                    lexical=lexical,
+                    fast_path=False,
+                )
+            api.augmented_generation(text, docs, collection=collection)
+
+        pipelines = {"save": save, "ask": ask}
+        for pipeline in args.pipelines.split(","):
+            for concurrency in [int(n) for n in args.concurrency.split(",")]:
+                result = run_scenario(
+                    pipelines[pipeline], args.requests, concurrency, tracing
+                )
+                result.update(
+                    pipeline=pipeline, corpus_size=corpus_size, concurrency=concurrency
+                )
+                results.append(result)
+                print(
+                    f"{pipeline:<5} corpus={corpus_size:<6} "
+                    f"concurrency={concurrency:<3} "
+                    f"{result['throughput_rps']:>7.2f} req/s  "
+                    f"p50={result['overall']['p50']:.0f} ms  "
+                    f"p95={result['overall']['p95']:.0f} ms  "
+                    f"p99={result['overall']['p99']:.0f} ms"
+                )
+                for name, stats in result["stages"].items():
+                    print(
+                        f"    {name:<24} p50={stats['p50']:>8.1f}  "
+                        f"p95={stats['p95']:>8.1f}"
+                    )
+
+    stub.stop()
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"bench_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nResults written to {output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Ask latency while saves and a backfill flood OpenAI, with and without the limiter.
+
+Points the service at an OpenAIStub that, like OpenAI, answers 429 with
+retry-after-ms once more than --stub-rpm requests arrive within a second.
+--flood threads send enrichment completions back to back in the ingest and
+background lanes. Meanwhile one user asks a question every --ask-interval
+seconds (a completion in the interactive lane, under the request deadline).
+Two modes:
+
+    off      no client-side limit: 429s are retried per resilience.py
+    limited  rate_limiter lets --limit-rpm requests a minute through, asks first
+
+Reports p50/p95/p99 ask latency, failed asks, flood throughput, 429s seen by
+the stub and the limiter's per-lane wait times.
+
+    cd rag_service
+    python bench/run_limiter_bench.py --stub-rpm 1200 --flood 16 --seconds 20
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from run_bench import SRC_DIR, random_note, summarise
+from stubs import OpenAIStub
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default="off,limited")
+    parser.add_argument("--stub-rpm", type=int, default=1200)
+    parser.add_argument("--limit-rpm", type=int, help="defaults to 95%% of --stub-rpm")
+    parser.add_argument("--burst-seconds", type=float, default=1.0)
+    parser.add_argument("--flood", type=int, default=16, help="flooding threads")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--ask-interval", type=float, default=0.25)
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--request-deadline", type=float, default=10)
+    parser.add_argument("--output", help="defaults to bench/results/limiter_<ts>.json")
+    args = parser.parse_args()
+    limit_rpm = args.limit_rpm or int(args.stub_rpm * 0.95)
+
+    stub = OpenAIStub(llm_latency_ms=args.llm_latency_ms, rpm=args.stub_rpm).start()
+    os.environ.update(
+        OPENAI_BASE_URL=stub.base_url,
+        OPENAI_API_BASE=stub.base_url,
+        OPENAI_API_KEY="bench",
+    )
+    sys.path.insert(0, SRC_DIR)
+
+    import llm_helper
+    import rate_limiter
+    import resilience
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+
+    rng = random.Random(0)
+    notes = [random_note(rng) for _ in range(100)]
+
+    def flood(lane, stop, done):
+        with rate_limiter.lane(lane):
+            i = 0
+            while not stop.is_set():
+                try:
+                    with resilience.deadline(120):
+                        llm_helper.call_openai_response(
+                            "Extract a title",
+                            notes[i % len(notes)],
+                            prompt_name="flood",
+                        )
+                    done.append(1)
+                except Exception:
+                    pass
+                i += 1
+
+    results = []
+    for mode in args.modes.split(","):
+        rate_limiter.limiters["chat"] = rate_limiter.Limiter(
+            "chat",
+            rpm=limit_rpm if mode == "limited" else 0,
+            tpm=0,
+            burst_seconds=args.burst_seconds,
+        )
+        # Each mode starts with a closed circuit and fresh counters
+        resilience.policies["openai.chat"] = resilience.Policy(
+            "openai.chat", attempts=3
+        )
+        stub.rejected = 0
+        stop = threading.Event()
+        done = []
+        threads = [
+            threading.Thread(
+                target=flood, args=("ingest" if i % 2 else "background", stop, done)
+            )
+            for i in range(args.flood)
+        ]
+        for thread in threads:
+            thread.start()
+
+        latencies, failures = [], 0
+        start = time.perf_counter()
+        with rate_limiter.lane("interactive"):
+            while time.perf_counter() - start < args.seconds:
+                began = time.perf_counter()
+                try:
+                    with resilience.deadline(args.request_deadline):
+                        llm_helper.call_openai_response(
+                            "Answer from the notes",
+                            notes[len(latencies) % len(notes)],
+                            prompt_name="ask",
+                        )
+                    latencies.append((time.perf_counter() - began) * 1000)
+                except Exception:
+                    failures += 1
+                time.sleep(max(0.0, args.ask_interval - (time.perf_counter() - began)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        limiter = rate_limiter.limiters["chat"].stats()
+        result = {
+            "mode": mode,
+            "asks": summarise(latencies) if latencies else None,
+            "ask_failures": failures,
+            "flood_rps": round(len(done) / elapsed, 2),
+            "stub_429s": stub.rejected,
+            "limiter": limiter,
+            "circuit": resilience.policies["openai.chat"].stats(),
+        }
+        results.append(result)
+        asks = result["asks"] or {"p50": 0, "p95": 0, "p99": 0}
+        print(
+            f"{mode:<8} ask p50={asks['p50']:>7.1f} ms p95={asks['p95']:>7.1f} ms "
+            f"p99={asks['p99']:>7.1f} ms failed={failures:<3} "
+            f"flood={result['flood_rps']:>6.1f} req/s 429s={stub.rejected:<5} "
+            f"wait interactive={limiter['interactive_wait_ms_mean']:.1f} ms "
+            f"background={limiter['background_wait_ms_mean']:.1f} ms"
+        )
+
+    stub.stop()
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"limiter_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
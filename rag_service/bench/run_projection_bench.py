@@ -0,0 +1,204 @@
+"""Bytes read from Astra, memory and latency per ask on the Astra search path.
+
+Seeds a FakeCollection with --corpus-size notes of --note-words words (as
+cleaned_content, raw_content and cleaned_concat, like saved notes) and builds
+the lexical index, so vector search fetches top_n * FUSION_DEPTH candidates
+as in the server, and a domain router that always picks a domain locally.
+--no-lexical leaves the lexical index out (top_n candidates, text fetched
+from Astra). Each ask runs api.retrieve_hybrid_search and
+api.augmented_generation (which packs the context and lists the references) and
+reports:
+
+    bytes    JSON size of every doc Astra returned for the ask (the fake
+             collection parses it back, as the Data API client does)
+    calls    Data API requests per ask
+    peak     peak Python memory allocated during the ask (tracemalloc)
+    latency  p50/p95 of the whole ask and of the search stage
+
+Only public api functions are used, so the same script runs against an older
+checkout of src/ for a before/after comparison (--src, --baseline).
+
+    cd rag_service
+    python bench/run_projection_bench.py --corpus-size 2000 --requests 100
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from run_bench import SRC_DIR, random_note, summarise
+from stubs import FakeCollection, OpenAIStub, stub_embedding
+
+
+def make_notes(size, words, rng, domains):
+    notes = []
+    for i in range(size):
+        text = random_note(rng, words)
+        notes.append(
+            {
+                "_id": f"note-{i}",
+                "message_id": i,
+                "update_ts": "2024-07-21 12:00:00",
+                "domain": rng.choice(domains),
+                "cleaned_title": text[:20],
+                "cleaned_summary": "This document describes " + text[:80],
+                "cleaned_content": text,
+                "cleaned_concat": text,
+                "raw_content": text,
+                "content_hash": f"{i:064x}",
+                "reference_url": f"https://bench.local/{i}.html",
+                "$vector": stub_embedding(text).tolist(),
+            }
+        )
+    return notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus-size", type=int, default=2000)
+    parser.add_argument("--note-words", type=int, default=400)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--astra-latency-ms", type=float, default=0)
+    parser.add_argument("--no-lexical", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--src", default=SRC_DIR, help="rag_service/src to benchmark")
+    parser.add_argument(
+        "--output", help="defaults to bench/results/projection_<ts>.json"
+    )
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    stub = OpenAIStub(llm_latency_ms=0, embed_latency_ms=0, stream_token_ms=0).start()
+    os.environ.update(
+        OPENAI_BASE_URL=stub.base_url,
+        OPENAI_API_BASE=stub.base_url,
+        OPENAI_API_KEY="bench",
+        EMBEDDING_CHECK_CTX_LENGTH="false",
+        EMBEDDING_CACHE_SIZE="0",
+        # The stub has no rate limits; the limiter would only slow the runs down
+        OPENAI_CHAT_RPM="0",
+        OPENAI_CHAT_TPM="0",
+        OPENAI_EMBED_RPM="0",
+        OPENAI_EMBED_TPM="0",
+    )
+    os.environ.setdefault("PUBLIC_S3_NAME", "bench-bucket")
+    os.environ.setdefault("RUN_ENV", "BENCH")
+    sys.path.insert(0, args.src)
+
+    import api
+    import domain_router
+    import lexical_index
+    import llm_helper
+    import tracing
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    rng = random.Random(args.seed)
+    notes = make_notes(args.corpus_size, args.note_words, rng, api.DOMAIN_TAGS)
+    collection = FakeCollection(args.astra_latency_ms, measure_bytes=True)
+    collection.seed(notes)
+    lexical = None
+    if not args.no_lexical:
+        lexical = lexical_index.LexicalIndex()
+        lexical.build(notes)
+    # The stub's completions aren't domain tags; never escalate to them
+    router = domain_router.DomainRouter(min_score=-1.0, min_margin=0.0)
+    router.build(notes)
+    questions = [f"what did I note about {random_note(rng, 6)}" for _ in range(50)]
+    embedder = llm_helper.initialize_embeddings()
+    embeddings = [llm_helper.vectorize_text(q, embedder) for q in questions]
+
+    def ask(i):
+        docs = api.retrieve_hybrid_search(
+            questions[i % len(questions)],
+            args.top_n,
+            collection,
+            embedding=embeddings[i % len(questions)],
+            router=router,
+            lexical=lexical,
+            fast_path=False,
+        )
+        api.augmented_generation(
+            questions[i % len(questions)], docs, collection=collection
+        )
+
+    ask(0)
+    tracing.reset()
+    collection.bytes_returned = collection.calls = 0
+    latencies = []
+    for i in range(args.requests):
+        start = time.perf_counter()
+        ask(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    bytes_per_ask = collection.bytes_returned / args.requests
+    calls_per_ask = collection.calls / args.requests
+    stages = tracing.samples()
+
+    peaks = []
+    tracemalloc.start()
+    for i in range(min(args.requests, 20)):
+        tracemalloc.reset_peak()
+        ask(i)
+        peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+    tracemalloc.stop()
+    stub.stop()
+
+    result = {
+        "bytes_per_ask": round(bytes_per_ask),
+        "calls_per_ask": round(calls_per_ask, 2),
+        "peak_kb": summarise(peaks),
+        "overall": summarise(latencies),
+        "stages": {name: summarise(values) for name, values in sorted(stages.items())},
+    }
+    search = result["stages"].get("ask.search", {"p50": 0, "p95": 0})
+    print(
+        f"corpus={args.corpus_size} words={args.note_words} top_n={args.top_n} "
+        f"lexical={not args.no_lexical}\n"
+        f"  bytes/ask={result['bytes_per_ask']:,}  calls/ask={calls_per_ask:.2f}  "
+        f"peak p50={result['peak_kb']['p50']:.0f} KB\n"
+        f"  ask p50={result['overall']['p50']:.2f} ms "
+        f"p95={result['overall']['p95']:.2f} ms  "
+        f"search p50={search['p50']:.2f} ms p95={search['p95']:.2f} ms"
+    )
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            before = json.load(file)["result"]
+        print(f"\nCompared to {args.baseline}:")
+        for name, old, new in (
+            ("bytes/ask", before["bytes_per_ask"], result["bytes_per_ask"]),
+            ("peak KB p50", before["peak_kb"]["p50"], result["peak_kb"]["p50"]),
+            ("ask p50 ms", before["overall"]["p50"], result["overall"]["p50"]),
+        ):
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"  {name}: {old:,} -> {new:,} ({change:+.1f}%)")
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"projection_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "result": result,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
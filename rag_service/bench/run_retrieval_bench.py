@@ -0,0 +1,200 @@
+"""Recall, memory and latency of two-stage retrieval against single-stage search.
+
+Compares api.vector_search over Astra (FakeCollection), a full 1536-dim
+LocalVectorIndex and ReducedVectorIndex at each --dims / --candidates setting
+(short-vector first pass, then a full-vector rerank of the candidates fetched
+from the collection). Recall@k is measured against exact full-vector search;
+the first-stage-only recall shows what the rerank buys.
+
+The default corpus is synthetic: topic clusters whose variance decays over
+the dimensions, roughly like text-embedding-3 vectors. For real numbers,
+export the collection's vectors to a .npy file (one row per note) and pass
+--vectors; the last --queries rows are then held out and used as questions.
+
+    cd rag_service
+    python bench/run_retrieval_bench.py --corpus-size 5000 --dims 128,256,512 \\
+        --candidates 20,40,100
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+from run_bench import SRC_DIR, summarise
+from stubs import EMBEDDING_DIM, FakeCollection
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def synthetic_vectors(n_docs, n_queries, rng, decay=0.5, query_noise=0.6):
+    """Clustered vectors with most of their variance in the leading dimensions."""
+    scale = (1.0 + np.arange(EMBEDDING_DIM)) ** -decay
+    n_topics = max(8, n_docs // 50)
+    centers = rng.standard_normal((n_topics, EMBEDDING_DIM)) * scale
+    topics = rng.integers(n_topics, size=n_docs)
+    docs = centers[topics] + rng.standard_normal((n_docs, EMBEDDING_DIM)) * scale
+    # Questions paraphrase a note: that note plus noise
+    targets = rng.integers(n_docs, size=n_queries)
+    queries = (
+        docs[targets]
+        + query_noise * rng.standard_normal((n_queries, EMBEDDING_DIM)) * scale
+    )
+    return normalize(docs).astype(np.float32), normalize(queries).astype(np.float32)
+
+
+def load_vectors(path, n_queries):
+    vectors = normalize(np.load(path).astype(np.float32))
+    return vectors[:-n_queries], vectors[-n_queries:]
+
+
+def seed(collection, vectors):
+    docs = [
+        {"_id": uuid.uuid4(), "message_id": i, "domain": "", "$vector": vector.tolist()}
+        for i, vector in enumerate(vectors)
+    ]
+    collection.seed(docs)
+    return docs
+
+
+def run(search, queries, truth, k):
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        docs = search(query.tolist())
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len({doc.message_id for doc in docs[:k]} & expected) / k)
+    return {
+        f"recall@{k}": round(float(np.mean(recalls)), 4),
+        "latency_ms": summarise(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus-size", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5, help="docs retrieved per question")
+    parser.add_argument("--dims", default="128,256,512")
+    parser.add_argument("--candidates", default="20,40,100", help="first-stage M")
+    parser.add_argument("--vectors", help=".npy of real embeddings, one row per note")
+    parser.add_argument("--astra-latency-ms", type=float, default=40)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="defaults to bench/results/retrieval_<ts>.json"
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("PUBLIC_S3_NAME", "bench-bucket")
+    os.environ.setdefault("RUN_ENV", "BENCH")
+    sys.path.insert(0, SRC_DIR)
+
+    import api
+    import vector_index
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    rng = np.random.default_rng(args.seed)
+    if args.vectors:
+        doc_vectors, queries = load_vectors(args.vectors, args.queries)
+    else:
+        doc_vectors, queries = synthetic_vectors(args.corpus_size, args.queries, rng)
+    k = args.k
+    # Exact full-vector top-k is the reference every setting is scored against
+    scores = queries @ doc_vectors.T
+    truth = [set(row) for row in np.argsort(-scores, axis=1)[:, :k].tolist()]
+
+    collection = FakeCollection(args.astra_latency_ms, args.jitter_ms)
+    corpus = seed(collection, doc_vectors)
+    print(f"{len(corpus)} notes, {len(queries)} questions, k={k}")
+
+    results = []
+
+    def report(name, result, **extra):
+        result = {"setting": name, **extra, **result}
+        results.append(result)
+        memory = (
+            f"{extra['index_bytes'] / 2**20:>7.1f} MiB"
+            if "index_bytes" in extra
+            else " " * 11
+        )
+        first = (
+            f"  first stage {result['first_stage_recall']:.3f}"
+            if "first_stage_recall" in result
+            else ""
+        )
+        print(
+            f"{name:<28} recall@{k}={result[f'recall@{k}']:.3f}  {memory}  "
+            f"p50={result['latency_ms']['p50']:>7.2f} ms  "
+            f"p95={result['latency_ms']['p95']:>7.2f} ms{first}"
+        )
+
+    report(
+        "astra (single stage)",
+        run(lambda q: api.vector_search(collection, q, k), queries, truth, k),
+    )
+
+    full = vector_index.LocalVectorIndex(max_age=None)
+    full.build(corpus)
+    report(
+        "local 1536 (single stage)",
+        run(
+            lambda q: api.vector_search(collection, q, k, index=full), queries, truth, k
+        ),
+        index_bytes=full.stats()["matrix_bytes"],
+    )
+
+    for dim in [int(n) for n in args.dims.split(",")]:
+        for candidates in [int(n) for n in args.candidates.split(",")]:
+            reduced = vector_index.ReducedVectorIndex(
+                dim=dim, max_age=None, candidates=candidates
+            )
+            reduced.build(corpus)
+            first_stage = run(lambda q: reduced.search(q, k), queries, truth, k)
+            result = run(
+                lambda q: api.vector_search(collection, q, k, index=reduced),
+                queries,
+                truth,
+                k,
+            )
+            result["first_stage_recall"] = first_stage[f"recall@{k}"]
+            report(
+                f"reduced {dim} M={candidates}",
+                result,
+                dim=dim,
+                candidates=candidates,
+                index_bytes=reduced.stats()["matrix_bytes"],
+                # Rerank payload: full vectors of the candidates
+                fetched_floats=candidates * EMBEDDING_DIM,
+            )
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"retrieval_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Concurrency benchmark for the async server against the Flask server.
+
+Serves /get_message from server.py (aiohttp, async OpenAI and Astra clients)
+and from main.py (Flask's threaded server, blocking clients). Both run in this
+one process against the local stand-ins in stubs.py, with the OpenAI stand-in
+in a separate process. Each concurrency level
+keeps that many asks in flight and reports throughput, p50/p95/p99 latency
+and errors per server.
+
+    cd rag_service
+    python bench/run_server_bench.py --concurrency 1,16,64,128 --requests 256
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import aiohttp
+from run_bench import SRC_DIR, random_note, seed_corpus, summarise
+from stubs import (
+    FakeAsyncCollection,
+    FakeCollection,
+    FakeS3Client,
+    start_stub_process,
+)
+
+
+def start_async_server(server):
+    from aiohttp import web
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(server.create_app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+
+def start_flask_server(main):
+    from werkzeug.serving import make_server
+
+    httpd = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}"
+
+
+async def load(base_url, n_requests, concurrency, rng):
+    latencies = []
+    errors = 0
+    slots = asyncio.Semaphore(concurrency)
+    timeout = aiohttp.ClientTimeout(total=300)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def ask(i):
+            nonlocal errors
+            payload = {
+                "message_id": i,
+                "text": f"what did I note about {random_note(rng, 6)}",
+            }
+            async with slots:
+                start = time.perf_counter()
+                try:
+                    async with session.post(
+                        base_url + "/get_message", json=payload
+                    ) as r:
+                        await r.read()
+                        if r.status != 200:
+                            errors += 1
+                            return
+                except aiohttp.ClientError:
+                    errors += 1
+                    return
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(ask(i) for i in range(n_requests)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "errors": errors,
+        "overall": summarise(latencies) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servers", default="async,flask")
+    parser.add_argument("--concurrency", default="1,16,64,128")
+    parser.add_argument("--requests", type=int, default=256, help="per level")
+    parser.add_argument("--corpus-size", type=int, default=500)
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--embed-latency-ms", type=float, default=80)
+    parser.add_argument("--astra-latency-ms", type=float, default=40)
+    parser.add_argument("--s3-latency-ms", type=float, default=60)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--router", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="defaults to bench/results/server_<ts>.json")
+    args = parser.parse_args()
+    levels = [int(n) for n in args.concurrency.split(",")]
+
+    stub_process, stub_url = start_stub_process(
+        llm_latency_ms=args.llm_latency_ms,
+        embed_latency_ms=args.embed_latency_ms,
+        jitter_ms=args.jitter_ms,
+    )
+    os.environ.update(
+        OPENAI_BASE_URL=stub_url,
+        OPENAI_API_BASE=stub_url,
+        OPENAI_API_KEY="bench",
+        EMBEDDING_CHECK_CTX_LENGTH="false",
+        EMBEDDING_CACHE_SIZE="0",
+        # The stub has no rate limits; the limiter would only slow the runs down
+        OPENAI_CHAT_RPM="0",
+        OPENAI_CHAT_TPM="0",
+        OPENAI_EMBED_RPM="0",
+        OPENAI_EMBED_TPM="0",
+        # Let the OpenAI pool hold every in-flight ask
+        OPENAI_POOL_SIZE=str(max(levels) * 2),
+    )
+    os.environ.setdefault("PUBLIC_S3_NAME", "bench-bucket")
+    os.environ.setdefault("RUN_ENV", "BENCH")
+    sys.path.insert(0, SRC_DIR)
+
+    import api
+    import clients
+    import domain_router
+    import main as flask_main
+    import server
+    import service
+    import tenants
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    clients.set_client("s3", FakeS3Client(args.s3_latency_ms, args.jitter_ms))
+
+    rng = random.Random(args.seed)
+    collection = FakeCollection(args.astra_latency_ms, args.jitter_ms)
+    corpus = seed_corpus(collection, args.corpus_size, rng, api.DOMAIN_TAGS)
+    router = None
+    if args.router:
+        router = domain_router.DomainRouter()
+        router.build(corpus)
+    registry = tenants.TenantRegistry(None, "bench")
+    tenant = registry.get()
+    tenant.collection = collection
+    tenant.async_collection = FakeAsyncCollection(collection)
+    tenant.router = router
+    service.conn_d.update(database="bench", tenants=registry)
+
+    starters = {
+        "async": lambda: start_async_server(server),
+        "flask": lambda: start_flask_server(flask_main),
+    }
+    results = []
+    for name in args.servers.split(","):
+        base_url = starters[name]()
+        for concurrency in levels:
+            result = asyncio.run(load(base_url, args.requests, concurrency, rng))
+            result.update(server=name, concurrency=concurrency)
+            results.append(result)
+            overall = result["overall"] or {"p50": 0, "p95": 0, "p99": 0}
+            print(
+                f"{name:<6} concurrency={concurrency:<4} "
+                f"{result['throughput_rps']:>7.2f} req/s  "
+                f"p50={overall['p50']:.0f} ms  p95={overall['p95']:.0f} ms  "
+                f"p99={overall['p99']:.0f} ms  errors={result['errors']}"
+            )
+
+    stub_process.terminate()
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"server_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
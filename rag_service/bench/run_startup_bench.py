@@ -0,0 +1,247 @@
+"""Cold-start benchmark: import time and time until the server is live and ready.
+
+Imports each module (service, server, main, and tele_service's main if aiogram
+is installed) in a fresh interpreter --repeats times and reports the median
+and best, and lists the slowest top-level imports from `python -X importtime`.
+Then starts server.py in a fresh process against the local stand-ins in
+stubs.py (Astra calls take --astra-latency-ms) and measures, from process
+launch, when /healthcheck (liveness) and /ready (readiness) first answer 200.
+Results are written as JSON. --baseline compares a run against a previous
+results file.
+
+    cd rag_service
+    python bench/run_startup_bench.py --repeats 5
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from run_bench import SRC_DIR
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TELE_SRC_DIR = os.path.join(BENCH_DIR, "..", "..", "tele_service", "src")
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def bench_env(data_dir):
+    # Dummy settings: nothing here makes a network call at import or startup
+    return {
+        **os.environ,
+        "RUN_ENV": "BENCH",
+        "ASTRA_API_ENDPOINT": "https://bench.apps.astra.datastax.com",
+        "ASTRA_API_TOKEN": "bench",
+        "OPENAI_API_KEY": "bench",
+        "PUBLIC_S3_NAME": "bench-bucket",
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "SAVE_LOG_PATH": os.path.join(data_dir, "save_log.sqlite3"),
+        "SCHEMA_CACHE_PATH": os.path.join(data_dir, "collection_schema.json"),
+    }
+
+
+def import_time(module, cwd, env, repeats):
+    timings = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+            cwd=cwd,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if out.returncode != 0:
+            return {"error": out.stderr.strip().splitlines()[-1]}
+        timings.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+    return {
+        "median_ms": round(statistics.median(timings), 1),
+        "min_ms": round(min(timings), 1),
+    }
+
+
+def slowest_imports(module, cwd, env, top):
+    """Packages by total import time (summed self time), from -X importtime."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    packages = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us) / 1000
+    slowest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return [{"package": name, "self_ms": round(ms, 1)} for name, ms in slowest]
+
+
+def serve_stubbed(port, astra_latency_ms):
+    """Entry point of the server process: server.py with stubbed dependencies."""
+    sys.path.insert(0, SRC_DIR)
+    import clients
+    import server
+    import service
+    from stubs import FakeDatabase, FakeS3Client
+
+    database = FakeDatabase(astra_latency_ms)
+    service.get_db_connection = lambda **kwargs: database
+    clients.set_client("s3", FakeS3Client())
+    server.serve("127.0.0.1", port)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, start, timeout):
+    while time.perf_counter() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return round((time.perf_counter() - start) * 1000, 1)
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.005)
+    return None
+
+
+def server_startup(env, astra_latency_ms, timeout):
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--serve",
+            str(port),
+            "--astra-latency-ms",
+            str(astra_latency_ms),
+        ],
+        cwd=os.path.join(BENCH_DIR, ".."),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        live_ms = wait_for(base_url + "/healthcheck", start, timeout)
+        ready_ms = wait_for(base_url + "/ready", start, timeout)
+    finally:
+        process.terminate()
+        process.wait()
+    return {"healthcheck_ms": live_ms, "ready_ms": ready_ms}
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+    print(f"\nCompared to {baseline_path}:")
+    for name, result in results["imports"].items():
+        before = baseline["imports"].get(name, {}).get("median_ms")
+        if before is None or "median_ms" not in result:
+            continue
+        change = (result["median_ms"] - before) / before * 100
+        print(f"  import {name}: {before} -> {result['median_ms']} ms ({change:+.1f}%)")
+    for runs in ("cold", "warm"):
+        for stat in ("healthcheck_ms", "ready_ms"):
+            old = baseline.get("startup", {}).get(runs, {}).get(stat)
+            new = results["startup"][runs][stat]
+            if old and new:
+                change = (new - old) / old * 100
+                print(f"  {runs} {stat}: {old} -> {new} ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest imports listed")
+    parser.add_argument("--astra-latency-ms", type=float, default=40)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="defaults to bench/results/startup_<ts>.json")
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_stubbed(args.serve, args.astra_latency_ms)
+        return
+
+    data_dir = tempfile.mkdtemp(prefix="startup_bench_")
+    env = bench_env(data_dir)
+    modules = [("service", SRC_DIR), ("server", SRC_DIR), ("main", SRC_DIR)]
+    if importlib.util.find_spec("aiogram") is not None:
+        modules.append(("tele_service.main", TELE_SRC_DIR))
+    else:
+        print("aiogram is not installed, skipping tele_service")
+
+    imports = {}
+    for name, cwd in modules:
+        result = import_time(name.split(".")[-1], cwd, env, args.repeats)
+        imports[name] = result
+        if "error" in result:
+            print(f"import {name:<20} failed: {result['error']}")
+        else:
+            print(
+                f"import {name:<20} median {result['median_ms']:>7.1f} ms  "
+                f"min {result['min_ms']:>7.1f} ms"
+            )
+
+    slowest = slowest_imports("server", SRC_DIR, env, args.top)
+    print("\nSlowest packages imported by server:")
+    for item in slowest:
+        print(f"  {item['package']:<28} {item['self_ms']:>7.1f} ms")
+
+    # The first start has no schema cache; the second finds the one it wrote
+    startup = {}
+    for runs in ("cold", "warm"):
+        startup[runs] = server_startup(env, args.astra_latency_ms, args.timeout)
+        print(
+            f"\n{runs} start: /healthcheck after {startup[runs]['healthcheck_ms']} ms, "
+            f"/ready after {startup[runs]['ready_ms']} ms"
+        )
+
+    results = {"imports": imports, "slowest_imports": slowest, "startup": startup}
+    output = args.output or os.path.join(
+        BENCH_DIR,
+        "results",
+        f"startup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "python": sys.version.split()[0],
+                **results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nResults written to {output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Ask latency of one small tenant as the number of tenants grows.
+
+Sets up tenants through a tenants file and service.new_tenant, as the server
+does: one heavy tenant (--heavy-size notes), one small probe tenant whose asks
+are timed, and small tenants (--tenant-size notes) up to each --tenants level.
+Runs service.prepare_answer for the probe tenant and reports p50/p95 of the
+whole call and of the search stage, in two layouts:
+
+    tenant  every tenant has its own collection and local mirrors
+    shared  all notes in one collection with one set of mirrors, as before
+            tenants (the probe searches everybody's notes)
+
+FakeCollection scores every note it holds, so its cost grows with the
+collection like a filtered search over a shared collection would.
+
+    cd rag_service
+    python bench/run_tenant_bench.py --tenants 2,8,32 --heavy-size 10000
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import uuid
+
+from run_bench import SRC_DIR, random_note, run_scenario
+from stubs import FakeAsyncCollection, FakeCollection, OpenAIStub, stub_embedding
+
+
+def make_notes(size, rng, domains):
+    # float32 arrays instead of lists keep 10k+ notes in a few hundred MB
+    notes = []
+    for i in range(size):
+        text = random_note(rng)
+        notes.append(
+            {
+                "_id": uuid.uuid4(),
+                "message_id": i,
+                "update_ts": "2024-07-21 12:00:00",
+                "domain": rng.choice(domains),
+                "cleaned_title": text[:20],
+                "cleaned_summary": "This document describes " + text[:80],
+                "cleaned_content": text,
+                "cleaned_concat": text,
+                "reference_url": f"https://bench.local/{i}.html",
+                "$vector": stub_embedding(text),
+            }
+        )
+    return notes
+
+
+def write_tenants_file(path, n_tenants):
+    names = ["heavy", "probe"] + [f"tenant_{i}" for i in range(2, n_tenants)]
+    with open(path, "w") as file:
+        json.dump({"tenants": {name: {} for name in names}}, file)
+    return names
+
+
+def attach(tenant, collection, notes):
+    tenant.collection = collection
+    tenant.async_collection = FakeAsyncCollection(collection)
+    for mirror in tenant.scanned:
+        mirror.build(notes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tenants", default="2,8,32")
+    parser.add_argument("--heavy-size", type=int, default=10000)
+    parser.add_argument("--tenant-size", type=int, default=300)
+    parser.add_argument("--layouts", default="tenant,shared")
+    parser.add_argument("--requests", type=int, default=100, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--llm-latency-ms", type=float, default=0)
+    parser.add_argument("--embed-latency-ms", type=float, default=0)
+    parser.add_argument("--astra-latency-ms", type=float, default=40)
+    parser.add_argument("--local-index", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="defaults to bench/results/tenants_<ts>.json")
+    args = parser.parse_args()
+
+    stub = OpenAIStub(
+        llm_latency_ms=args.llm_latency_ms, embed_latency_ms=args.embed_latency_ms
+    ).start()
+    os.environ.update(
+        OPENAI_BASE_URL=stub.base_url,
+        OPENAI_API_BASE=stub.base_url,
+        OPENAI_API_KEY="bench",
+        EMBEDDING_CHECK_CTX_LENGTH="false",
+        EMBEDDING_CACHE_SIZE="0",
+        # The stub has no rate limits; the limiter would only slow the runs down
+        OPENAI_CHAT_RPM="0",
+        OPENAI_CHAT_TPM="0",
+        OPENAI_EMBED_RPM="0",
+        OPENAI_EMBED_TPM="0",
+        # Every ask should search, not hit the semantic cache
+        ANSWER_CACHE_SIZE="0",
+        LOCAL_VECTOR_INDEX=str(args.local_index).lower(),
+    )
+    os.environ.setdefault("PUBLIC_S3_NAME", "bench-bucket")
+    os.environ.setdefault("RUN_ENV", "BENCH")
+    sys.path.insert(0, SRC_DIR)
+
+    import api
+    import service
+    import tenants
+    import tracing
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    rng = random.Random(args.seed)
+    levels = [int(n) for n in args.tenants.split(",")]
+    heavy_notes = make_notes(args.heavy_size, rng, api.DOMAIN_TAGS)
+    small_notes = [
+        make_notes(args.tenant_size, rng, api.DOMAIN_TAGS)
+        for _ in range(max(levels) - 1)
+    ]
+    questions = [f"what did I note about {random_note(rng, 6)}" for _ in range(50)]
+    print(
+        f"heavy tenant: {args.heavy_size} notes, others: {args.tenant_size} notes each"
+    )
+
+    results = []
+    tenants_path = os.path.join(
+        tempfile.mkdtemp(prefix="tenant_bench_"), "tenants.json"
+    )
+    for layout in args.layouts.split(","):
+        for n_tenants in levels:
+            names = write_tenants_file(tenants_path, n_tenants)
+            registry = tenants.TenantRegistry(
+                tenants_path, "core_messages", factory=service.new_tenant
+            )
+            corpora = dict(zip(names, [heavy_notes] + small_notes[: n_tenants - 1]))
+            if layout == "tenant":
+                for name, notes in corpora.items():
+                    collection = FakeCollection(args.astra_latency_ms)
+                    collection.seed(notes)
+                    attach(registry.get(name), collection, notes)
+            else:
+                everyone = [note for notes in corpora.values() for note in notes]
+                collection = FakeCollection(args.astra_latency_ms)
+                collection.seed(everyone)
+                attach(registry.get("probe"), collection, everyone)
+            service.conn_d["tenants"] = registry
+            probe = registry.get("probe")
+            # Client creation and first connections aren't part of the numbers
+            service.prepare_answer(probe, questions[0])
+
+            result = run_scenario(
+                lambda i: service.prepare_answer(probe, questions[i % len(questions)]),
+                args.requests,
+                args.concurrency,
+                tracing,
+            )
+            search = result["stages"].get("ask.search")
+            total_notes = sum(len(notes) for notes in corpora.values())
+            results.append(
+                {
+                    "layout": layout,
+                    "tenants": n_tenants,
+                    "total_notes": total_notes,
+                    "probe_notes": len(corpora["probe"]),
+                    **result,
+                }
+            )
+            print(
+                f"{layout:<7} tenants={n_tenants:<4} notes={total_notes:<7} "
+                f"ask p50={result['overall']['p50']:>7.1f} ms "
+                f"p95={result['overall']['p95']:>7.1f} ms  "
+                f"search p50={search['p50'] if search else 0:>7.1f} ms "
+                f"p95={search['p95'] if search else 0:>7.1f} ms"
+            )
+            # Let the collections of this level go before the next one
+            for tenant in registry.all():
+                tenant.closed = True
+            del registry, corpora, collection
+
+    stub.stop()
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        f"tenants_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "config": vars(args),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
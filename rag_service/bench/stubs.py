@@ -0,0 +1,507 @@
+"""Local stand-ins for OpenAI, the Astra Data API collection and S3.
+
+Used by the benchmarks so pipelines can be driven without real network calls.
+Latencies are configurable to approximate the real services.
+"""
+
+import asyncio
+import base64
+import collections
+import copy
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+import types
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+EMBEDDING_DIM = 1536
+
+
+def _sleep_ms(latency_ms, jitter_ms=0):
+    delay = latency_ms + (random.uniform(0, jitter_ms) if jitter_ms else 0)
+    if delay > 0:
+        time.sleep(delay / 1000)
+
+
+def stub_embedding(text, dim=EMBEDDING_DIM):
+    """Deterministic, normalized bag-of-words embedding.
+
+    Texts that share words get similar vectors, which keeps vector search and
+    the semantic cache meaningful against the stub.
+    """
+    if isinstance(text, list):
+        tokens = [str(t) for t in text]
+    else:
+        tokens = re.findall(r"\w+", text.lower())
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in tokens or [""]:
+        digest = int.from_bytes(hashlib.sha1(token.encode("utf-8")).digest()[:8], "big")
+        vector[digest % dim] += 1.0 if (digest >> 32) & 1 else -1.0
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Many clients connect at once under load; the default backlog of 5 drops SYNs
+    request_queue_size = 1024
+
+
+class OpenAIStub:
+    """OpenAI-compatible HTTP server for /v1/chat/completions and /v1/embeddings.
+
+    Chat completions honour json_schema response formats (returning the
+    enrichment fields) and stream=True (server-sent chunks).
+    """
+
+    def __init__(
+        self,
+        port=0,
+        llm_latency_ms=300,
+        embed_latency_ms=80,
+        stream_token_ms=20,
+        jitter_ms=0,
+        rpm=0,
+    ):
+        self.llm_latency_ms = llm_latency_ms
+        self.embed_latency_ms = embed_latency_ms
+        self.stream_token_ms = stream_token_ms
+        self.jitter_ms = jitter_ms
+        self.requests = 0
+        # Like OpenAI, enforce rpm (0: unlimited) per second and answer 429
+        self.rpm = rpm
+        self.rejected = 0
+        self._window = collections.deque()
+        self._lock = threading.Lock()
+        self._server = _StubHTTPServer(("127.0.0.1", port), self._handler())
+        self.port = self._server.server_address[1]
+        self.base_url = f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                stub.requests += 1
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if not stub._admit():
+                    self._send_rate_limited()
+                    return
+                if self.path.endswith("/embeddings"):
+                    _sleep_ms(stub.embed_latency_ms, stub.jitter_ms)
+                    self._send_json(stub.embeddings(body))
+                elif body.get("stream"):
+                    _sleep_ms(stub.llm_latency_ms, stub.jitter_ms)
+                    self._send_stream(stub.completion_text(body))
+                else:
+                    _sleep_ms(stub.llm_latency_ms, stub.jitter_ms)
+                    self._send_json(stub.completion(body))
+
+            def _send_json(self, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_rate_limited(self):
+                data = json.dumps(
+                    {"error": {"message": "Rate limit reached", "type": "requests"}}
+                ).encode("utf-8")
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("retry-after-ms", "1000")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, text):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for word in re.findall(r"\S+\s*", text):
+                    _sleep_ms(stub.stream_token_ms)
+                    chunk = {
+                        "id": "stub",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": "stub",
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": {"content": word},
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                    self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                self._write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, text):
+                data = text.encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+        return Handler
+
+    def _admit(self):
+        if not self.rpm:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            while self._window and self._window[0] <= now - 1:
+                self._window.popleft()
+            if len(self._window) >= self.rpm / 60:
+                self.rejected += 1
+                return False
+            self._window.append(now)
+            return True
+
+    def embeddings(self, body):
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        # A list of ints is a single tokenized input
+        if inputs and isinstance(inputs[0], int):
+            inputs = [inputs]
+        # The SDK asks for base64 float32 when numpy is installed, like the real API
+        if body.get("encoding_format") == "base64":
+            encode = lambda v: base64.b64encode(v.astype(np.float32).tobytes()).decode()
+        else:
+            encode = lambda v: v.tolist()
+        tokens = sum(
+            len(text) // 4 if isinstance(text, str) else len(text) for text in inputs
+        )
+        return {
+            "object": "list",
+            "model": body.get("model", "stub"),
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": encode(stub_embedding(text)),
+                }
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def completion_text(self, body):
+        user_prompt = body["messages"][-1]["content"]
+        words = re.findall(r"\w+", user_prompt)
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            return json.dumps(
+                {
+                    "domain": "untagged",
+                    "title": " ".join(words[1:3])[:20] or "Untitled",
+                    "summary": "This document describes " + " ".join(words[1:12]),
+                    "content": user_prompt.strip(),
+                }
+            )
+        return "Stub answer: " + " ".join(words[-40:])
+
+    def completion(self, body):
+        text = self.completion_text(body)
+        prompt_tokens = sum(len(m["content"]) // 4 for m in body["messages"])
+        return {
+            "id": "stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": text},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(text) // 4,
+                "total_tokens": prompt_tokens + len(text) // 4,
+            },
+        }
+
+
+def _serve_stub(ports, kwargs):
+    stub = OpenAIStub(**kwargs).start()
+    ports.put(stub.port)
+    threading.Event().wait()
+
+
+def start_stub_process(**kwargs):
+    """Run an OpenAIStub in its own process, so it doesn't compete for the GIL
+    with the server being measured. Returns (process, base_url)."""
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    process = context.Process(target=_serve_stub, args=(ports, kwargs), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{ports.get(timeout=30)}/v1"
+
+
+def _matches(doc, filter_d):
+    for key, condition in (filter_d or {}).items():
+        if key == "$and":
+            if not all(_matches(doc, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict) and "$in" in condition:
+            if doc.get(key) not in condition["$in"]:
+                return False
+        elif doc.get(key) != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if projection is None:
+        return {k: v for k, v in doc.items() if k != "$vector"}
+    if projection.get("*"):
+        return dict(doc)
+    if any(projection.values()):
+        return {k: v for k, v in doc.items() if k == "_id" or projection.get(k)}
+    return {k: v for k, v in doc.items() if k not in projection and k != "$vector"}
+
+
+def _copy(doc):
+    # deepcopy walks every float of a $vector; a list copy is enough for those
+    vector = doc.get("$vector")
+    if vector is None:
+        return copy.deepcopy(doc)
+    rest = copy.deepcopy({k: v for k, v in doc.items() if k != "$vector"})
+    return {**rest, "$vector": list(vector)}
+
+
+class FakeCollection:
+    """In-memory stand-in for an astrapy Collection with a fixed latency per call."""
+
+    def __init__(self, latency_ms=40, jitter_ms=0, measure_bytes=False):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.calls = 0
+        # With measure_bytes, find() counts the JSON size of the docs it
+        # returns and parses that JSON, as the Data API client would
+        self.measure_bytes = measure_bytes
+        self.bytes_returned = 0
+        self._docs = {}
+        self._lock = threading.Lock()
+        self._skip_latency = threading.local()
+        self._vectors = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _call(self):
+        self.calls += 1
+        if not getattr(self._skip_latency, "value", False):
+            _sleep_ms(self.latency_ms, self.jitter_ms)
+
+    @contextmanager
+    def _no_latency(self):
+        # The async wrapper has already awaited the latency
+        self._skip_latency.value = True
+        try:
+            yield
+        finally:
+            self._skip_latency.value = False
+
+    def _store(self, _id, doc):
+        self._docs[_id] = copy.deepcopy(doc)
+        # Kept as arrays so vector sorts don't convert lists on every find
+        if doc.get("$vector") is not None:
+            self._vectors[_id] = np.asarray(doc["$vector"], dtype=np.float32)
+        else:
+            self._vectors.pop(_id, None)
+
+    def seed(self, docs):
+        """Load docs without paying the per-call latency."""
+        with self._lock:
+            for doc in docs:
+                self._store(doc["_id"], doc)
+
+    def insert_many(self, docs, ordered=True, **kwargs):
+        self._call()
+        with self._lock:
+            for doc in docs:
+                self._store(doc["_id"], doc)
+        return types.SimpleNamespace(inserted_ids=[doc["_id"] for doc in docs])
+
+    def find(
+        self,
+        filter=None,
+        *,
+        projection=None,
+        sort=None,
+        limit=None,
+        include_similarity=False,
+        **kwargs,
+    ):
+        self._call()
+        with self._lock:
+            ids = (filter or {}).get("_id")
+            if isinstance(ids, dict) and list(ids) == ["$in"] and len(filter) == 1:
+                # Primary key lookup, like the Data API
+                docs = [self._docs[_id] for _id in ids["$in"] if _id in self._docs]
+            else:
+                docs = [doc for doc in self._docs.values() if _matches(doc, filter)]
+        if sort and "$vector" in sort:
+            query = np.asarray(sort["$vector"], dtype=np.float32)
+            scored = [
+                (float(np.dot(query, self._vectors[doc["_id"]])), doc)
+                for doc in docs
+                if doc["_id"] in self._vectors
+            ]
+            scored.sort(key=lambda pair: -pair[0])
+            results = []
+            for score, doc in scored[:limit]:
+                doc = _project(doc, projection)
+                if include_similarity:
+                    doc["$similarity"] = score
+                results.append(doc)
+        else:
+            results = [_project(doc, projection) for doc in docs[:limit]]
+        if self.measure_bytes:
+            payloads = [json.dumps(doc, default=str) for doc in results]
+            with self._lock:
+                self.bytes_returned += sum(len(payload) for payload in payloads)
+            # Parsed for the cost only: the copies below keep UUID _ids
+            for payload in payloads:
+                json.loads(payload)
+        return iter([_copy(doc) for doc in results])
+
+    def find_one(self, filter=None, *, projection=None, **kwargs):
+        results = list(self.find(filter, projection=projection, limit=1))
+        return results[0] if results else None
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        self._call()
+        with self._lock:
+            for doc in self._docs.values():
+                if _matches(doc, filter):
+                    doc.update(copy.deepcopy(update.get("$set", {})))
+                    return types.SimpleNamespace(update_info={"n": 1})
+        return types.SimpleNamespace(update_info={"n": 0})
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        self._call()
+        with self._lock:
+            for _id, doc in self._docs.items():
+                if _matches(doc, filter):
+                    self._store(_id, {**replacement, "_id": _id})
+                    return types.SimpleNamespace(update_info={"n": 1})
+            if upsert:
+                self._store(replacement["_id"], replacement)
+        return types.SimpleNamespace(update_info={"n": 0})
+
+    def options(self, **kwargs):
+        self._call()
+        return types.SimpleNamespace(
+            vector=types.SimpleNamespace(dimension=EMBEDDING_DIM, metric="dot_product")
+        )
+
+    def to_async(self):
+        return FakeAsyncCollection(self)
+
+
+class FakeDatabase:
+    """Stand-in for an astrapy Database: a FakeCollection per collection name."""
+
+    def __init__(self, latency_ms=40, jitter_ms=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.collections = {}
+
+    def get_collection(self, name, **kwargs):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self.latency_ms, self.jitter_ms)
+        return self.collections[name]
+
+
+class _FakeAsyncCursor:
+    def __init__(self, latency_ms, jitter_ms, results):
+        self._latency_ms = latency_ms
+        self._jitter_ms = jitter_ms
+        self._results = results
+
+    async def __aiter__(self):
+        await _async_sleep_ms(self._latency_ms, self._jitter_ms)
+        for doc in self._results():
+            yield doc
+
+
+async def _async_sleep_ms(latency_ms, jitter_ms=0):
+    delay = latency_ms + (random.uniform(0, jitter_ms) if jitter_ms else 0)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+
+class FakeAsyncCollection:
+    """astrapy AsyncCollection counterpart of FakeCollection, sharing its documents."""
+
+    def __init__(self, collection):
+        self.sync = collection
+
+    def find(self, filter=None, **kwargs):
+        # Like astrapy, find() returns a cursor and the latency is paid on iteration
+        return _FakeAsyncCursor(
+            self.sync.latency_ms,
+            self.sync.jitter_ms,
+            lambda: self._without_latency(self.sync.find, filter, **kwargs),
+        )
+
+    async def insert_many(self, docs, **kwargs):
+        await _async_sleep_ms(self.sync.latency_ms, self.sync.jitter_ms)
+        return self._without_latency(self.sync.insert_many, docs, **kwargs)
+
+    async def update_one(self, filter, update, **kwargs):
+        await _async_sleep_ms(self.sync.latency_ms, self.sync.jitter_ms)
+        return self._without_latency(self.sync.update_one, filter, update, **kwargs)
+
+    async def replace_one(self, filter, replacement, **kwargs):
+        await _async_sleep_ms(self.sync.latency_ms, self.sync.jitter_ms)
+        return self._without_latency(
+            self.sync.replace_one, filter, replacement, **kwargs
+        )
+
+    def _without_latency(self, method, *args, **kwargs):
+        with self.sync._no_latency():
+            return method(*args, **kwargs)
+
+
+class FakeS3Client:
+    """Stand-in for the boto3 S3 client calls used by api.py."""
+
+    def __init__(self, latency_ms=60, jitter_ms=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        _sleep_ms(self.latency_ms, self.jitter_ms)
+        self.objects[(Bucket, Key)] = Body
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        _sleep_ms(self.latency_ms, self.jitter_ms)
+        if (Bucket, Key) not in self.objects:
+            raise KeyError(Key)
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """Cache of generated answers keyed by query embedding.
+
+    A lookup hits when a cached query embedding is within `threshold` dot
+    product similarity of the new one. Each entry remembers which docs and
+    domains fed its answer. add(docs) is called after every insert and drops
+    entries that used one of those docs or cover the same domain, or any
+    entry whose search wasn't limited to its domains. Entries
+    expire after `ttl` seconds, and the least recently used entry is evicted
+    beyond `max_entries`.
+    """
+
+    def __init__(self, threshold=0.9, max_entries=256, ttl=3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def lookup(self, vector):
+        """Return the cached answer for a similar query, or None."""
+        query = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                self._counters["misses"] += 1
+                return None
+            if self._matrix is None:
+                self._matrix = np.stack([e["vector"] for e in self._entries.values()])
+            scores = self._matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self._counters["misses"] += 1
+                return None
+            key = list(self._entries)[best]
+            self._entries.move_to_end(key)
+            self._matrix = None
+            self._counters["hits"] += 1
+            return self._entries[key]["answer"]
+
+    def store(self, vector, answer, docs, any_domain=False):
+        """Cache the answer generated from docs (DocRecords) for this query.
+
+        Args:
+            any_domain (bool): docs of any domain could have been retrieved,
+                e.g. by the lexical index, which isn't filtered by domain; the
+                answer is then dropped on every insert
+        """
+        domains = None if any_domain else {doc.domain for doc in docs}
+        with self._lock:
+            self._entries[self._next_key] = {
+                "vector": np.asarray(vector, dtype=np.float32),
+                "answer": answer,
+                "doc_ids": {str(doc.id) for doc in docs},
+                # None: any new note could change the answer
+                "domains": domains or None,
+                "created": time.time(),
+            }
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+            self._matrix = None
+
+    def add(self, docs):
+        """Invalidate answers affected by newly inserted or changed docs."""
+        doc_ids = {str(doc["_id"]) for doc in docs}
+        domains = {doc.get("domain") for doc in docs}
+        with self._lock:
+            stale = [
+                key
+                for key, entry in self._entries.items()
+                if entry["doc_ids"] & doc_ids
+                or entry["domains"] is None
+                or entry["domains"] & domains
+            ]
+            self._drop(stale, "invalidations")
+
+    def set_reference_urls(self, urls):
+        """Nothing to do: a new reference URL doesn't change an answer."""
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "hit_rate": round(self._counters["hits"] / lookups, 4)
+                if lookups
+                else 0.0,
+            }
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, e in self._entries.items() if e["created"] < cutoff]
+        self._drop(expired, "evictions")
+
+    def _drop(self, keys, counter):
+        for key in keys:
+            del self._entries[key]
+            self._counters[counter] += 1
+        if keys:
+            self._matrix = None
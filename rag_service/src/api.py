@@ -1,41 +1,79 @@
+import asyncio
 import datetime
+import hashlib
+import json
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
+import clients
 import llm_helper
-import markdown
-from astrapy import DataAPIClient
-from astrapy.constants import VectorMetric
-from astrapy.exceptions import CollectionAlreadyExistsException, InsertManyException
-from astrapy.ids import UUID, uuid8
-from astrapy.info import CollectionVectorServiceOptions
+import resilience
+import tracing
+import vector_index
+from context_packer import ContextPacker
 from dotenv import load_dotenv
 from loguru import logger
+from records import CONTENT_PROJECTION, SUMMARY_PROJECTION, DocRecord
 
 load_dotenv("../.env")
 
 lg = logger.info
 
+DOMAIN_TAGS = ["dev-ideas", "lessons", "data-engineering", "life"]
+
+# astrapy and markdown are imported where they are used: astrapy loads when
+# service.setup connects in the background, so the server starts without it.
+
+# Per-attempt timeout of Data API calls, capped by the caller's deadline
+ASTRA_TIMEOUT = float(os.environ.get("ASTRA_TIMEOUT", 20))
+
+
+def _astra_ms():
+    return int(resilience.attempt_timeout(ASTRA_TIMEOUT) * 1000)
+
+
+def uuid8():
+    # Time-ordered _ids, as astrapy generates them
+    from astrapy.ids import uuid8
+
+    return uuid8()
+
+
+def build_domain_prompts(text):
+    tags_str = "','".join(DOMAIN_TAGS)
+
+    system_prompt = f"""
+    I have a piece of text and a list of tags. Please infer the tag that best matches the text. Return the tag as a string. If you are unable to infer the tag, return "untagged". Do not return anything else.
+    """
+
+    user_prompt = f"""\
+    tags: ['{tags_str}']
+    text: {text}
+    """
+    return system_prompt, user_prompt
+
 
 def infer_domain(text):
     if text.startswith("#"):
         return text.split(" ")[0][1:]
     else:
-        tag_list = ["dev-ideas", "lessons", "data-engineering", "life"]
-        tags_str = "','".join(tag_list)
-
-        system_prompt = f"""
-        I have a piece of text and a list of tags. Please infer the tag that best matches the text. Return the tag as a string. If you are unable to infer the tag, return "untagged". Do not return anything else.
-        """
+        system_prompt, user_prompt = build_domain_prompts(text)
+        response = llm_helper.call_openai_response(
+            system_prompt, user_prompt, prompt_name="domain"
+        )
+        return response.choices[0].message.content
 
-        user_prompt = f"""\
-        tags: ['{tags_str}']
-        text: {text}
-        """
 
-        response = llm_helper.call_openai_response(system_prompt, user_prompt)
-        return response.choices[0].message.content
+async def ainfer_domain(text):
+    if text.startswith("#"):
+        return infer_domain(text)
+    system_prompt, user_prompt = build_domain_prompts(text)
+    response = await llm_helper.acall_openai_response(
+        system_prompt, user_prompt, prompt_name="domain"
+    )
+    return response.choices[0].message.content
 
 
 def summarise_content(text):
@@ -47,7 +85,9 @@ def summarise_content(text):
     text: {text}
     """
 
-    response = llm_helper.call_openai_response(system_prompt, user_prompt)
+    response = llm_helper.call_openai_response(
+        system_prompt, user_prompt, prompt_name="summary"
+    )
     return response.choices[0].message.content
 
 
@@ -60,7 +100,9 @@ def infer_title(text):
     text: {text}
     """
 
-    response = llm_helper.call_openai_response(system_prompt, user_prompt)
+    response = llm_helper.call_openai_response(
+        system_prompt, user_prompt, prompt_name="title"
+    )
     return response.choices[0].message.content
 
 
@@ -73,10 +115,134 @@ def clean_content(text):
     text: {text}
     """
 
-    response = llm_helper.call_openai_response(system_prompt, user_prompt)
+    response = llm_helper.call_openai_response(
+        system_prompt, user_prompt, prompt_name="content"
+    )
     return response.choices[0].message.content
 
 
+ENRICHMENT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "enrichment",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "domain": {"type": "string", "enum": DOMAIN_TAGS + ["untagged"]},
+                "title": {"type": "string"},
+                "summary": {"type": "string"},
+                "content": {"type": "string"},
+            },
+            "required": ["domain", "title", "summary", "content"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def enrich_content_structured(text):
+    tags_str = "','".join(DOMAIN_TAGS)
+    system_prompt = f"""
+    You are given a piece of text. Return a JSON object with the following fields:
+    - domain: the tag from ['{tags_str}'] that best matches the text. If you are unable to infer the tag, return "untagged".
+    - title: a title that best describes the text. Use less than 20 characters. If you are unable to infer a title, return 'Untitled'.
+    - summary: a summary of the text in less than 120 characters. Start with <This document describes ...>
+    - content: the text cleaned up, including proper formatting so that it is easy to understand. Do not rephrase a sentence if the language is already concise and clear. Use concise language that a B2 English proficiency speaker would use. Use Markdown format. Add hyperlinks where appropriate.
+    """
+
+    user_prompt = f"""
+    text: {text}
+    """
+
+    response = llm_helper.call_openai_response(
+        system_prompt,
+        user_prompt,
+        response_format=ENRICHMENT_RESPONSE_FORMAT,
+        prompt_name="enrich",
+    )
+    content = response.choices[0].message.content
+    if content is None:
+        raise ValueError("Structured enrichment was refused")
+    fields = json.loads(content)
+    for key in ["domain", "title", "summary", "content"]:
+        if not isinstance(fields.get(key), str):
+            raise ValueError(f"Structured enrichment is missing field: {key}")
+    return fields
+
+
+def _timed(stage, func, *args):
+    start = time.perf_counter()
+    with tracing.span(stage):
+        result = func(*args)
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+
+def enrich_content(text):
+    """Produce domain, title, summary and cleaned content for a note.
+
+    Tries a single structured (JSON schema) completion first. If its response
+    doesn't parse or lacks a field, the individual prompts are fired in
+    parallel instead. A failed call is raised as is: four more calls to a
+    dependency that just failed would only fail too.
+
+    Returns:
+        tuple: (fields dict, timings dict in ms)
+    """
+    timings = {}
+    try:
+        fields, timings["structured"] = _timed(
+            "save.enrich", enrich_content_structured, text
+        )
+    except ValueError as e:
+        # json.JSONDecodeError is a ValueError too
+        logger.warning(f"Structured enrichment failed, falling back to parallel: {e}")
+        prompts = {
+            "domain": infer_domain,
+            "title": infer_title,
+            "summary": summarise_content,
+            "content": clean_content,
+        }
+        with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+            futures = {
+                key: resilience.submit(
+                    executor, _timed, f"save.enrich.{key}", func, text
+                )
+                for key, func in prompts.items()
+            }
+            fields = {}
+            for key, future in futures.items():
+                fields[key], timings[key] = future.result()
+
+    # An explicit #tag always wins over the inferred domain
+    if text.startswith("#"):
+        fields["domain"] = infer_domain(text)
+    return fields, timings
+
+
+def resolve_domain(text, embedding=None, router=None, fallback=None):
+    """Pick the domain for a text: #tag, then the local router, then the LLM.
+
+    Args:
+        router (DomainRouter): classifies the embedding against domain centroids
+        fallback (callable): used when the router is not confident, defaults
+            to infer_domain
+    """
+    if text.startswith("#"):
+        return infer_domain(text)
+    fallback = fallback or (lambda: infer_domain(text))
+    if router is None or embedding is None:
+        return fallback()
+    return router.route(embedding, fallback)
+
+
+async def aresolve_domain(text, embedding=None, router=None):
+    """Async counterpart of resolve_domain, escalating to ainfer_domain."""
+    if text.startswith("#") or router is None or embedding is None:
+        return await ainfer_domain(text)
+    return await router.aroute(embedding, lambda: ainfer_domain(text))
+
+
 def preprocess_content(text):
     if text is None:
         text = ""
@@ -84,33 +250,41 @@ def preprocess_content(text):
     return text.strip()
 
 
-def prepare_doc(message_id, raw_content):
+def content_hash(text):
+    """Hash of the preprocessed raw text, stored on each doc to detect edits."""
+    return hashlib.sha256(preprocess_content(text).encode("utf-8")).hexdigest()
+
 
+def new_doc(message_id, raw_content, _id=None, update_ts=None):
     # Initial content only contains raw_content
     doc = {
-        "_id": uuid8(),
+        "_id": _id or uuid8(),
         "message_id": message_id,
-        "update_ts": datetime.datetime.now(datetime.timezone.utc).strftime(
-            "%Y-%m-%d %H:%M:%S"
-        ),
+        "update_ts": update_ts
+        or datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
         "domain": None,
         "cleaned_title": None,
         "cleaned_summary": None,
         "cleaned_content": None,
         "cleaned_concat": None,
         "raw_content": raw_content,
+        "content_hash": content_hash(raw_content),
         "$vector": None,
     }
-    # Call LLM OpenAI to produce cleaned fields
+    return doc
 
-    text = preprocess_content(raw_content)
 
-    domain = infer_domain(text)
-    title = infer_title(text)
-    summary = summarise_content(text)
-    content = clean_content(text)
+def enrich_doc(doc):
+    """Fill the cleaned fields of a doc from its raw_content. Returns timings."""
+    # Call LLM OpenAI to produce cleaned fields
+    text = preprocess_content(doc["raw_content"])
+
+    fields, timings = enrich_content(text)
+    domain = fields["domain"]
+    title = fields["title"]
+    summary = fields["summary"]
+    content = fields["content"]
     concat = " | ".join([title, summary, content])
-    embedding = llm_helper.vectorize_text(concat, llm_helper.initialize_embeddings())
 
     cleaned_data = {}
     cleaned_data["domain"] = domain
@@ -118,73 +292,668 @@ def prepare_doc(message_id, raw_content):
     cleaned_data["cleaned_summary"] = summary
     cleaned_data["cleaned_content"] = content
     cleaned_data["cleaned_concat"] = concat
-    cleaned_data["$vector"] = embedding
     doc.update(cleaned_data)
+    return timings
+
+
+def prepare_doc(message_id, raw_content, on_stage=None, router=None, _id=None):
+
+    doc = new_doc(message_id, raw_content, _id=_id)
+
+    if on_stage:
+        on_stage("enriching")
+    timings = enrich_doc(doc)
+    if on_stage:
+        on_stage("embedding")
+    doc["$vector"], timings["embedding"] = _timed(
+        "save.embed",
+        llm_helper.vectorize_text,
+        doc["cleaned_concat"],
+        llm_helper.initialize_embeddings(),
+    )
+    if doc["$vector"] is None:
+        raise llm_helper.EmbeddingError(f"Embedding failed for message {message_id}")
+    doc["domain"] = stored_domain(doc, router=router)
+    if on_stage:
+        on_stage("rendering")
+    _, timings["reference"] = _timed("save.reference", publish_reference, doc)
+    lg(f"prepare_doc timings (ms): {timings}")
+    return doc
+
+
+def stored_domain(doc, router=None):
+    """The domain to save an enriched doc under: the one enrichment returned.
+
+    The router's centroids are built from stored domains, so letting it
+    relabel docs would pull each centroid further toward itself. It only
+    stands in, through resolve_domain, when enrichment gave no domain.
+    """
+    if doc.get("domain"):
+        return doc["domain"]
+    return resolve_domain(
+        preprocess_content(doc["raw_content"]), doc.get("$vector"), router=router
+    )
+
+
+def _finish_doc(doc, router=None):
+    # The domain and the reference page, once the doc has its $vector
+    doc["domain"] = stored_domain(doc, router=router)
+    publish_reference(doc)
     return doc
 
 
-def retrieve_hybrid_search(text, top_n, collection):
-    """_summary_
+def prepare_docs(messages, executor, on_stage=None, router=None, ids=None):
+    """Batched counterpart of prepare_doc.
+
+    Enrichment and reference uploads run concurrently on executor, and all
+    cleaned texts are embedded with one embed_documents call.
+
+    Args:
+        messages (list): (message_id, raw_content) tuples
+        ids (list): _id for each doc, None to generate one
+
+    Returns:
+        list: one doc per message, or the exception that stopped it
+    """
+    ids = ids or [None] * len(messages)
+    docs = [
+        new_doc(message_id, raw_content, _id=_id)
+        for (message_id, raw_content), _id in zip(messages, ids)
+    ]
+    results = list(docs)
+
+    def settle(futures):
+        for i, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(
+                    f"Preparing doc for message {docs[i]['message_id']} failed: {e}"
+                )
+                results[i] = e
+
+    def pending():
+        return [
+            i for i, result in enumerate(results) if not isinstance(result, Exception)
+        ]
+
+    if on_stage:
+        on_stage("enriching")
+    with tracing.span("save.enrich_batch"):
+        settle(
+            [(i, resilience.submit(executor, enrich_doc, docs[i])) for i in pending()]
+        )
+
+    if on_stage:
+        on_stage("embedding")
+    todo = pending()
+    with tracing.span("save.embed_batch"):
+        vectors = llm_helper.vectorize_texts(
+            [docs[i]["cleaned_concat"] for i in todo],
+            llm_helper.initialize_embeddings(),
+        )
+    for i, vector in zip(todo, vectors):
+        docs[i]["$vector"] = vector
+        if vector is None:
+            results[i] = llm_helper.EmbeddingError("Embedding failed")
+
+    if on_stage:
+        on_stage("rendering")
+    with tracing.span("save.reference_batch"):
+        settle(
+            [
+                (i, resilience.submit(executor, _finish_doc, docs[i], router))
+                for i in pending()
+            ]
+        )
+    return results
+
+
+def revise_doc(doc, raw_content, on_stage=None, router=None):
+    """Apply an edit of the raw text to an existing doc, in place.
+
+    Only the stages whose inputs changed are re-run: an edit that leaves the
+    preprocessed text alone is a no-op, the embedding is kept when the
+    cleaned fields come back unchanged, and the reference page is only
+    uploaded again if it renders differently.
+
+    Returns:
+        dict: the changed fields, empty if the edit changed nothing
+    """
+    digest = content_hash(raw_content)
+    if digest == (doc.get("content_hash") or content_hash(doc.get("raw_content"))):
+        return {}
+
+    before = dict(doc)
+    doc.update(
+        raw_content=raw_content,
+        content_hash=digest,
+        update_ts=datetime.datetime.now(datetime.timezone.utc).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        ),
+    )
+    if on_stage:
+        on_stage("enriching")
+    timings = enrich_doc(doc)
+    if doc["cleaned_concat"] != before.get("cleaned_concat") or not before.get(
+        "$vector"
+    ):
+        if on_stage:
+            on_stage("embedding")
+        doc["$vector"], timings["embedding"] = _timed(
+            "save.embed",
+            llm_helper.vectorize_text,
+            doc["cleaned_concat"],
+            llm_helper.initialize_embeddings(),
+        )
+    doc["domain"] = stored_domain(doc, router=router)
+    if on_stage:
+        on_stage("rendering")
+    _, timings["reference"] = _timed("save.reference", publish_reference, doc)
+    lg(f"revise_doc timings (ms): {timings}")
+    return {
+        key: value
+        for key, value in doc.items()
+        if key != "_id" and before.get(key) != value
+    }
+
+
+def find_by_message_id(collection, message_id):
+    """The stored doc for a Telegram message, including its $vector."""
+    with tracing.span("astra.find"):
+        return resilience.call(
+            "astra.read",
+            lambda: collection.find_one(
+                {"message_id": message_id},
+                projection={"*": True},
+                max_time_ms=_astra_ms(),
+            ),
+            idempotent=True,
+        )
+
+
+def update_doc(collection, doc, changes, mirrors=()):
+    """Write the changed fields of a doc in place and update the mirrors.
+
+    Args:
+        changes (dict): fields to $set, as returned by revise_doc
+        mirrors (list): objects with an add(docs) method that upserts by _id
+    """
+    with tracing.span("astra.update"):
+        # $set of the same fields, so safe to retry
+        response = resilience.call(
+            "astra.write",
+            lambda: collection.update_one(
+                {"_id": doc["_id"]}, {"$set": changes}, max_time_ms=_astra_ms()
+            ),
+        )
+    for mirror in mirrors:
+        mirror.add([doc])
+    return response
+
+
+def insert_docs(collection, docs, mirrors=()):
+    """Insert docs into the collection and keep in-process mirrors in sync.
+
+    Docs whose _id already exists are treated as inserted, so a save can be
+    retried with the same _id without creating a duplicate.
+
+    Args:
+        mirrors (list): objects with an add(docs) method, e.g. LocalVectorIndex
+    """
+    from astrapy.exceptions import InsertManyException
+
+    try:
+        with tracing.span("astra.insert"):
+            # Retrying is safe: docs that already made it in are skipped below
+            response = resilience.call(
+                "astra.write",
+                lambda: collection.insert_many(
+                    docs, ordered=False, max_time_ms=_astra_ms()
+                ),
+            )
+    except InsertManyException as e:
+        errors = [
+            err
+            for err in e.error_descriptors
+            if err.error_code != "DOCUMENT_ALREADY_EXISTS"
+        ]
+        inserted = inserted_ids(e, docs)
+        # Mirror whatever made it in before the caller handles the rest
+        for mirror in mirrors:
+            mirror.add([doc for doc in docs if doc["_id"] in inserted])
+        if errors:
+            raise
+        return e.partial_result
+    for mirror in mirrors:
+        mirror.add(docs)
+    return response
+
+
+def inserted_ids(error, docs):
+    """The _ids of docs that are in the collection after a failed insert_many.
+
+    A replayed save whose doc made it in last time counts as inserted. The
+    Data API names the _id in the message of each error, so docs that already
+    exist are told apart from docs that failed for another reason.
+    """
+    inserted = set(error.partial_result.inserted_ids)
+    existing = [
+        err.message or ""
+        for err in error.error_descriptors
+        if err.error_code == "DOCUMENT_ALREADY_EXISTS"
+    ]
+    if len(existing) == len(error.error_descriptors):
+        return {doc["_id"] for doc in docs}
+    for doc in docs:
+        if any(str(doc["_id"]) in message for message in existing):
+            inserted.add(doc["_id"])
+    return inserted
+
+
+def scan_collection(collection):
+    """Full scan of the collection, including the $vector of each document."""
+    return collection.find({}, projection={"*": True})
+
+
+# Vector and lexical candidates fetched per requested doc before fusing
+FUSION_DEPTH = 4
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Merge ranked DocRecord lists by summing 1 / (k + rank) per doc."""
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = str(doc.id)
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank + 1)
+            # Keep the first copy seen, which carries the similarity if any
+            docs.setdefault(key, doc)
+    order = sorted(scores, key=lambda key: -scores[key])
+    return [docs[key].replace(score=scores[key]) for key in order]
+
+
+def lexical_fast_path(lexical, text, top_n):
+    """Docs for a quoted-phrase or name lookup from the lexical index, else None."""
+    if lexical is None or not lexical.is_fresh():
+        return None
+    with tracing.span("ask.lexical"):
+        docs = lexical.exact_match(text, top_n)
+    if docs:
+        lg(f"Lexical fast path matched {len(docs)} docs")
+        return docs
+    return None
+
+
+def _fuse(lexical, text, vector_docs, top_n):
+    if lexical is None or not lexical.is_fresh():
+        return vector_docs[:top_n]
+    with tracing.span("ask.fuse"):
+        # No domain filter on the lexical side: a keyword hit in another
+        # domain is still a strong signal
+        lexical_docs = lexical.search(text, top_n * FUSION_DEPTH)
+        docs = reciprocal_rank_fusion([vector_docs, lexical_docs])[:top_n]
+        # The lexical index holds the text of every note, so the winners
+        # found in Astra don't need a second request for it
+        known = lexical.records([doc.id for doc in docs if not doc.hydrated])
+        return [
+            doc.replace(
+                content=known[doc.id].content,
+                raw_content=known[doc.id].raw_content,
+                hydrated=True,
+            )
+            if doc.id in known
+            else doc
+            for doc in docs
+        ]
+
+
+def _search_depth(lexical, top_n):
+    return top_n * FUSION_DEPTH if lexical is not None and lexical.is_fresh() else top_n
+
+
+# Most values the Data API takes in an $in filter
+IN_LIMIT = 100
+
+
+def _id_chunks(ids):
+    return [ids[i : i + IN_LIMIT] for i in range(0, len(ids), IN_LIMIT)]
+
+
+def fetch_vectors(collection, ids):
+    """Full $vectors of the docs with the given _ids, by _id.
+
+    Fetched IN_LIMIT ids per request.
+    """
+
+    def find(chunk):
+        return list(
+            collection.find(
+                {"_id": {"$in": chunk}},
+                projection={"$vector": True},
+                limit=len(chunk),
+                max_time_ms=_astra_ms(),
+            )
+        )
+
+    vectors = {}
+    with tracing.span("astra.fetch_vectors"):
+        for chunk in _id_chunks(ids):
+            docs = resilience.call("astra.read", lambda: find(chunk), idempotent=True)
+            vectors.update((doc["_id"], doc.get("$vector")) for doc in docs)
+    return vectors
+
+
+async def afetch_vectors(collection, ids):
+    """Async counterpart of fetch_vectors; the requests run concurrently."""
+
+    async def find(chunk):
+        cursor = collection.find(
+            {"_id": {"$in": chunk}},
+            projection={"$vector": True},
+            limit=len(chunk),
+            max_time_ms=_astra_ms(),
+        )
+        return [doc async for doc in cursor]
+
+    with tracing.span("astra.fetch_vectors"):
+        found = await asyncio.gather(
+            *(
+                resilience.acall(
+                    "astra.read", lambda chunk=chunk: find(chunk), idempotent=True
+                )
+                for chunk in _id_chunks(ids)
+            )
+        )
+    return {doc["_id"]: doc.get("$vector") for docs in found for doc in docs}
+
+
+def hydrate_docs(collection, docs):
+    """Load the text of the DocRecords that don't have it yet, in one request.
+
+    Records from the local indexes, or fused with the lexical index's, already
+    have it. Docs deleted since they were found are dropped.
+    """
+    missing = [doc for doc in docs if not doc.hydrated]
+    if not missing or collection is None:
+        return docs
+    ids = [doc.id for doc in missing]
+    with tracing.span("astra.hydrate"):
+        found = resilience.call(
+            "astra.read",
+            lambda: list(
+                collection.find(
+                    {"_id": {"$in": ids}},
+                    projection=CONTENT_PROJECTION,
+                    limit=len(ids),
+                    max_time_ms=_astra_ms(),
+                )
+            ),
+            idempotent=True,
+        )
+    return _hydrated(docs, missing, found)
+
+
+async def ahydrate_docs(collection, docs):
+    """Async counterpart of hydrate_docs."""
+    missing = [doc for doc in docs if not doc.hydrated]
+    if not missing or collection is None:
+        return docs
+    ids = [doc.id for doc in missing]
+
+    async def find():
+        cursor = collection.find(
+            {"_id": {"$in": ids}},
+            projection=CONTENT_PROJECTION,
+            limit=len(ids),
+            max_time_ms=_astra_ms(),
+        )
+        return [doc async for doc in cursor]
+
+    with tracing.span("astra.hydrate"):
+        found = await resilience.acall("astra.read", find, idempotent=True)
+    return _hydrated(docs, missing, found)
+
+
+def _hydrated(docs, missing, found):
+    found = {doc["_id"]: doc for doc in found}
+    for doc in missing:
+        if doc.id in found:
+            doc.hydrate(found[doc.id])
+    return [doc for doc in docs if doc.hydrated]
+
+
+def _search_projection(with_text):
+    return (
+        {**SUMMARY_PROJECTION, **CONTENT_PROJECTION}
+        if with_text
+        else SUMMARY_PROJECTION
+    )
+
+
+def vector_search(
+    collection, embedding, depth, domain=None, index=None, with_text=False
+):
+    """The depth nearest docs to embedding, within domain if given.
+
+    Searched in the local index when it is fresh, otherwise in Astra. A
+    ReducedVectorIndex is searched for index.candidates docs first, which are
+    then reranked with their full vectors fetched from Astra.
 
     Args:
-        filter_d (dict): {"domain":"ideas"} | {"$and": [{"name": "John"}, {"price": {"$lt": 100}}]}
-        text (str): _description_
-        top_n (int): _description_
+        with_text (bool): also fetch the text from Astra, for callers that
+            will use every doc returned
 
     Returns:
-        _type_: _description_
+        list: DocRecords, best first. Records found in Astra carry only the
+            SUMMARY_PROJECTION fields (unless with_text) until hydrate_docs
+            is called on them.
     """
-    embedding = llm_helper.vectorize_text(text, llm_helper.initialize_embeddings())
+    if index is None or not index.is_fresh():
+        filter_d = {"domain": domain} if domain else {}
+        with tracing.span("astra.find"):
+            # The cursor only hits the Data API once iterated
+            docs = resilience.call(
+                "astra.read",
+                lambda: list(
+                    collection.find(
+                        filter_d,
+                        projection=_search_projection(with_text),
+                        sort={"$vector": embedding},
+                        limit=depth,
+                        include_similarity=True,
+                        max_time_ms=_astra_ms(),
+                    )
+                ),
+                idempotent=True,
+            )
+        return [DocRecord.from_doc(doc) for doc in docs]
+    if not isinstance(index, vector_index.ReducedVectorIndex):
+        return index.search(embedding, depth, domain=domain)
+    candidates = index.search(embedding, max(depth, index.candidates), domain=domain)
+    if not candidates:
+        return []
+    try:
+        vectors = fetch_vectors(collection, [doc.id for doc in candidates])
+    except Exception as e:
+        logger.warning(f"Rerank fetch failed, keeping the first-stage ranking: {e}")
+        return candidates[:depth]
+    with tracing.span("ask.rerank"):
+        return vector_index.rerank(embedding, candidates, vectors, depth)
+
 
-    domain = infer_domain(text)
+async def avector_search(
+    collection, embedding, depth, domain=None, index=None, with_text=False
+):
+    """Async counterpart of vector_search.
+
+    Args:
+        collection (AsyncCollection): astrapy async collection
+    """
+    if index is None or not index.is_fresh():
+        filter_d = {"domain": domain} if domain else {}
+
+        async def find():
+            cursor = collection.find(
+                filter_d,
+                projection=_search_projection(with_text),
+                sort={"$vector": embedding},
+                limit=depth,
+                include_similarity=True,
+                max_time_ms=_astra_ms(),
+            )
+            return [doc async for doc in cursor]
+
+        with tracing.span("astra.find"):
+            docs = await resilience.acall("astra.read", find, idempotent=True)
+        return [DocRecord.from_doc(doc) for doc in docs]
+    if not isinstance(index, vector_index.ReducedVectorIndex):
+        return index.search(embedding, depth, domain=domain)
+    candidates = index.search(embedding, max(depth, index.candidates), domain=domain)
+    if not candidates:
+        return []
+    try:
+        vectors = await afetch_vectors(collection, [doc.id for doc in candidates])
+    except Exception as e:
+        logger.warning(f"Rerank fetch failed, keeping the first-stage ranking: {e}")
+        return candidates[:depth]
+    with tracing.span("ask.rerank"):
+        return vector_index.rerank(embedding, candidates, vectors, depth)
+
+
+def retrieve_hybrid_search(
+    text,
+    top_n,
+    collection,
+    index=None,
+    embedding=None,
+    router=None,
+    lexical=None,
+    fast_path=True,
+):
+    """Retrieve the top_n docs for a question.
+
+    Quoted-phrase and name lookups are answered from the lexical index
+    without an embedding. Otherwise vector results (local index or Astra, within the
+    routed domain) are fused with BM25 results by reciprocal rank fusion.
+
+    Args:
+        text (str): the question
+        top_n (int): number of docs to return
+        index (LocalVectorIndex): searched instead of Astra when it is fresh,
+            see vector_search
+        embedding (list): precomputed query embedding, if the caller has one
+        router (DomainRouter): picks the domain filter without an LLM call
+        lexical (LexicalIndex): BM25 index for the fast path and fusion
+        fast_path (bool): False if the caller already tried lexical_fast_path
+
+    Returns:
+        list: DocRecords, best first; see vector_search for which are hydrated
+    """
+    if fast_path:
+        docs = lexical_fast_path(lexical, text, top_n)
+        if docs:
+            return docs
+
+    if embedding is None:
+        with tracing.span("ask.embed"):
+            embedding = llm_helper.vectorize_text(
+                text, llm_helper.initialize_embeddings()
+            )
+
+    with tracing.span("ask.domain"):
+        domain = resolve_domain(text, embedding, router=router)
     if domain == "":
         filter_d = {}
     else:
         filter_d = {"domain": domain}
 
     lg(filter_d)
-    results_ite = collection.find(
-        filter_d,
-        sort={"$vector": embedding},
-        limit=top_n,
-    )
+    depth = _search_depth(lexical, top_n)
+    with tracing.span("ask.search"):
+        # Without fusion every doc found is used, so its text comes along
+        vector_docs = vector_search(
+            collection,
+            embedding,
+            depth,
+            domain=filter_d.get("domain"),
+            index=index,
+            with_text=depth <= top_n,
+        )
+    return _fuse(lexical, text, vector_docs, top_n)
 
-    # query = results_ite.get_sort_vector()
-    return [doc for doc in results_ite]
 
+async def aretrieve_hybrid_search(
+    text,
+    top_n,
+    collection,
+    index=None,
+    embedding=None,
+    router=None,
+    lexical=None,
+    fast_path=True,
+):
+    """Async counterpart of retrieve_hybrid_search.
 
-def repack_docs_to_str_list(docs, keep_keys, sep="---"):
-    repack_ls = []
-    for doc in docs:
-        doc_str = ""
-        for key in keep_keys:
-            if key == "update_ts":
-                doc_str += f"*{key.upper()}* : {doc.get(key)}\n"
-            else:
-                doc_str += f"*{key.upper()}* :\n{doc.get(key)}\n"
-        repack_ls.append(doc_str)
-    return repack_ls
+    Args:
+        collection (AsyncCollection): astrapy async collection
+    """
+    if fast_path:
+        docs = lexical_fast_path(lexical, text, top_n)
+        if docs:
+            return docs
 
+    if embedding is None:
+        with tracing.span("ask.embed"):
+            embedding = await llm_helper.avectorize_text(
+                text, llm_helper.initialize_embeddings()
+            )
 
-# Helper
-def upload_to_s3(file_path, object_name, bucket_name=os.environ["PUBLIC_S3_NAME"]):
+    with tracing.span("ask.domain"):
+        domain = await aresolve_domain(text, embedding, router=router)
+    filter_d = {} if domain == "" else {"domain": domain}
 
-    if os.environ["RUN_ENV"] == "LOCAL":
-        aws_profile = "developer_crc_PermissionSet"
-        session = boto3.Session(profile_name=aws_profile)
-    else:
-        session = boto3.Session()
+    lg(filter_d)
+    depth = _search_depth(lexical, top_n)
+    with tracing.span("ask.search"):
+        vector_docs = await avector_search(
+            collection,
+            embedding,
+            depth,
+            domain=filter_d.get("domain"),
+            index=index,
+            with_text=depth <= top_n,
+        )
+    return _fuse(lexical, text, vector_docs, top_n)
 
-    try:
 
-        s3_client = session.client("s3")
-        s3_client.upload_file(file_path, bucket_name, object_name)
-        print(f"Successfully uploaded {file_path} to s3://{bucket_name}/{object_name}")
+# Helper
+def upload_to_s3(body, object_name, bucket_name=None):
+    bucket_name = bucket_name or os.environ["PUBLIC_S3_NAME"]
+    try:
+        s3_client = clients.get_s3_client()
+        with tracing.span("s3.put"):
+            # Object names are content-addressed, so a retried put is harmless
+            resilience.call(
+                "s3",
+                s3_client.put_object,
+                Bucket=bucket_name,
+                Key=object_name,
+                Body=body,
+                ContentType="text/html; charset=utf-8",
+            )
+        lg(f"Successfully uploaded s3://{bucket_name}/{object_name}")
+        return True
     except Exception as e:
-        print(f"Error uploading {file_path} to S3: {e}")
+        logger.error(f"Error uploading {object_name} to S3: {e}")
+        return False
+
 
+def render_html(doc):
+    import markdown
 
-def create_html_file(doc):
     # Convert cleaned_content from markdown to HTML
     html_content = markdown.markdown(doc["cleaned_content"])
 
@@ -208,44 +977,132 @@ def create_html_file(doc):
     </body>
     </html>
     """
-    current_ts = datetime.datetime.now().strftime("%H%M%S")
-    # Create file name
-    sanitise_title = re.sub(r"[^a-zA-Z0-9 ]", "", doc["cleaned_title"]).lower()
-    object_name = f"{sanitise_title.replace(' ', '_')}_{current_ts}.html"
+    return html
 
-    # Save HTML content to file
-    with open("tmp.html", "w", encoding="utf-8") as file:
-        file.write(html)
 
-    return object_name
+def reference_object_name(doc, body):
+    # Content-addressed, so an unchanged page always maps to the same key
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    sanitise_title = re.sub(r"[^a-zA-Z0-9 ]", "", doc["cleaned_title"]).lower()
+    return f"{sanitise_title.replace(' ', '_')}_{digest}.html"
 
 
-def upload_to_s3_workflow(docs):
-    links = []
-    for doc in docs:
-        # Create HTML file
-        object_name = create_html_file(doc)
-
-        # Upload the file to S3
-        upload_to_s3("tmp.html", object_name)
-        link = f"https://{os.environ['PUBLIC_S3_NAME']}.s3.amazonaws.com/{object_name}"
-        links.append(link)
-        # Clean up the local file
-        os.remove("tmp.html")
-    return links
-
-
-def augmented_generation(prompt, docs):
-
-    repacked_docs = repack_docs_to_str_list(
-        docs,
-        keep_keys=[
-            "update_ts",
-            "message_id",
-            "cleaned_title",
-        ],
+def reference_url(object_name):
+    base_url = os.environ.get(
+        "PUBLIC_S3_BASE_URL", f"https://{os.environ['PUBLIC_S3_NAME']}.s3.amazonaws.com"
     )
-    docs_str = "\n---\n".join(repacked_docs)
+    return f"{base_url}/{object_name}"
+
+
+def publish_reference(doc):
+    """Render the doc's reference page in memory, upload it and store its URL."""
+    body = render_html(doc).encode("utf-8")
+    object_name = reference_object_name(doc, body)
+    # Content-addressed, so an unchanged page is already uploaded
+    if doc.get("reference_url") == reference_url(object_name):
+        return doc["reference_url"]
+    if upload_to_s3(body, object_name):
+        doc["reference_url"] = reference_url(object_name)
+    return doc.get("reference_url")
+
+
+def publish_record(doc):
+    """publish_reference for a hydrated DocRecord."""
+    doc.reference_url = publish_reference(doc.to_doc())
+    return doc.reference_url
+
+
+def upload_to_s3_workflow(docs, collection=None, mirrors=()):
+    """Return reference links for DocRecords, publishing any that don't have one yet.
+
+    Docs saved before references were published at save time are uploaded in
+    parallel, and their URL is written back to the collection if one is given,
+    then to the mirrors, so the next answer citing them doesn't publish again.
+    """
+    missing = [doc for doc in docs if not doc.reference_url]
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = [
+                resilience.submit(executor, publish_record, doc) for doc in missing
+            ]
+            for future in futures:
+                future.result()
+        if collection is not None:
+            for doc in missing:
+                if not doc.reference_url:
+                    continue
+                # The answer and its pages exist either way; this only saves
+                # publishing the doc again next time
+                try:
+                    with tracing.span("astra.update"):
+                        resilience.call(
+                            "astra.write",
+                            lambda: collection.update_one(
+                                {"_id": doc.id},
+                                {"$set": {"reference_url": doc.reference_url}},
+                                max_time_ms=_astra_ms(),
+                            ),
+                        )
+                except Exception as e:
+                    logger.warning(
+                        f"Could not store the reference URL of {doc.id}: {e!r}"
+                    )
+            _set_reference_urls(mirrors, missing)
+    return [doc.reference_url for doc in docs if doc.reference_url]
+
+
+def _set_reference_urls(mirrors, docs):
+    urls = {doc.id: doc.reference_url for doc in docs if doc.reference_url}
+    if urls:
+        for mirror in mirrors:
+            mirror.set_reference_urls(urls)
+
+
+async def aupload_to_s3_workflow(docs, collection=None, mirrors=()):
+    """Async counterpart of upload_to_s3_workflow.
+
+    Uploads still go through boto3, so they run on worker threads.
+    """
+    missing = [doc for doc in docs if not doc.reference_url]
+    if missing:
+        await asyncio.gather(
+            *(asyncio.to_thread(publish_record, doc) for doc in missing)
+        )
+        if collection is not None:
+            for doc in missing:
+                if not doc.reference_url:
+                    continue
+                try:
+                    with tracing.span("astra.update"):
+                        await resilience.acall(
+                            "astra.write",
+                            lambda: collection.update_one(
+                                {"_id": doc.id},
+                                {"$set": {"reference_url": doc.reference_url}},
+                                max_time_ms=_astra_ms(),
+                            ),
+                        )
+                except Exception as e:
+                    logger.warning(
+                        f"Could not store the reference URL of {doc.id}: {e!r}"
+                    )
+            _set_reference_urls(mirrors, missing)
+    return [doc.reference_url for doc in docs if doc.reference_url]
+
+
+# Prompt budget for the CONTEXT block, counted with the chat model's tokenizer
+context_packer = ContextPacker(
+    max_tokens=int(os.environ.get("CONTEXT_MAX_TOKENS", 2000)),
+    passage_tokens=int(os.environ.get("CONTEXT_PASSAGE_TOKENS", 200)),
+    model=llm_helper.CHAT_MODEL,
+)
+
+
+def build_generation_prompts(prompt, docs, packer=None):
+    packer = packer or context_packer
+    with tracing.span("ask.pack"):
+        docs_str, pack_stats = packer.pack(prompt, docs)
+    lg(f"Packed context: {pack_stats}")
     system_prompt = f"""
     You are a laidback, helpful daemon living in database. But never mention your role.
     Use the CONTEXT to answer the QUESTION. Try to use all context blocks to answer, only if the context is relevant to the QUESTION. Context blocks are separated by --- and are ordered by importance.
@@ -265,31 +1122,152 @@ def augmented_generation(prompt, docs):
         docs_str=docs_str, prompt=prompt
     )
 
-    lg(docs_str)
+    logger.debug(docs_str)
+    return system_prompt, user_prompt
+
+
+def format_references(links):
+    links_str = "\n".join([f"{i+1}. {link}" for i, link in enumerate(links)])
+    return "\n\nREFERENCES:\n" + links_str
+
+
+def augmented_generation(prompt, docs, collection=None, mirrors=()):
+
+    # Only the docs that are packed and referenced need their text
+    with tracing.span("ask.hydrate"):
+        docs = hydrate_docs(collection, docs)
+    system_prompt, user_prompt = build_generation_prompts(prompt, docs)
 
     # Generate the llm reply
-    response = llm_helper.call_openai_response(system_prompt, user_prompt)
+    with tracing.span("ask.generate"):
+        response = llm_helper.call_openai_response(
+            system_prompt, user_prompt, prompt_name="generate"
+        )
     response_text = response.choices[0].message.content
     lg(response_text)
 
-    response_text
-
     # Generate the links to HTML of the docs.
-    links = upload_to_s3_workflow(docs)
-    links_str = "\n".join([f"{i+1}. {link}" for i, link in enumerate(links)])
+    with tracing.span("ask.references"):
+        links = upload_to_s3_workflow(docs, collection=collection, mirrors=mirrors)
     # Append the links as references
-    response_text_reference = response_text + "\n\nREFERENCES:\n" + links_str
+    response_text_reference = response_text + format_references(links)
     lg(response_text_reference)
     return response_text_reference  # string
 
 
+def augmented_generation_stream(prompt, docs, collection=None, mirrors=()):
+    """Streaming counterpart of augmented_generation.
+
+    Yields ("token", text) for each completion delta, then ("references", text)
+    once generation finishes. Missing reference pages are published while the
+    answer streams.
+    """
+    with tracing.span("ask.hydrate"):
+        docs = hydrate_docs(collection, docs)
+    system_prompt, user_prompt = build_generation_prompts(prompt, docs)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        links_future = resilience.submit(
+            executor, upload_to_s3_workflow, docs, collection, mirrors
+        )
+        for delta in llm_helper.stream_openai_response(
+            system_prompt, user_prompt, prompt_name="generate"
+        ):
+            yield "token", delta
+        yield "references", format_references(links_future.result())
+
+
+async def aaugmented_generation(prompt, docs, collection=None, mirrors=()):
+    """Async counterpart of augmented_generation.
+
+    Args:
+        collection (AsyncCollection): astrapy async collection
+    """
+    with tracing.span("ask.hydrate"):
+        docs = await ahydrate_docs(collection, docs)
+    system_prompt, user_prompt = build_generation_prompts(prompt, docs)
+
+    with tracing.span("ask.generate"):
+        response = await llm_helper.acall_openai_response(
+            system_prompt, user_prompt, prompt_name="generate"
+        )
+    response_text = response.choices[0].message.content
+    lg(response_text)
+
+    with tracing.span("ask.references"):
+        links = await aupload_to_s3_workflow(
+            docs, collection=collection, mirrors=mirrors
+        )
+    response_text_reference = response_text + format_references(links)
+    lg(response_text_reference)
+    return response_text_reference
+
+
+async def aaugmented_generation_stream(prompt, docs, collection=None, mirrors=()):
+    """Async counterpart of augmented_generation_stream."""
+    with tracing.span("ask.hydrate"):
+        docs = await ahydrate_docs(collection, docs)
+    system_prompt, user_prompt = build_generation_prompts(prompt, docs)
+
+    links_task = asyncio.ensure_future(
+        aupload_to_s3_workflow(docs, collection, mirrors)
+    )
+    try:
+        async for delta in llm_helper.astream_openai_response(
+            system_prompt, user_prompt, prompt_name="generate"
+        ):
+            yield "token", delta
+        yield "references", format_references(await links_task)
+    finally:
+        links_task.cancel()
+
+
 def connect(endpoint, token, keyspace):
+    """Database handle; no request is made until it is used."""
+    from astrapy import DataAPIClient
+
     client = DataAPIClient(token)
     database = client.get_database(endpoint, namespace=keyspace)
-    lg(f"* Database: {database.info().name}")
+    lg(f"* Database: {endpoint} ({keyspace})")
     return database
 
 
+def check_collection(database, name, dimension, metric="dot_product"):
+    """Create the collection if it is missing and check its vector options.
+
+    Returns:
+        dict: the collection's vector options, {"dimension", "metric"}
+
+    Raises:
+        ValueError: if the collection exists with other vector options
+    """
+    from astrapy.exceptions import CollectionNotFoundException
+
+    expected = {"dimension": dimension, "metric": metric}
+    try:
+        options = database.get_collection(name).options(max_time_ms=_astra_ms())
+    except CollectionNotFoundException:
+        lg(f"Collection {name} not found, creating it")
+        database.create_collection(
+            name,
+            dimension=dimension,
+            metric=metric,
+            check_exists=False,
+            max_time_ms=_astra_ms(),
+        )
+        return expected
+    vector = options.vector
+    schema = {
+        "dimension": vector.dimension if vector else None,
+        "metric": vector.metric if vector else None,
+    }
+    if schema != expected:
+        raise ValueError(
+            f"Collection {name} has vector options {schema}, expected {expected}"
+        )
+    return schema
+
+
 def liveness_check(collection):
 
     try:
@@ -311,6 +1289,10 @@ if __name__ == "__main__":
     import json
     import random
 
+    from astrapy import DataAPIClient
+    from astrapy.constants import VectorMetric
+    from astrapy.exceptions import CollectionAlreadyExistsException
+
     # Initialize the client and get a "Database" object
     client = DataAPIClient(os.environ["ASTRA_API_TOKEN"])
     database = client.get_database(
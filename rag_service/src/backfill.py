@@ -0,0 +1,279 @@
+"""Bulk import of notes into core_messages.
+
+Reads a Telegram export (result.json), a JSON list like data/test_messages.json
+or a JSONL file with one record per line. Records are enriched concurrently,
+embedded in batches and inserted in chunks. Progress is written to a
+checkpoint file, so an interrupted run can be resumed without enriching or
+embedding the same records again.
+
+    python src/backfill.py data/test_messages.json --batch-size 32 --workers 8
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import api
+import llm_helper
+import rate_limiter
+import tracing
+from astrapy.exceptions import InsertManyException
+from loguru import logger
+
+lg = logger.info
+
+# Namespace for deterministic _ids, so re-running an import never duplicates docs
+BACKFILL_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "telegram-rag/backfill")
+
+
+def _telegram_text(text):
+    # Telegram exports split formatted text into a list of strings and entities
+    if isinstance(text, list):
+        return "".join(
+            part if isinstance(part, str) else part.get("text", "") for part in text
+        )
+    return text
+
+
+def normalize_record(record):
+    """Map a Telegram export message or a test_messages.json item to one shape."""
+    if "object_id" in record:
+        return {
+            "object_id": str(record["object_id"]),
+            "timestamp": record.get("timestamp"),
+            "message": record.get("message"),
+        }
+    if record.get("type", "message") != "message":
+        return None
+    return {
+        "object_id": str(record["id"]),
+        "timestamp": (record.get("date") or "").replace("T", " ") or None,
+        "message": _telegram_text(record.get("text")),
+    }
+
+
+def read_records(path):
+    """Yield normalized records from a JSON, Telegram export or JSONL file."""
+    if path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as file:
+            records = (json.loads(line) for line in file if line.strip())
+            for record in records:
+                record = normalize_record(record)
+                if record and record["message"]:
+                    yield record
+        return
+
+    with open(path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    if isinstance(data, dict):
+        data = data.get("messages", [])
+    for record in data:
+        record = normalize_record(record)
+        if record and record["message"]:
+            yield record
+
+
+def dedupe_records(records):
+    """Assign each record a stable key.
+
+    The first record with a given object_id keeps it as its key. Later records
+    with the same object_id but different text become <object_id>-2,
+    <object_id>-3, ... in file order. Exact repeats are dropped.
+    """
+    seen = {}
+    for record in records:
+        object_id = record["object_id"]
+        digest = hashlib.sha256(record["message"].encode("utf-8")).hexdigest()
+        digests = seen.setdefault(object_id, [])
+        if digest in digests:
+            lg(f"Skipping exact duplicate of {object_id}")
+            continue
+        digests.append(digest)
+        key = object_id if len(digests) == 1 else f"{object_id}-{len(digests)}"
+        yield key, record
+
+
+class Checkpoint:
+    """Append-only JSONL log of enriched docs, their vectors and inserted keys."""
+
+    def __init__(self, path):
+        self.path = path
+        self.prepared = {}
+        self.inserted = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    if entry.get("inserted"):
+                        self.inserted.add(entry["key"])
+                        self.prepared.pop(entry["key"], None)
+                    elif "vector" in entry:
+                        if entry["key"] in self.prepared:
+                            self.prepared[entry["key"]]["$vector"] = entry["vector"]
+                    else:
+                        self.prepared[entry["key"]] = entry["doc"]
+            lg(
+                f"Resuming from {path}: {len(self.inserted)} inserted, "
+                f"{len(self.prepared)} prepared"
+            )
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record_prepared(self, key, doc):
+        doc = {**doc, "_id": str(doc["_id"])}
+        self._file.write(json.dumps({"key": key, "doc": doc}) + "\n")
+        self._file.flush()
+
+    def record_embedded(self, key, vector):
+        self._file.write(json.dumps({"key": key, "vector": vector}) + "\n")
+        self._file.flush()
+
+    def record_inserted(self, keys):
+        for key in keys:
+            self._file.write(json.dumps({"key": key, "inserted": True}) + "\n")
+            self.inserted.add(key)
+            self.prepared.pop(key, None)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def enrich_record(key, doc):
+    """Enrich a doc and publish its reference page; False if that failed."""
+    try:
+        api.enrich_doc(doc)
+        api.publish_reference(doc)
+        return True
+    except Exception as e:
+        # One bad record must not stop the import; the next run retries it
+        logger.error(f"Skipping {key}, enrichment failed: {e}")
+        return False
+
+
+def prepare_batch(batch, checkpoint, executor, embed_batch_size):
+    """Enrich and embed a batch of (key, record), reusing checkpointed docs.
+
+    Records that fail to enrich are left out. Enriched docs are checkpointed
+    before they are embedded, so a resume after a failed embedding only
+    embeds them again.
+    """
+    docs = {}
+    to_enrich = {}
+    for key, record in batch:
+        if key in checkpoint.prepared:
+            doc = dict(checkpoint.prepared[key])
+            doc["_id"] = uuid.UUID(doc["_id"])
+            docs[key] = doc
+        else:
+            to_enrich[key] = api.new_doc(
+                message_id=record["object_id"],
+                raw_content=record["message"],
+                _id=uuid.uuid5(BACKFILL_NAMESPACE, key),
+                update_ts=record["timestamp"],
+            )
+
+    enriched = executor.map(enrich_record, to_enrich.keys(), to_enrich.values())
+    for (key, doc), ok in zip(to_enrich.items(), list(enriched)):
+        if ok:
+            checkpoint.record_prepared(key, doc)
+            docs[key] = doc
+
+    to_embed = {key: doc for key, doc in docs.items() if doc.get("$vector") is None}
+    vectors = llm_helper.vectorize_texts(
+        [doc["cleaned_concat"] for doc in to_embed.values()],
+        llm_helper.initialize_embeddings(),
+        batch_size=embed_batch_size,
+    )
+    for (key, doc), vector in zip(to_embed.items(), vectors):
+        doc["$vector"] = vector
+        if vector is not None:
+            checkpoint.record_embedded(key, vector)
+    return docs
+
+
+def insert_chunk(collection, docs):
+    try:
+        with tracing.span("astra.insert"):
+            collection.insert_many(list(docs.values()), ordered=False)
+    except InsertManyException as e:
+        # Docs left over from a run that crashed after inserting are fine
+        errors = [
+            err
+            for err in e.error_descriptors
+            if err.error_code != "DOCUMENT_ALREADY_EXISTS"
+        ]
+        if errors:
+            raise
+
+
+def backfill(path, collection, checkpoint_path, batch_size, workers, embed_batch_size):
+    checkpoint = Checkpoint(checkpoint_path)
+    start = time.perf_counter()
+    n_done = 0
+    n_skipped = 0
+    batch = []
+
+    def flush(batch):
+        nonlocal n_skipped
+        docs = prepare_batch(batch, checkpoint, executor, embed_batch_size)
+        docs = {key: doc for key, doc in docs.items() if doc["$vector"] is not None}
+        n_skipped += len(batch) - len(docs)
+        insert_chunk(collection, docs)
+        checkpoint.record_inserted(docs.keys())
+        return len(docs)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, record in dedupe_records(read_records(path)):
+            if key in checkpoint.inserted:
+                continue
+            batch.append((key, record))
+            if len(batch) >= batch_size:
+                n_done += flush(batch)
+                batch = []
+                elapsed = time.perf_counter() - start
+                lg(f"{n_done} docs inserted, {n_done / elapsed:.2f} docs/sec")
+        if batch:
+            n_done += flush(batch)
+
+    checkpoint.close()
+    elapsed = time.perf_counter() - start
+    rate = n_done / elapsed if elapsed else 0.0
+    print(f"Imported {n_done} docs in {elapsed:.1f}s ({rate:.2f} docs/sec)")
+    if n_skipped:
+        print(f"Skipped {n_skipped} records that failed; run again to retry them")
+    return n_done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="Telegram result.json, JSON list or JSONL file")
+    parser.add_argument("--checkpoint", help="defaults to <path>.checkpoint.jsonl")
+    parser.add_argument("--collection", default="core_messages")
+    parser.add_argument(
+        "--batch-size", type=int, default=32, help="docs per insert_many"
+    )
+    parser.add_argument("--workers", type=int, default=8, help="concurrent enrichments")
+    parser.add_argument("--embed-batch-size", type=int, default=100)
+    args = parser.parse_args()
+    # Like its worker threads, which start in the default lane, the backfill
+    # only gets the OpenAI capacity that asks and saves leave
+    rate_limiter.set_lane("background")
+
+    database = api.connect(
+        endpoint=os.environ["ASTRA_API_ENDPOINT"],
+        token=os.environ["ASTRA_API_TOKEN"],
+        keyspace="telegram_rag",
+    )
+    backfill(
+        path=args.path,
+        collection=database.get_collection(args.collection),
+        checkpoint_path=args.checkpoint or f"{args.path}.checkpoint.jsonl",
+        batch_size=args.batch_size,
+        workers=args.workers,
+        embed_batch_size=args.embed_batch_size,
+    )
@@ -0,0 +1,94 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from loguru import logger
+
+lg = logger.info
+
+
+class MicroBatcher:
+    """Coalesce items submitted from many threads into batched handler calls.
+
+    submit() returns a Future right away. A collector thread waits for the
+    first item, then keeps collecting until max_items are queued or max_wait
+    seconds have passed, and hands the batch to handler(items) on one of
+    max_batches worker threads. The handler returns one result per item, in
+    order; an Exception in place of a result fails only that item's Future.
+    While every worker is busy the collector holds off, so items arriving
+    during a slow batch are grouped into the next one.
+    """
+
+    def __init__(
+        self, handler, max_items=8, max_wait=0.05, max_batches=2, name="batch"
+    ):
+        self.handler = handler
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_batches)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_batches, thread_name_prefix=name
+        )
+        self._lock = threading.Lock()
+        self._counters = {"batches": 0, "items": 0, "failed_items": 0, "max_batch": 0}
+        thread = threading.Thread(target=self._collect, name=f"{name}-collector")
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def stats(self):
+        with self._lock:
+            batches = self._counters["batches"]
+            return {
+                **self._counters,
+                "pending": self._queue.qsize(),
+                "mean_batch": round(self._counters["items"] / batches, 2)
+                if batches
+                else 0.0,
+            }
+
+    def _collect(self):
+        while True:
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            items = [item for item, _ in batch]
+            try:
+                results = self.handler(items)
+            except Exception as e:
+                logger.warning(f"Batch of {len(items)} failed: {e}")
+                results = [e] * len(items)
+            failed = 0
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                    failed += 1
+                else:
+                    future.set_result(result)
+            with self._lock:
+                self._counters["batches"] += 1
+                self._counters["items"] += len(batch)
+                self._counters["failed_items"] += failed
+                self._counters["max_batch"] = max(
+                    self._counters["max_batch"], len(batch)
+                )
+        finally:
+            self._slots.release()
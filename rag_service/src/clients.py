@@ -0,0 +1,194 @@
+import itertools
+import os
+import threading
+
+import httpx
+from loguru import logger
+
+# Shared, process-wide clients. All OpenAI traffic (chat and embeddings) goes
+# through one keep-alive httpx pool so TLS connections are reused across
+# Flask threads instead of being set up on every call. The SDKs' own retries
+# are off: resilience.py retries within the caller's deadline instead.
+#
+# openai, langchain_openai and boto3 take over a second to import, so they are
+# imported when their client is first created (see service.warm_up) rather
+# than when the server starts.
+
+OPENAI_POOL_SIZE = int(os.environ.get("OPENAI_POOL_SIZE", 20))
+# httpcore's async pool rescans all of its connections whenever a request
+# starts or ends, which costs more CPU than the requests themselves once a
+# few dozen are in flight. The async server's OPENAI_POOL_SIZE connections
+# are therefore split over OPENAI_ASYNC_POOL_SHARDS clients, used in turn.
+OPENAI_ASYNC_POOL_SHARDS = int(os.environ.get("OPENAI_ASYNC_POOL_SHARDS", 8))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 60))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 5))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 120))
+S3_POOL_SIZE = int(os.environ.get("S3_POOL_SIZE", 10))
+# langchain tokenizes every text locally (downloading tiktoken files on first
+# use) to enforce the context length; vectorize_text already caps text length
+EMBEDDING_CHECK_CTX_LENGTH = os.environ.get(
+    "EMBEDDING_CHECK_CTX_LENGTH", "true"
+).lower() in ("1", "true")
+
+_lock = threading.RLock()
+_clients = {}
+_connection_counters = {"requests": 0, "new_connections": 0}
+
+
+def _trace(event_name, info):
+    # httpcore emits this once per newly opened TCP connection
+    if event_name == "connection.connect_tcp.complete":
+        with _lock:
+            _connection_counters["new_connections"] += 1
+
+
+def _on_request(request):
+    with _lock:
+        _connection_counters["requests"] += 1
+    request.extensions["trace"] = _trace
+
+
+async def _atrace(event_name, info):
+    _trace(event_name, info)
+
+
+async def _aon_request(request):
+    with _lock:
+        _connection_counters["requests"] += 1
+    request.extensions["trace"] = _atrace
+
+
+def _limits(size):
+    return httpx.Limits(
+        max_connections=size,
+        max_keepalive_connections=size,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    )
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+                logger.info(f"Created shared client: {name}")
+    return client
+
+
+def set_client(name, client):
+    """Replace a shared client, e.g. with a local stand-in for benchmarks."""
+    with _lock:
+        _clients[name] = client
+
+
+def get_http_client():
+    return _get_or_create(
+        "http",
+        lambda: httpx.Client(
+            limits=_limits(OPENAI_POOL_SIZE),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            event_hooks={"request": [_on_request]},
+        ),
+    )
+
+
+def get_async_http_client(shard=0):
+    # Used by the async server; one per shard and process, bound to its loop
+    size = -(-OPENAI_POOL_SIZE // OPENAI_ASYNC_POOL_SHARDS)
+    return _get_or_create(
+        f"async_http:{shard}",
+        lambda: httpx.AsyncClient(
+            limits=_limits(size),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            event_hooks={"request": [_aon_request]},
+        ),
+    )
+
+
+def _create_openai_client():
+    from openai import OpenAI
+
+    return OpenAI(http_client=get_http_client(), max_retries=0)
+
+
+def _create_async_openai_client(shard):
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(http_client=get_async_http_client(shard), max_retries=0)
+
+
+def get_openai_client():
+    return _get_or_create("openai", _create_openai_client)
+
+
+_next_shard = itertools.count()
+
+
+def get_async_openai_client():
+    """The async OpenAI client of the next pool shard."""
+    shard = next(_next_shard) % OPENAI_ASYNC_POOL_SHARDS
+    return _get_or_create(
+        f"async_openai:{shard}", lambda: _create_async_openai_client(shard)
+    )
+
+
+def get_async_openai_clients():
+    """One async OpenAI client per pool shard, e.g. to create them up front."""
+    return [get_async_openai_client() for _ in range(OPENAI_ASYNC_POOL_SHARDS)]
+
+
+def _create_embedder(model):
+    from langchain_openai import OpenAIEmbeddings
+
+    # aembed_query/aembed_documents go through the async pool
+    return OpenAIEmbeddings(
+        model=model,
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client(),
+        check_embedding_ctx_length=EMBEDDING_CHECK_CTX_LENGTH,
+        max_retries=0,
+    )
+
+
+def get_embedder(model="text-embedding-3-small"):
+    return _get_or_create(f"embedder:{model}", lambda: _create_embedder(model))
+
+
+def _create_s3_client():
+    import boto3
+    from botocore.config import Config
+
+    # S3_ENDPOINT_URL points uploads at a local S3 stand-in (moto, minio)
+    endpoint_url = os.environ.get("S3_ENDPOINT_URL")
+    if os.environ["RUN_ENV"] == "LOCAL" and not endpoint_url:
+        aws_profile = "developer_crc_PermissionSet"
+        session = boto3.Session(profile_name=aws_profile)
+    else:
+        session = boto3.Session()
+    return session.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        config=Config(
+            max_pool_connections=S3_POOL_SIZE, retries={"total_max_attempts": 1}
+        ),
+    )
+
+
+def get_s3_client():
+    return _get_or_create("s3", _create_s3_client)
+
+
+def connection_stats():
+    with _lock:
+        requests = _connection_counters["requests"]
+        new_connections = _connection_counters["new_connections"]
+    reused = max(requests - new_connections, 0)
+    return {
+        "requests": requests,
+        "new_connections": new_connections,
+        "reused_connections": reused,
+        "reuse_ratio": round(reused / requests, 4) if requests else 0.0,
+    }
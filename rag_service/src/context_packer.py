@@ -0,0 +1,211 @@
+import functools
+import re
+
+import lexical_index
+from loguru import logger
+
+lg = logger.info
+
+# Fallback when the tokenizer files can't be loaded (tiktoken downloads them
+# on first use): roughly four characters per token for English text
+CHARS_PER_TOKEN = 4
+
+_paragraph_re = re.compile(r"\n\s*\n")
+_sentence_re = re.compile(r"(?<=[.!?])\s+")
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"No tokenizer for {model}, estimating tokens from length: {e}")
+        return None
+
+
+def load_tokenizer(model):
+    """Load the model's tokenizer now instead of on the first request.
+
+    The first load downloads the tokenizer files; on the async server that
+    would block the event loop. Returns False if it falls back to estimates.
+    """
+    return _encoding(model) is not None
+
+
+def count_tokens(text, model):
+    encoding = _encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens, model):
+    """Cut text to at most max_tokens tokens, on a word boundary if possible."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _encoding(model)
+    if encoding is None:
+        cut = text[: max_tokens * CHARS_PER_TOKEN]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoding.decode(tokens[:max_tokens])
+    if len(cut) >= len(text):
+        return text
+    head = cut.rsplit(" ", 1)[0]
+    return (head if len(head) > len(cut) // 2 else cut) + " ..."
+
+
+def split_passages(text, max_tokens, model):
+    """Split content into paragraphs, breaking long ones up by sentence."""
+    passages = []
+    for paragraph in _paragraph_re.split(text or ""):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph, model) <= max_tokens:
+            passages.append(paragraph)
+            continue
+        current = ""
+        for sentence in _sentence_re.split(paragraph):
+            candidate = f"{current} {sentence}".strip()
+            if current and count_tokens(candidate, model) > max_tokens:
+                passages.append(current)
+                current = sentence
+            else:
+                current = candidate
+        if current:
+            passages.append(current)
+    return passages
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class ContextPacker:
+    """Pack retrieved docs into a CONTEXT block that fits a token budget.
+
+    DocRecords are taken in retrieval order (most relevant first), hydrated.
+    Each doc's content is split into passages, which are ranked by how many of
+    the question's terms they contain. Every doc first gets its header and its
+    best passage, then the remaining passages are added by doc rank and
+    passage score until the budget runs out; the passage that crosses it is
+    truncated. Passages whose words overlap an already packed passage by
+    dedupe_threshold (Jaccard) or more are skipped.
+    """
+
+    def __init__(
+        self,
+        max_tokens=2000,
+        passage_tokens=200,
+        dedupe_threshold=0.8,
+        model="gpt-4o-mini",
+        sep="---",
+    ):
+        self.max_tokens = max_tokens
+        self.passage_tokens = passage_tokens
+        self.dedupe_threshold = dedupe_threshold
+        self.model = model
+        self.sep = sep
+
+    def header(self, doc):
+        return (
+            f"*UPDATE_TS* : {doc.update_ts}\n"
+            f"*MESSAGE_ID* : {doc.message_id}\n"
+            f"*CLEANED_TITLE* :\n{doc.title}\n"
+            f"*CLEANED_CONTENT* :\n"
+        )
+
+    def _ranked_passages(self, doc, terms):
+        passages = split_passages(
+            doc.content or doc.raw_content,
+            self.passage_tokens,
+            self.model,
+        )
+        scored = []
+        for position, passage in enumerate(passages):
+            words = set(lexical_index.tokenize(passage))
+            score = sum(1 for term in terms if term in words)
+            scored.append((score, position, passage, words))
+        # Best match first, original order between equals
+        return sorted(scored, key=lambda item: (-item[0], item[1]))
+
+    def pack(self, question, docs):
+        """Return the packed context string and what went into it.
+
+        Returns:
+            tuple: (context str, stats dict with tokens, docs, passages,
+                duplicates and truncated counts)
+        """
+        terms = set(lexical_index.query_terms(question))
+        sep_tokens = count_tokens(f"\n{self.sep}\n", self.model)
+        budget = self.max_tokens
+        stats = {"docs": 0, "passages": 0, "duplicates": 0, "truncated": 0}
+
+        blocks = []
+        for doc in docs:
+            header = self.header(doc)
+            cost = count_tokens(header, self.model) + (sep_tokens if blocks else 0)
+            if cost > budget:
+                break
+            budget -= cost
+            blocks.append(
+                {
+                    "header": header,
+                    "chosen": {},
+                    "queue": self._ranked_passages(doc, terms),
+                }
+            )
+        stats["docs"] = len(blocks)
+
+        packed_words = []
+
+        def take(block, item):
+            # Returns False for a near-duplicate, which doesn't use up the budget
+            nonlocal budget
+            _, position, passage, words = item
+            if any(
+                _jaccard(words, seen) >= self.dedupe_threshold for seen in packed_words
+            ):
+                stats["duplicates"] += 1
+                return False
+            cost = count_tokens(passage + "\n", self.model)
+            if cost > budget:
+                passage = truncate_tokens(passage, budget - 1, self.model)
+                stats["truncated"] += 1
+                cost = budget
+            if passage:
+                block["chosen"][position] = passage
+                packed_words.append(words)
+                stats["passages"] += 1
+            budget -= cost
+            return True
+
+        # Best passage of every doc first, then fill by doc rank
+        for block in blocks:
+            while budget > 0 and block["queue"]:
+                if take(block, block["queue"].pop(0)):
+                    break
+        for block in blocks:
+            while budget > 0 and block["queue"]:
+                take(block, block["queue"].pop(0))
+
+        rendered = [
+            block["header"]
+            + "\n".join(
+                block["chosen"][position] for position in sorted(block["chosen"])
+            )
+            for block in blocks
+        ]
+        context = f"\n{self.sep}\n".join(rendered)
+        stats["tokens"] = self.max_tokens - budget
+        return context, stats
@@ -0,0 +1,155 @@
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+
+lg = logger.info
+
+
+class DomainRouter:
+    """Classify embeddings into domains by their nearest domain centroid.
+
+    A running sum of the stored $vectors is kept per domain, so add(docs) on
+    insert keeps centroids current without a rescan. Each doc's contribution
+    is remembered by _id, so adding an edited doc moves it rather than
+    counting it twice. classify() returns None
+    when it is not confident: the best centroid scores below min_score, beats
+    the runner-up by less than min_margin, or has fewer than min_docs behind
+    it. The caller then escalates to the LLM.
+    """
+
+    def __init__(
+        self, dim=1536, min_score=0.3, min_margin=0.02, min_docs=3, max_age=3600
+    ):
+        self.dim = dim
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.min_docs = min_docs
+        self.max_age = max_age
+        self.synced_at = None
+        self._lock = threading.Lock()
+        self._sums = {}
+        self._counts = {}
+        self._members = {}
+        self._labels = []
+        self._centroids = None
+        self._added = None
+        self._counters = {"routed": 0, "escalated": 0}
+
+    def is_fresh(self):
+        if self.synced_at is None:
+            return False
+        return self.max_age is None or time.time() - self.synced_at < self.max_age
+
+    def begin_build(self):
+        """Remember the docs add()ed from now on, to re-add them after build().
+
+        Call it before scanning the collection for build(): the scan may not
+        see docs inserted while it runs, and build() would drop them.
+        """
+        with self._lock:
+            self._added = []
+
+    def build(self, docs):
+        fresh = DomainRouter(
+            self.dim, self.min_score, self.min_margin, self.min_docs, self.max_age
+        )
+        fresh.add(docs)
+        with self._lock:
+            self._sums = fresh._sums
+            self._counts = fresh._counts
+            self._members = fresh._members
+            self._centroids = None
+            added, self._added = self._added, None
+            if added:
+                self._add(added)
+            self.synced_at = time.time()
+        lg(f"Domain router built: {self._counts}")
+
+    def add(self, docs):
+        docs = list(docs)
+        with self._lock:
+            if self._added is not None:
+                self._added.extend(docs)
+            self._add(docs)
+
+    def _add(self, docs):
+        for doc in docs:
+            vector = doc.get("$vector")
+            domain = doc.get("domain")
+            if vector is None or not domain:
+                continue
+            previous = self._members.pop(doc["_id"], None)
+            if previous is not None:
+                old_domain, old_vector = previous
+                self._sums[old_domain] -= old_vector
+                self._counts[old_domain] -= 1
+                if not self._counts[old_domain]:
+                    del self._sums[old_domain], self._counts[old_domain]
+            vector = np.asarray(vector, dtype=np.float32)
+            if domain not in self._sums:
+                self._sums[domain] = np.zeros(self.dim, dtype=np.float64)
+                self._counts[domain] = 0
+            self._sums[domain] += vector
+            self._counts[domain] += 1
+            self._members[doc["_id"]] = (domain, vector)
+        self._centroids = None
+
+    def set_reference_urls(self, urls):
+        """Nothing to do: the router keeps no records."""
+
+    def classify(self, vector):
+        """Return the domain for an embedding, or None if not confident."""
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        with self._lock:
+            if self._centroids is None:
+                self._refresh_centroids()
+            if not self._labels:
+                return None
+            scores = self._centroids @ query
+            order = np.argsort(-scores)
+            best = scores[order[0]]
+            runner_up = scores[order[1]] if len(order) > 1 else -1.0
+            label = self._labels[order[0]]
+            if (
+                best < self.min_score
+                or best - runner_up < self.min_margin
+                or self._counts[label] < self.min_docs
+            ):
+                return None
+            return label
+
+    def route(self, vector, fallback):
+        """classify(), escalating to fallback() when not confident."""
+        domain = self.classify(vector)
+        with self._lock:
+            self._counters["routed" if domain is not None else "escalated"] += 1
+        if domain is None:
+            domain = fallback()
+        return domain
+
+    async def aroute(self, vector, fallback):
+        """route() for the async server, where fallback() is a coroutine function."""
+        domain = self.classify(vector)
+        with self._lock:
+            self._counters["routed" if domain is not None else "escalated"] += 1
+        if domain is None:
+            domain = await fallback()
+        return domain
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "domains": dict(self._counts)}
+
+    def _refresh_centroids(self):
+        self._labels = list(self._sums)
+        if not self._labels:
+            self._centroids = np.zeros((0, self.dim), dtype=np.float32)
+            return
+        centroids = np.stack([self._sums[label] for label in self._labels])
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        self._centroids = (centroids / np.where(norms == 0, 1, norms)).astype(
+            np.float32
+        )
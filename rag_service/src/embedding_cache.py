@@ -0,0 +1,103 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from loguru import logger
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(model, text):
+    return hashlib.sha256(
+        f"{model}\0{normalize_text(text)}".encode("utf-8")
+    ).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache keyed on (model, normalized text hash).
+
+    Vectors are kept as float32 arrays in a size-bounded in-memory LRU. If
+    db_path is set, they are also written to a SQLite table as raw float32
+    bytes, so the cache survives restarts. The table has its own lock, so
+    memory hits never wait on a disk read or commit.
+    """
+
+    def __init__(self, max_entries=10_000, db_path=None):
+        self.max_entries = max_entries
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, model TEXT, dim INTEGER, vector BLOB)"
+            )
+            self._db.commit()
+            logger.info(f"Embedding cache persisted to {db_path}")
+
+    def get(self, model, text):
+        key = cache_key(model, text)
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return vector
+        row = None
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+        with self._lock:
+            if row is None:
+                self._counters["misses"] += 1
+                return None
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            self._counters["disk_hits"] += 1
+            return vector
+
+    def put(self, model, text, vector):
+        key = cache_key(model, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                    (key, model, vector.shape[0], vector.tobytes()),
+                )
+                self._db.commit()
+        return vector
+
+    def stats(self):
+        with self._lock:
+            lookups = sum(
+                self._counters[k] for k in ("memory_hits", "disk_hits", "misses")
+            )
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+            return {
+                **self._counters,
+                "entries": len(self._lru),
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _remember(self, key, vector):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+            self._counters["evictions"] += 1
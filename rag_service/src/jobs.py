@@ -0,0 +1,117 @@
+import contextvars
+import datetime
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+lg = logger.info
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class JobQueue:
+    """Bounded background worker pool that tracks the status of each job.
+
+    A job function is called as func(payload, progress) where progress(stage)
+    records which stage the job is in. Finished jobs are kept around (up to
+    `retention`) so that their status can still be queried.
+    """
+
+    def __init__(self, workers=4, max_pending=100, retention=1000):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="ingest"
+        )
+        self._max_pending = max_pending
+        self._retention = retention
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._cond = threading.Condition()
+
+    def submit(self, func, payload):
+        with self._cond:
+            if self._pending >= self._max_pending:
+                raise QueueFullError(f"{self._pending} jobs already pending")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "status": "queued",
+                "stage": "queued",
+                "created_ts": _now(),
+                "updated_ts": _now(),
+                "result": None,
+                "error": None,
+            }
+            self._pending += 1
+            self._prune()
+        # Run in a copy of the caller's context so the request id follows the job
+        context = contextvars.copy_context()
+        self._executor.submit(context.run, self._run, job_id, func, payload)
+        return job_id
+
+    def get(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id, timeout):
+        """Block until the job is done/failed or the timeout passes."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._jobs.get(job_id, {}).get("status")
+                in (None, "done", "failed"),
+                timeout=timeout,
+            )
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def capacity(self):
+        """How many more jobs can be submitted before QueueFullError."""
+        with self._cond:
+            return self._max_pending - self._pending
+
+    def stats(self):
+        with self._cond:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {"pending": self._pending, "jobs": counts}
+
+    def _update(self, job_id, **fields):
+        with self._cond:
+            self._jobs[job_id].update(fields, updated_ts=_now())
+            self._cond.notify_all()
+
+    def _prune(self):
+        # Drop the oldest finished jobs once we are above retention
+        excess = len(self._jobs) - self._retention
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id]["status"] in ("done", "failed"):
+                del self._jobs[job_id]
+                excess -= 1
+
+    def _run(self, job_id, func, payload):
+        self._update(job_id, status="running")
+
+        def progress(stage):
+            self._update(job_id, stage=stage)
+
+        try:
+            result = func(payload, progress)
+            self._update(job_id, status="done", stage="done", result=result)
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed: {e}")
+            self._update(job_id, status="failed", error=str(e))
+        finally:
+            with self._cond:
+                self._pending -= 1
@@ -0,0 +1,272 @@
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from loguru import logger
+from records import DocRecord
+
+lg = logger.info
+
+FIELDS = ("raw_content", "cleaned_content")
+
+# Question filler that should not count as a search term
+STOPWORDS = set(
+    """
+    a about all am an and any are as at be been but by can did do does for from
+    had has have how i in is it its me my note noted notes of on or said saved
+    say so that the there this to was were what when where which who whom why
+    wrote with you
+    """.split()
+)
+
+_token_re = re.compile(r"\w+")
+_phrase_re = re.compile(r'"([^"]+)"')
+_sentence_start_re = re.compile(r"(^|[.!?]\s+)$")
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+def tokenize(text):
+    return _token_re.findall(normalize(text))
+
+
+def query_terms(text):
+    return [t for t in tokenize(text) if t not in STOPWORDS]
+
+
+def lookup_terms(text):
+    """The terms of a question that only names things, else [].
+
+    Every term has to be written as a name or identifier: capitalized
+    (Priya), all caps (INV), with a digit (2041) or after @ or #. A
+    capitalized first word of a sentence proves nothing either way, so it
+    is let through as long as another term is a name.
+    """
+    terms = []
+    named = False
+    for match in _token_re.finditer(text):
+        word = match.group()
+        term = normalize(word)
+        if term in STOPWORDS:
+            continue
+        before = text[: match.start()]
+        initial = word[0].isupper() and _sentence_start_re.search(before)
+        if (
+            before[-1:] in ("@", "#")
+            or any(c.isdigit() for c in word)
+            or word.isupper()
+            or (word[0].isupper() and not initial)
+        ):
+            named = True
+        elif not initial:
+            return []
+        terms.append(term)
+    return terms if named else []
+
+
+class LexicalIndex:
+    """In-process BM25 inverted index over the raw and cleaned note text.
+
+    Postings map each term to {doc slot: term frequency}. Documents are kept
+    as hydrated DocRecords so lexical hits can be served without Astra.
+    Like LocalVectorIndex it is built from a full scan, kept in sync by add()
+    after every insert (an existing _id is re-indexed in place) and reports
+    itself stale once max_age seconds have passed since the last build.
+
+    exact_match() is the fast path for name and identifier lookups: it only
+    answers when the question boils down to a quoted phrase, or to at most
+    max_terms names (see lookup_terms) that occur together in at most
+    max_hits notes. Any other question needs the semantic search.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, max_terms=3, max_hits=5, max_age=3600):
+        self.k1 = k1
+        self.b = b
+        self.max_terms = max_terms
+        self.max_hits = max_hits
+        self.max_age = max_age
+        self.synced_at = None
+        self._lock = threading.RLock()
+        self._counters = {"fast_path_hits": 0, "fast_path_misses": 0, "searches": 0}
+        self._added = None
+        self._reset()
+
+    def _reset(self):
+        self._postings = {}
+        self._docs = []
+        self._texts = []
+        self._lengths = []
+        self._terms = []
+        self._slots = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def is_fresh(self):
+        if self.synced_at is None:
+            return False
+        return self.max_age is None or time.time() - self.synced_at < self.max_age
+
+    def begin_build(self):
+        """Remember the docs add()ed from now on, to re-add them after build().
+
+        Call it before scanning the collection for build(): the scan may not
+        see docs inserted while it runs, and build() would drop them.
+        """
+        with self._lock:
+            self._added = []
+
+    def build(self, docs):
+        start = time.perf_counter()
+        fresh = LexicalIndex(
+            self.k1, self.b, self.max_terms, self.max_hits, self.max_age
+        )
+        fresh.add(docs)
+        with self._lock:
+            self._postings = fresh._postings
+            self._docs = fresh._docs
+            self._texts = fresh._texts
+            self._lengths = fresh._lengths
+            self._terms = fresh._terms
+            self._slots = fresh._slots
+            self._total_length = fresh._total_length
+            added, self._added = self._added, None
+            if added:
+                self.add(added)
+            self.synced_at = time.time()
+        lg(
+            f"Lexical index built: {len(self._slots)} docs, "
+            f"{len(self._postings)} terms in "
+            f"{(time.perf_counter() - start) * 1000:.0f} ms"
+        )
+
+    def add(self, docs):
+        docs = list(docs)
+        with self._lock:
+            if self._added is not None:
+                self._added.extend(docs)
+            for doc in docs:
+                text = " ".join(doc.get(field) or "" for field in FIELDS)
+                terms = Counter(tokenize(text))
+                slot = self._slots.get(doc["_id"])
+                if slot is None:
+                    slot = len(self._docs)
+                    self._slots[doc["_id"]] = slot
+                    self._docs.append(None)
+                    self._texts.append(None)
+                    self._lengths.append(0)
+                    self._terms.append(Counter())
+                else:
+                    self._unindex(slot)
+                for term, tf in terms.items():
+                    self._postings.setdefault(term, {})[slot] = tf
+                self._docs[slot] = DocRecord.from_doc(doc)
+                self._texts[slot] = normalize(text)
+                self._lengths[slot] = sum(terms.values())
+                self._terms[slot] = terms
+                self._total_length += self._lengths[slot]
+
+    def set_reference_urls(self, urls):
+        """Store the reference_url written back for docs, from {_id: url}."""
+        with self._lock:
+            for doc_id, url in urls.items():
+                slot = self._slots.get(doc_id)
+                if slot is not None:
+                    self._docs[slot] = self._docs[slot].replace(reference_url=url)
+
+    def _unindex(self, slot):
+        for term in self._terms[slot]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(slot, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._lengths[slot]
+
+    def search(self, text, top_n, domain=None):
+        """Return up to top_n DocRecords ranked by BM25 score."""
+        terms = query_terms(text)
+        with self._lock:
+            self._counters["searches"] += 1
+            scores = self._score(terms)
+            return self._ranked(scores, top_n, domain)
+
+    def exact_match(self, text, top_n):
+        """Documents for a phrase or name lookup, or [] to fall back to search."""
+        phrases = [normalize(p).strip() for p in _phrase_re.findall(text)]
+        names = [] if phrases else lookup_terms(text)
+        terms = query_terms(text)
+        with self._lock:
+            if phrases:
+                slots = {
+                    slot
+                    for slot, body in enumerate(self._texts)
+                    if body is not None and all(p in body for p in phrases)
+                }
+            elif 0 < len(names) <= self.max_terms:
+                postings = [self._postings.get(term, {}) for term in names]
+                slots = set(postings[0]).intersection(*postings[1:])
+                if len(slots) > self.max_hits:
+                    slots = set()
+            else:
+                slots = set()
+
+            if not slots:
+                self._counters["fast_path_misses"] += 1
+                return []
+            self._counters["fast_path_hits"] += 1
+            scores = self._score(terms)
+            return self._ranked({slot: scores.get(slot, 0.0) for slot in slots}, top_n)
+
+    def records(self, ids):
+        """The indexed DocRecords among ids, by _id."""
+        with self._lock:
+            return {
+                _id: self._docs[self._slots[_id]] for _id in ids if _id in self._slots
+            }
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "docs": len(self._slots),
+                "terms": len(self._postings),
+            }
+
+    def _score(self, terms):
+        n_docs = len(self._slots)
+        if not n_docs:
+            return {}
+        avg_length = self._total_length / n_docs or 1.0
+        scores = {}
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for slot, tf in postings.items():
+                norm = self.k1 * (
+                    1 - self.b + self.b * self._lengths[slot] / avg_length
+                )
+                scores[slot] = scores.get(slot, 0.0) + idf * tf * (self.k1 + 1) / (
+                    tf + norm
+                )
+        return scores
+
+    def _ranked(self, scores, top_n, domain=None):
+        ranked = sorted(scores.items(), key=lambda item: -item[1])
+        results = []
+        for slot, score in ranked:
+            doc = self._docs[slot]
+            if domain and doc.domain != domain:
+                continue
+            results.append(doc.replace(score=score))
+            if len(results) >= top_n:
+                break
+        return results
@@ -1,37 +1,92 @@
-import ast
-import json
+import asyncio
+import math
 import os
-import random
-import time
-from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
-import loguru
-import pandas as pd
-from langchain_openai import OpenAIEmbeddings
-from openai import OpenAI
+import clients
+import context_packer
+import rate_limiter
+import resilience
+import tracing
+from embedding_cache import EmbeddingCache
+from loguru import logger
 
 ### VECTORIZATIONS ###
 
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10_000)),
+    db_path=os.environ.get("EMBEDDING_CACHE_PATH"),
+)
 
-# Initialize OpenAI and LangChain embeddings
+
+# Shared OpenAI and LangChain embeddings, see clients.py
 def initialize_embeddings() -> Any:
-    embedder = OpenAIEmbeddings(model="text-embedding-3-small")
+    embedder = clients.get_embedder(model="text-embedding-3-small")
     return embedder
 
 
-def exponential_backoff(
-    attempt: int,
-    max_attempts: int = 5,
-    base_delay: float = 1.0,
-    max_delay: float = 60.0,
-) -> Any:
-    if attempt < max_attempts:
-        # Calculate delay with exponential growth and add random jitter
-        delay = min(max_delay, base_delay * 2**attempt) + random.uniform(0, 1)
-        time.sleep(delay)
-        return True  # Indicate that we should retry
-    return False  # Max attempts reached, do not retry
+def _embeddable(text, max_characters):
+    # None, or NaN from a dataframe column
+    if text is None or (isinstance(text, float) and math.isnan(text)):
+        logger.debug("Text is None, , returning NULL embeddings")
+        return False
+    if len(text) > max_characters:
+        logger.warning(
+            f"Text of length {len(text)} chars is too long, will not attempt tokenization for: {text[0:50]}...{text[-50:]}"
+        )
+        return False
+    return True
+
+
+def _embed_tokens(texts):
+    # Estimated without a tokenizer; corrected from the response's usage
+    return sum(-(-len(text) // context_packer.CHARS_PER_TOKEN) for text in texts)
+
+
+def _embed_documents(embedder, texts):
+    # Every attempt waits for the shared rate limit, see rate_limiter.py
+    grant = rate_limiter.acquire("embed", _embed_tokens(texts))
+    # Without usage in the response the estimate stands
+    tokens = None
+    try:
+        timeout = resilience.attempt_timeout(clients.OPENAI_TIMEOUT)
+        if getattr(embedder, "check_embedding_ctx_length", True):
+            # LangChain reports no usage; its requests are bounded by the
+            # pooled client's OPENAI_TIMEOUT
+            return embedder.embed_documents(texts)
+        # Without the context length check langchain sends one request per text;
+        # the texts are already capped at max_characters, so send them as one
+        response = clients.get_openai_client().embeddings.create(
+            input=texts, model=embedder.model, timeout=timeout
+        )
+        usage = getattr(response, "usage", None)
+        tokens = usage.prompt_tokens if usage else None
+        return [item.embedding for item in response.data]
+    except Exception as e:
+        rate_limiter.rate_limited("embed", e)
+        raise
+    finally:
+        rate_limiter.settle(grant, tokens)
+
+
+async def _aembed_documents(embedder, texts):
+    grant = await rate_limiter.aacquire("embed", _embed_tokens(texts))
+    tokens = None
+    try:
+        timeout = resilience.attempt_timeout(clients.OPENAI_TIMEOUT)
+        if getattr(embedder, "check_embedding_ctx_length", True):
+            return await embedder.aembed_documents(texts)
+        response = await clients.get_async_openai_client().embeddings.create(
+            input=texts, model=embedder.model, timeout=timeout
+        )
+        usage = getattr(response, "usage", None)
+        tokens = usage.prompt_tokens if usage else None
+        return [item.embedding for item in response.data]
+    except Exception as e:
+        rate_limiter.rate_limited("embed", e)
+        raise
+    finally:
+        rate_limiter.settle(grant, tokens)
 
 
 # Function to vectorize text using OpenAIEmbeddings
@@ -41,66 +96,277 @@ def vectorize_text(
     max_characters=10_000,
 ) -> Any:
     # logger.debug(type(text))
-    if text is None or pd.Series([text]).isna().any():
-        logger.debug("Text is None, , returning NULL embeddings")
+    if not _embeddable(text, max_characters):
         return None
-    if len(text) > max_characters:
-        logger.warning(
-            f"Text of length {len(text)} chars is too long, will not attempt tokenization for: {text[0:50]}...{text[-50:]}"
-        )
+    model = getattr(embedder, "model", "unknown")
+    cached = embedding_cache.get(model, text)
+    if cached is not None:
+        return cached.tolist()
+    try:
+        with tracing.span("openai.embed"):
+            # Retries, deadline and hedging: see resilience.py
+            vector = resilience.call(
+                "openai.embed", _embed_documents, embedder, [text], idempotent=True
+            )[0]
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
         return None
-    max_attempts = 5
-    for attempt in range(max_attempts):
-        try:
-            vector = embedder.embed_query(text)
+    if vector:
+        embedding_cache.put(model, text, vector)
+        return vector
+    return None
 
-            if vector:
-                return vector
-            # Wait before retrying
-            if not exponential_backoff(attempt, max_attempts):
-                break  # Exceeded max attempts, give up
-        except Exception as e:
-            logger.error(f"An error occurred: {e}")
 
-            # Wait before retrying
-            if not exponential_backoff(attempt, max_attempts):
-                break  # Exceeded max attempts, give up
+# Async counterpart of vectorize_text, used by the async server
+async def avectorize_text(
+    text: Any,
+    embedder: Any,
+    max_characters=10_000,
+) -> Any:
+    if not _embeddable(text, max_characters):
+        return None
+    model = getattr(embedder, "model", "unknown")
+    # The cache may read or commit to its SQLite file
+    cached = await asyncio.to_thread(embedding_cache.get, model, text)
+    if cached is not None:
+        return cached.tolist()
+    try:
+        with tracing.span("openai.embed"):
+            vector = (
+                await resilience.acall(
+                    "openai.embed",
+                    lambda: _aembed_documents(embedder, [text]),
+                    idempotent=True,
+                )
+            )[0]
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        return None
+    if vector:
+        await asyncio.to_thread(embedding_cache.put, model, text, vector)
+        return vector
     return None
 
 
-def vectorize_wrapper(args: Any) -> Any:
-    return vectorize_text(*args)
+# Batched counterpart of vectorize_text, one embeddings request per batch
+def vectorize_texts(
+    texts: list,
+    embedder: Any,
+    batch_size: int = 100,
+    max_characters=10_000,
+) -> list:
+    model = getattr(embedder, "model", "unknown")
+    vectors = [None] * len(texts)
+    misses = []
+    for i, text in enumerate(texts):
+        if not _embeddable(text, max_characters):
+            logger.warning(f"Skipping embedding for text at position {i}")
+            continue
+        cached = embedding_cache.get(model, text)
+        if cached is not None:
+            vectors[i] = cached.tolist()
+        else:
+            misses.append(i)
+
+    for start in range(0, len(misses), batch_size):
+        batch = misses[start : start + batch_size]
+        try:
+            with tracing.span("openai.embed_batch"):
+                embedded = resilience.call(
+                    "openai.embed",
+                    _embed_documents,
+                    embedder,
+                    [texts[i] for i in batch],
+                    idempotent=True,
+                )
+        except Exception as e:
+            logger.error(f"An error occurred: {e}")
+            continue
+        for i, vector in zip(batch, embedded):
+            embedding_cache.put(model, texts[i], vector)
+            vectors[i] = vector
+    return vectors
 
 
-# Function to perform vectorization on the dataframe
+# Function to perform vectorization on the dataframe. Rows are embedded in
+# batches, whose requests wait for the shared rate limit in the caller's lane
 def perform_vectorization(df: Any, columns_to_vectorize: Optional[dict]) -> Any:
     if columns_to_vectorize:
         embedder = initialize_embeddings()
-        with ThreadPoolExecutor() as executor:
-            for column, vectorized_column in columns_to_vectorize.items():
-                df[vectorized_column] = list(
-                    executor.map(vectorize_wrapper, [(x, embedder) for x in df[column]])
-                )
-                # logger.debug(df[vectorized_column])
-                # logger.debug(column)
+        for column, vectorized_column in columns_to_vectorize.items():
+            df[vectorized_column] = vectorize_texts(list(df[column]), embedder)
     return df
 
 
 ### LLM CALL-RESPONSE ###
 
+CHAT_MODEL = "gpt-4o-mini"
+
+# Completion tokens counted against the rate limit until the response reports
+# the actual usage
+COMPLETION_TOKENS_ESTIMATE = int(
+    os.environ.get("OPENAI_COMPLETION_TOKENS_ESTIMATE", 400)
+)
+
+
+class LLMError(Exception):
+    """A chat completion call failed; callers decide whether to retry."""
+
+
+class EmbeddingError(Exception):
+    pass
+
+
+def _chat_kwargs(system_prompt, user_prompt, response_format=None):
+    kwargs = {
+        "model": CHAT_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+    }
+    if response_format is not None:
+        kwargs["response_format"] = response_format
+    return kwargs
+
 
-def call_openai_response(system_prompt, user_prompt):
+def _chat_tokens(kwargs):
+    # A few tokens of chat formatting per message on top of the content
+    prompt = sum(
+        context_packer.count_tokens(message["content"], kwargs["model"]) + 4
+        for message in kwargs["messages"]
+    )
+    return prompt + COMPLETION_TOKENS_ESTIMATE
+
+
+def _chat_create(client, kwargs):
+    """One chat completion attempt, once the rate limit lets it through.
+
+    Returns:
+        tuple: (response or stream, rate limiter grant to settle with usage)
+    """
+    grant = rate_limiter.acquire("chat", _chat_tokens(kwargs))
     try:
-        client = OpenAI()
         response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
+            **kwargs, timeout=resilience.attempt_timeout(clients.OPENAI_TIMEOUT)
         )
+    except BaseException as e:
+        rate_limiter.rate_limited("chat", e)
+        # Nothing was generated for this attempt
+        rate_limiter.settle(grant, 0)
+        raise
+    return response, grant
+
+
+async def _achat_create(client, kwargs):
+    grant = await rate_limiter.aacquire("chat", _chat_tokens(kwargs))
+    try:
+        response = await client.chat.completions.create(
+            **kwargs, timeout=resilience.attempt_timeout(clients.OPENAI_TIMEOUT)
+        )
+    except BaseException as e:
+        rate_limiter.rate_limited("chat", e)
+        rate_limiter.settle(grant, 0)
+        raise
+    return response, grant
+
+
+def call_openai_response(
+    system_prompt, user_prompt, response_format=None, prompt_name="chat"
+):
+    try:
+        client = clients.get_openai_client()
+        with tracing.span(f"llm.{prompt_name}"):
+            response, grant = resilience.call(
+                "openai.chat",
+                _chat_create,
+                client,
+                _chat_kwargs(system_prompt, user_prompt, response_format),
+            )
+        _record_usage(prompt_name, response.usage, grant)
         return response
 
     except Exception as e:
         logger.warning(f"An unexpected error occurred during API call: {e}")
-        return None
+        raise LLMError(f"{prompt_name} completion failed: {e}") from e
+
+
+async def acall_openai_response(
+    system_prompt, user_prompt, response_format=None, prompt_name="chat"
+):
+    try:
+        client = clients.get_async_openai_client()
+        with tracing.span(f"llm.{prompt_name}"):
+            kwargs = _chat_kwargs(system_prompt, user_prompt, response_format)
+            response, grant = await resilience.acall(
+                "openai.chat", lambda: _achat_create(client, kwargs)
+            )
+        _record_usage(prompt_name, response.usage, grant)
+        return response
+
+    except Exception as e:
+        logger.warning(f"An unexpected error occurred during API call: {e}")
+        raise LLMError(f"{prompt_name} completion failed: {e}") from e
+
+
+def stream_openai_response(system_prompt, user_prompt, prompt_name="chat"):
+    """Yield the completion's content deltas as they arrive."""
+    client = clients.get_openai_client()
+    with tracing.span(f"llm.{prompt_name}.stream"):
+        # Opening the stream is retried; nothing is once tokens were yielded
+        stream, grant = resilience.call(
+            "openai.chat",
+            _chat_create,
+            client,
+            _stream_kwargs(system_prompt, user_prompt),
+        )
+        usage = None
+        try:
+            for chunk in stream:
+                usage = chunk.usage or usage
+                delta = _stream_delta(chunk)
+                if delta:
+                    yield delta
+        finally:
+            # Also when the stream fails or the caller stops reading
+            _record_usage(prompt_name, usage, grant)
+
+
+async def astream_openai_response(system_prompt, user_prompt, prompt_name="chat"):
+    """Async counterpart of stream_openai_response."""
+    client = clients.get_async_openai_client()
+    with tracing.span(f"llm.{prompt_name}.stream"):
+        kwargs = _stream_kwargs(system_prompt, user_prompt)
+        stream, grant = await resilience.acall(
+            "openai.chat", lambda: _achat_create(client, kwargs)
+        )
+        usage = None
+        try:
+            async for chunk in stream:
+                usage = chunk.usage or usage
+                delta = _stream_delta(chunk)
+                if delta:
+                    yield delta
+        finally:
+            _record_usage(prompt_name, usage, grant)
+
+
+def _stream_kwargs(system_prompt, user_prompt):
+    return {
+        **_chat_kwargs(system_prompt, user_prompt),
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+
+
+def _record_usage(prompt_name, usage, grant):
+    # Settle every grant exactly once; without usage nothing is counted
+    tracing.record_usage(prompt_name, usage)
+    rate_limiter.settle(grant, usage.total_tokens if usage is not None else 0)
+
+
+def _stream_delta(chunk):
+    # The final chunk carries usage and no choices
+    if chunk.choices:
+        return chunk.choices[0].delta.content
+    return None
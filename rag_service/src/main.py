@@ -1,18 +1,58 @@
 import os
-import threading
 import time
 
 import api
-from flask import Flask, json, jsonify, render_template, request
+import jobs
+import rate_limiter
+import resilience
+import service
+import tenants
+import tracing
+from flask import (
+    Flask,
+    Response,
+    json,
+    jsonify,
+    g,
+    render_template,
+    request,
+    stream_with_context,
+)
 from loguru import logger
 
+# Flask app. Fine for local development; production runs server.py, which
+# serves the same endpoints asynchronously (see RAG_SERVER below).
+
 lg = logger.info
+conn_d = service.conn_d
+job_queue = service.job_queue
 
 app = Flask(__name__)
 
 
-def get_db_connection(endpoint, token, keyspace):
-    return api.connect(endpoint, token, keyspace)
+@app.before_request
+def start_request():
+    # tele_service passes X-Request-ID so one Telegram message can be followed
+    # end to end
+    g.request_id = tracing.set_request_id(request.headers.get("X-Request-ID"))
+    resilience.set_deadline(service.REQUEST_DEADLINE)
+    # Someone is waiting: OpenAI calls go ahead of saves and backfills
+    rate_limiter.set_lane("interactive")
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def finish_request(response):
+    response.headers["X-Request-ID"] = g.request_id
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    tracing.observe(
+        "rag_http_request_duration_seconds",
+        time.perf_counter() - g.start,
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+    )
+    return response
 
 
 @app.route("/")
@@ -22,13 +62,43 @@ def index():
 
 @app.route("/healthcheck")
 def healthcheck():
-    response = {"message": f"Server is connected to: {database}"}
+    response = {"message": service.healthcheck_message()}
     return response
 
 
-@app.route("/send_message", methods=["POST"])
-def send_message():
-    collection = conn_d.get("collection")
+@app.route("/ready")
+def ready():
+    # Readiness, unlike /healthcheck (liveness): 503 until Astra and the clients are up
+    report = service.readiness_report()
+    return jsonify(report), 200 if report["ready"] else 503
+
+
+def not_ready(e):
+    logger.warning(f"Rejecting request: {e}")
+    return jsonify({"message": "Server is starting, please retry"}), 503
+
+
+def unknown_tenant(e):
+    logger.warning(f"Rejecting request: {e}")
+    return jsonify({"message": "Unknown tenant"}), 403
+
+
+def get_tenant():
+    # tele_service sends the tenant of the chat; without one, the default tenant
+    return service.get_tenant(request.headers.get("X-Tenant-ID"))
+
+
+@app.route("/stats")
+def stats():
+    return jsonify(service.collect_stats())
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(service.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def accept_write(kind):
     # recieve message from the user
     data = request.get_json()
     lg(f"RECV: {data}")
@@ -37,18 +107,75 @@ def send_message():
         data = json.loads(data)
 
     # extract text of the message
-    message_id = data.get("message_id")
-    text = data.get("text")
+    payload = {"message_id": data.get("message_id"), "text": data.get("text")}
 
-    # # invoke beluga llm
-    # llm_answer = llm(query, top_k=40, top_p=0.4, temperature=0.5)
-    # response = {"message": llm_answer}
-    docs = [api.prepare_doc(message_id, text)]
-    lg(f"LLM parsed text")
-    response = collection.insert_many(docs)
-    lg(f"Insert to DB complete: {response}")
+    # Enrichment, embedding and writes happen on the worker pool
+    try:
+        response = service.accept_write(kind, payload, get_tenant())
+    except tenants.UnknownTenantError as e:
+        return unknown_tenant(e)
+    except jobs.QueueFullError as e:
+        logger.warning(f"Rejecting {kind}: {e}")
+        return jsonify({"message": "Ingestion queue is full, please retry"}), 503
+    except service.NotReadyError as e:
+        return not_ready(e)
 
-    return jsonify(response)
+    return jsonify(response), 202
+
+
+@app.route("/send_message", methods=["POST"])
+def send_message():
+    return accept_write("save")
+
+
+@app.route("/update", methods=["POST"])
+def update_message():
+    # Edited Telegram messages: the note with the same message_id is revised in place
+    return accept_write("update")
+
+
+@app.route("/saves")
+def list_saves():
+    # Backlog of the save log: ?status=pending,running,failed&limit=100
+    log = conn_d.get("save_log")
+    if log is None:
+        return jsonify({"message": "Save log is disabled"}), 404
+    status = request.args.get("status", "pending,running,failed").split(",")
+    limit = int(request.args.get("limit", 100))
+    return jsonify({**log.stats(), "saves": log.backlog(status, limit)})
+
+
+@app.route("/saves/<int:save_id>")
+def get_save(save_id):
+    log = conn_d.get("save_log")
+    entry = log.get(save_id) if log is not None else None
+    if entry is None:
+        return jsonify({"message": f"Unknown save: {save_id}"}), 404
+    return jsonify(entry)
+
+
+@app.route("/saves/retry", methods=["POST"])
+def retry_saves():
+    # Make failed or backed-off saves due now: {"save_ids": [...]}
+    log = conn_d.get("save_log")
+    if log is None:
+        return jsonify({"message": "Save log is disabled"}), 404
+    save_ids = request.get_json().get("save_ids") or []
+    return jsonify({"retried": log.retry(save_ids) if save_ids else 0})
+
+
+# Longest a /jobs long-poll may hold a worker thread; clients poll again
+MAX_JOB_WAIT = 5
+
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    # ?wait=<seconds> long-polls until the job finishes, up to MAX_JOB_WAIT
+    wait = min(float(request.args.get("wait", 0)), MAX_JOB_WAIT)
+    job = job_queue.wait(job_id, wait) if wait > 0 else job_queue.get(job_id)
+    if job is None:
+        return jsonify({"message": f"Unknown job: {job_id}"}), 404
+    return jsonify(job)
 
 
 @app.route("/get_message", methods=["POST"])
@@ -64,50 +191,92 @@ def get_message():
     # extract text of the message
     message_id = data.get("message_id")
     text = data.get("text")
-    docs = api.retrieve_hybrid_search(
-        text=text,
-        top_n=3,
-        collection=conn_d["collection"],
+    try:
+        tenant = get_tenant()
+        service.check_connected(tenant)
+    except tenants.UnknownTenantError as e:
+        return unknown_tenant(e)
+    except service.NotReadyError as e:
+        return not_ready(e)
+    embedding, cached, docs = service.prepare_answer(tenant, text)
+    if cached is not None:
+        return jsonify(cached)
+
+    response = api.augmented_generation(
+        prompt=text, docs=docs, collection=tenant.collection, mirrors=tenant.mirrors
     )
-    lg(docs)
-    response = api.augmented_generation(prompt=text, docs=docs)
+    service.cache_answer(tenant, embedding, response, docs)
     # return jsonify(response)
     return jsonify(response)
 
 
-def keep_alive(collection, interval=300):
-    while True:
-        api.liveness_check(collection)
-        time.sleep(interval)
+def sse_event(event):
+    return f"data: {json.dumps(event)}\n\n"
 
 
-if __name__ == "__main__":
+@app.route("/get_message_stream", methods=["POST"])
+def get_message_stream():
+    """Same contract as /get_message, but streams the answer as server-sent events.
 
-    database = get_db_connection(
-        endpoint=os.environ["ASTRA_API_ENDPOINT"],
-        token=os.environ["ASTRA_API_TOKEN"],
-        keyspace="telegram_rag",
+    Events are {"type": "token" | "references", "text": ...}, followed by
+    {"type": "done", "ttft_ms": ..., "total_ms": ...} or {"type": "error"}.
+    """
+    data = request.get_json()
+    if isinstance(data, str):
+        data = json.loads(data)
+    lg(data)
+    text = data.get("text")
+    start = time.perf_counter()
+    try:
+        tenant = get_tenant()
+        service.check_connected(tenant)
+    except tenants.UnknownTenantError as e:
+        return unknown_tenant(e)
+    except service.NotReadyError as e:
+        return not_ready(e)
+
+    def generate():
+        ttft_ms = None
+        try:
+            embedding, cached, docs = service.prepare_answer(tenant, text)
+            if cached is not None:
+                ttft_ms = (time.perf_counter() - start) * 1000
+                yield sse_event({"type": "token", "text": cached})
+            else:
+                response = ""
+                for kind, chunk in api.augmented_generation_stream(
+                    prompt=text,
+                    docs=docs,
+                    collection=tenant.collection,
+                    mirrors=tenant.mirrors,
+                ):
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - start) * 1000
+                    response += chunk
+                    yield sse_event({"type": kind, "text": chunk})
+                service.cache_answer(tenant, embedding, response, docs)
+                tracing.record("ask.stream", (time.perf_counter() - start) * 1000)
+        except Exception as e:
+            logger.exception(f"Streaming answer failed: {e}")
+            yield sse_event({"type": "error", "text": "Server error, please retry"})
+            return
+        total_ms = (time.perf_counter() - start) * 1000
+        lg(f"Streamed answer: ttft {ttft_ms:.0f} ms, total {total_ms:.0f} ms")
+        yield sse_event({"type": "done", "ttft_ms": ttft_ms, "total_ms": total_ms})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    try:
-        collection = database.create_collection(
-            "core_messages",
-            dimension=1536,
-            metric=api.VectorMetric.DOT_PRODUCT,  # Or just 'cosine'.
-            check_exists=True,  # Optional
-        )
-    except api.CollectionAlreadyExistsException:
-        lg("Collection already exists.")
-
-    collection = database.get_collection("core_messages")
-
-    conn_d = {}
-    conn_d["collection"] = collection
-    conn_d["database"] = database
-
-    # Start keep-alive in a separate thread
-    query_thread = threading.Thread(target=keep_alive, args=(collection,))
-    query_thread.daemon = True
-    query_thread.start()
-
-    app.run(host="0.0.0.0", port=5000)
+
+if __name__ == "__main__":
+    # RAG_SERVER=flask keeps the development server for local debugging
+    if os.environ.get("RAG_SERVER", "async").lower() == "flask":
+        service.setup()
+        app.run(host="0.0.0.0", port=5000)
+    else:
+        import server
+
+        server.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,342 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import resilience
+import tracing
+from loguru import logger
+
+# Process-wide client-side rate limits for OpenAI, so that live asks, saves
+# and backfills together stay under the account's requests-per-minute and
+# tokens-per-minute limits instead of running into 429s. Every chat or
+# embeddings request takes one request and its estimated tokens from its
+# model's buckets before it is sent; the estimate is corrected with the usage
+# the response reports.
+#
+# Waiting requests queue in lanes. A request is only let through when every
+# request queued in a higher lane has been, so an /ask is never stuck behind
+# a save or a backfill:
+#
+#     interactive  requests served while a user waits (/ask, /search)
+#     ingest       saves and updates, from the job queue and the save log
+#     background   backfills and anything else without a lane
+
+LANES = ("interactive", "ingest", "background")
+
+# Bursts of up to BURST_SECONDS worth of the per-minute limits go through at
+# once; OpenAI enforces limits over shorter periods than a minute too.
+BURST_SECONDS = float(os.environ.get("OPENAI_LIMITER_BURST_SECONDS", 10))
+
+_lane = contextvars.ContextVar("openai_lane", default="background")
+
+
+class RateLimitExceeded(resilience.DeadlineExceeded):
+    """The request could not be let through before its deadline."""
+
+
+@contextmanager
+def lane(name):
+    """Run the block's OpenAI requests in the given lane."""
+    if name not in LANES:
+        raise ValueError(f"Unknown lane {name!r}")
+    token = _lane.set(name)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def set_lane(name):
+    """Put the rest of the current request's OpenAI requests in the given lane."""
+    if name not in LANES:
+        raise ValueError(f"Unknown lane {name!r}")
+    _lane.set(name)
+
+
+def current_lane():
+    return _lane.get()
+
+
+class Bucket:
+    """A token bucket refilled continuously at per_minute / 60 a second."""
+
+    def __init__(self, per_minute, burst_seconds=BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.available = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.available = min(
+            self.capacity, self.available + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def wait(self, amount):
+        """Seconds until amount is available.
+
+        An amount over capacity waits for a full bucket.
+        """
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing / self.rate)
+
+
+class Grant:
+    def __init__(self, limiter, tokens, lane):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.lane = lane
+        self.granted = False
+        self.queued_at = time.monotonic()
+        # Wakes an async waiter, which isn't waiting on the condition
+        self.wake = None
+
+
+class Limiter:
+    """Requests- and tokens-per-minute limits shared by all threads and the event loop.
+
+    rpm or tpm of 0 turns that limit off. There is no dispatcher thread:
+    whichever waiter wakes up first lets through the queued requests that
+    now fit, in lane order.
+    """
+
+    def __init__(self, name, rpm, tpm, burst_seconds=BURST_SECONDS):
+        self.name = name
+        self.requests = Bucket(rpm, burst_seconds) if rpm > 0 else None
+        self.tokens = Bucket(tpm, burst_seconds) if tpm > 0 else None
+        self._queues = {lane: deque() for lane in LANES}
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._counts = {
+            lane: {"granted": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for lane in LANES
+        }
+        self._pauses = 0
+
+    @property
+    def enabled(self):
+        return self.requests is not None or self.tokens is not None
+
+    def acquire(self, tokens, lane=None):
+        """Wait until a request of about `tokens` tokens may be sent.
+
+        Returns:
+            Grant: to pass to settle() with the actual usage, None if disabled
+
+        Raises:
+            RateLimitExceeded: if the deadline passes while waiting
+        """
+        if not self.enabled:
+            return None
+        grant = Grant(self, tokens, lane or _lane.get())
+        with self._cond:
+            self._queues[grant.lane].append(grant)
+            while True:
+                wait = self._dispatch()
+                if grant.granted:
+                    break
+                left = resilience.remaining()
+                if left is not None and left <= 0:
+                    self._give_up(grant)
+                    raise RateLimitExceeded(
+                        "Deadline exceeded waiting for the OpenAI "
+                        f"{self.name} rate limit"
+                    )
+                timeout = wait if left is None else min(wait or left, left)
+                self._cond.wait(timeout)
+        self._record(grant)
+        return grant
+
+    async def aacquire(self, tokens, lane=None):
+        """Async counterpart of acquire(); waits without blocking the event loop."""
+        if not self.enabled:
+            return None
+        loop = asyncio.get_running_loop()
+        grant = Grant(self, tokens, lane or _lane.get())
+        event = asyncio.Event()
+        grant.wake = lambda: loop.call_soon_threadsafe(event.set)
+        with self._cond:
+            self._queues[grant.lane].append(grant)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._dispatch()
+                    if grant.granted:
+                        break
+                    event.clear()
+                left = resilience.remaining()
+                if left is not None and left <= 0:
+                    raise RateLimitExceeded(
+                        "Deadline exceeded waiting for the OpenAI "
+                        f"{self.name} rate limit"
+                    )
+                timeout = wait if left is None else min(wait or left, left)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._cond:
+                self._give_up(grant)
+            raise
+        self._record(grant)
+        return grant
+
+    def settle(self, grant, actual_tokens):
+        """Correct the token estimate of a grant; None keeps the estimate."""
+        if grant is None or self.tokens is None or actual_tokens is None:
+            return
+        with self._cond:
+            self.tokens.available += grant.tokens - actual_tokens
+            grant.tokens = actual_tokens
+            self._wake_all()
+
+    def pause(self, seconds):
+        """Let nothing through for `seconds`, after OpenAI answered 429."""
+        if not self.enabled:
+            return
+        with self._cond:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._pauses += 1
+            # We sent more than OpenAI allows: the buckets are empty when the
+            # pause ends, instead of letting a full burst through again
+            for bucket in (self.requests, self.tokens):
+                if bucket is not None:
+                    bucket.refill(now)
+                    bucket.available = (
+                        min(bucket.available, 0.0)
+                        - (self._paused_until - now) * bucket.rate
+                    )
+        logger.warning(f"OpenAI {self.name} rate limited, pausing for {seconds:.2f}s")
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            for bucket in (self.requests, self.tokens):
+                if bucket is not None:
+                    bucket.refill(now)
+            stats = {
+                "requests_available": self.requests.available
+                if self.requests
+                else None,
+                "tokens_available": self.tokens.available if self.tokens else None,
+                "paused_seconds": max(0.0, self._paused_until - now),
+                "pauses": self._pauses,
+            }
+            for lane, counts in self._counts.items():
+                granted = counts["granted"]
+                stats[f"{lane}_queued"] = len(self._queues[lane])
+                stats[f"{lane}_granted"] = granted
+                stats[f"{lane}_timeouts"] = counts["timeouts"]
+                stats[f"{lane}_wait_ms_mean"] = (
+                    counts["wait_total"] / granted * 1000 if granted else 0.0
+                )
+                stats[f"{lane}_wait_ms_max"] = counts["wait_max"] * 1000
+        return stats
+
+    def _dispatch(self):
+        """Let through the queued requests that fit, highest lane first.
+
+        Returns seconds until the first request still queued could go, or
+        None if nothing is queued. Called with the condition held.
+        """
+        now = time.monotonic()
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill(now)
+        for lane in LANES:
+            queue = self._queues[lane]
+            while queue:
+                grant = queue[0]
+                wait = self._paused_until - now
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait(1))
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait(grant.tokens))
+                if wait > 0:
+                    # Lower lanes wait too, or they would starve this one
+                    return wait
+                queue.popleft()
+                if self.requests is not None:
+                    self.requests.available -= 1
+                if self.tokens is not None:
+                    self.tokens.available -= grant.tokens
+                grant.granted = True
+                # No longer queued, so _wake_all() doesn't reach it
+                if grant.wake is not None:
+                    grant.wake()
+                self._wake_all()
+        return None
+
+    def _give_up(self, grant):
+        if grant.granted:
+            # Granted while we were cancelled: hand the capacity back
+            if self.requests is not None:
+                self.requests.available += 1
+            if self.tokens is not None:
+                self.tokens.available += grant.tokens
+        else:
+            self._queues[grant.lane].remove(grant)
+        self._counts[grant.lane]["timeouts"] += 1
+        self._wake_all()
+
+    def _wake_all(self):
+        self._cond.notify_all()
+        for queue in self._queues.values():
+            for grant in queue:
+                if grant.wake is not None:
+                    grant.wake()
+
+    def _record(self, grant):
+        waited = time.monotonic() - grant.queued_at
+        with self._cond:
+            counts = self._counts[grant.lane]
+            counts["granted"] += 1
+            counts["wait_total"] += waited
+            counts["wait_max"] = max(counts["wait_max"], waited)
+        tracing.observe(
+            "rag_openai_limiter_wait_seconds", waited, kind=self.name, lane=grant.lane
+        )
+
+
+# OpenAI's limits are per model; one limiter per model the service calls
+limiters = {
+    "chat": Limiter(
+        "chat",
+        rpm=int(os.environ.get("OPENAI_CHAT_RPM", 500)),
+        tpm=int(os.environ.get("OPENAI_CHAT_TPM", 200_000)),
+    ),
+    "embed": Limiter(
+        "embed",
+        rpm=int(os.environ.get("OPENAI_EMBED_RPM", 3000)),
+        tpm=int(os.environ.get("OPENAI_EMBED_TPM", 1_000_000)),
+    ),
+}
+
+
+def acquire(kind, tokens):
+    return limiters[kind].acquire(tokens)
+
+
+async def aacquire(kind, tokens):
+    return await limiters[kind].aacquire(tokens)
+
+
+def settle(grant, actual_tokens):
+    if grant is not None:
+        grant.limiter.settle(grant, actual_tokens)
+
+
+def rate_limited(kind, error):
+    """Pause the limiter if error is a 429 from OpenAI."""
+    if resilience.status_code(error) == 429:
+        limiters[kind].pause(resilience.retry_after(error) or 1.0)
+
+
+def stats():
+    return {kind: limiter.stats() for kind, limiter in limiters.items()}
@@ -0,0 +1,110 @@
+import copy
+
+# Retrieval asks Astra for SUMMARY_PROJECTION only: what it takes to rank,
+# filter, cite and log a match. The text is only needed for the few docs that
+# are packed into the prompt or rendered as a reference page, and is loaded
+# for those by api.hydrate_docs. $vector never leaves the search.
+
+SUMMARY_PROJECTION = {
+    "message_id": True,
+    "cleaned_title": True,
+    "update_ts": True,
+    "domain": True,
+    "reference_url": True,
+}
+CONTENT_PROJECTION = {"cleaned_content": True, "raw_content": True}
+
+
+class DocRecord:
+    """A retrieved note, with fixed fields instead of the whole Astra document.
+
+    content (cleaned_content) and raw_content are None until the record is
+    hydrated. similarity is the dot product with the query for vector
+    matches; score is the BM25 or fused score it was ranked by, if any.
+    Records held by the local indexes are shared, so callers change copies
+    made with replace(), never the records a search returned.
+    """
+
+    __slots__ = (
+        "id",
+        "message_id",
+        "title",
+        "update_ts",
+        "domain",
+        "reference_url",
+        "similarity",
+        "score",
+        "content",
+        "raw_content",
+        "hydrated",
+    )
+
+    def __init__(
+        self,
+        id,
+        message_id=None,
+        title=None,
+        update_ts=None,
+        domain=None,
+        reference_url=None,
+        similarity=None,
+        score=None,
+        content=None,
+        raw_content=None,
+        hydrated=False,
+    ):
+        self.id = id
+        self.message_id = message_id
+        self.title = title
+        self.update_ts = update_ts
+        self.domain = domain
+        self.reference_url = reference_url
+        self.similarity = similarity
+        self.score = score
+        self.content = content
+        self.raw_content = raw_content
+        self.hydrated = hydrated
+
+    @classmethod
+    def from_doc(cls, doc):
+        """Record of an Astra doc; hydrated if the doc carries its text."""
+        return cls(
+            doc["_id"],
+            message_id=doc.get("message_id"),
+            title=doc.get("cleaned_title"),
+            update_ts=doc.get("update_ts"),
+            domain=doc.get("domain"),
+            reference_url=doc.get("reference_url"),
+            similarity=doc.get("$similarity"),
+            content=doc.get("cleaned_content"),
+            raw_content=doc.get("raw_content"),
+            hydrated="cleaned_content" in doc or "raw_content" in doc,
+        )
+
+    def replace(self, **changes):
+        record = copy.copy(self)
+        for name, value in changes.items():
+            setattr(record, name, value)
+        return record
+
+    def hydrate(self, doc):
+        """Fill in the text from a doc fetched with CONTENT_PROJECTION."""
+        self.content = doc.get("cleaned_content")
+        self.raw_content = doc.get("raw_content")
+        self.hydrated = True
+
+    def to_doc(self):
+        """The record as an Astra doc, for code shared with the save path."""
+        return {
+            "_id": self.id,
+            "message_id": self.message_id,
+            "cleaned_title": self.title,
+            "update_ts": self.update_ts,
+            "domain": self.domain,
+            "reference_url": self.reference_url,
+            "cleaned_content": self.content,
+            "raw_content": self.raw_content,
+        }
+
+    def __repr__(self):
+        return f"DocRecord({self.id!s}, {self.title!r})"
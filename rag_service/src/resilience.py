@@ -0,0 +1,411 @@
+import asyncio
+import contextvars
+import email.utils
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from loguru import logger
+
+# Shared retry, deadline, circuit breaker and hedging policy for calls to
+# OpenAI, Astra and S3. Every call made through call()/acall() is bounded by
+# the deadline of the request or job it runs in, so a flaky dependency costs
+# at most the time the caller was willing to wait, never minutes of backoff.
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+# Hedged duplicates run here, so the calling thread can wait on both
+_hedge_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("HEDGE_WORKERS", 16)), thread_name_prefix="hedge"
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@contextmanager
+def deadline(seconds, inherit=True):
+    """Bound everything in the block to `seconds` from now.
+
+    With inherit=True an enclosing, earlier deadline still applies. Jobs use
+    inherit=False so they don't carry over the deadline of the request that
+    queued them.
+    """
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    if inherit and current is not None:
+        end = min(end, current)
+    token = _deadline.set(end)
+    try:
+        yield end
+    finally:
+        _deadline.reset(token)
+
+
+def set_deadline(seconds):
+    """Start the deadline of the current request, replacing any earlier one."""
+    _deadline.set(time.monotonic() + seconds)
+
+
+def submit(executor, func, *args):
+    """executor.submit in the caller's context, so the work keeps its deadline."""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def remaining():
+    """Seconds left before the current deadline, or None without one."""
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+def attempt_timeout(default):
+    """Timeout for a single attempt: the default, capped by the deadline."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+    return min(default, left)
+
+
+def status_code(error):
+    # openai.APIStatusError, httpx.HTTPStatusError, botocore ClientError
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+        if status is None and isinstance(response, dict):
+            status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return status
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait (Retry-After / retry-after-ms)."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None and isinstance(response, dict):
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders")
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def is_retryable(error):
+    """Transient failures: timeouts, dropped connections, 408/429/5xx."""
+    if isinstance(error, (DeadlineExceeded, CircuitOpenError)):
+        return False
+    status = status_code(error)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    # Transport errors of httpx, openai, astrapy and botocore
+    name = type(error).__name__
+    return any(word in name for word in ("Timeout", "Connect", "Network", "Transport"))
+
+
+class CircuitBreaker:
+    """Fail fast while a dependency is down.
+
+    Opens after failure_threshold consecutive retryable failures. While open,
+    calls are rejected with CircuitOpenError; after reset_timeout one probe
+    call is let through (half-open) and its outcome closes or re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if (
+                self.state == "open"
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"Circuit for {self.name} closed")
+            self.state = "closed"
+            self._failures = 0
+            self._probing = False
+
+    def release(self):
+        """End a half-open probe that neither closed nor re-opened the circuit.
+
+        Called once every call, so a probe that failed with an error saying
+        nothing about the dependency (a deadline, a cancellation) lets the
+        next call probe instead of leaving the circuit half-open for good.
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(
+                        f"Circuit for {self.name} opened after "
+                        f"{self._failures} failures"
+                    )
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class Policy:
+    """How calls to one dependency are retried, broken and hedged.
+
+    hedge_after: seconds after which an idempotent call that hasn't returned
+        is duplicated; the first result wins. None disables hedging.
+    """
+
+    def __init__(
+        self,
+        name,
+        attempts=3,
+        base_delay=0.5,
+        max_delay=8.0,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        hedge_after=None,
+    ):
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self._lock = threading.Lock()
+        self._counters = {
+            "calls": 0,
+            "failures": 0,
+            "retries": 0,
+            "rejected": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+        }
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def delay(self, attempt, error):
+        backoff = min(self.max_delay, self.base_delay * 2**attempt)
+        backoff = random.uniform(backoff / 2, backoff)
+        server = retry_after(error)
+        return max(backoff, server) if server is not None else backoff
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                "circuit": self.breaker.state,
+                "circuit_open": int(self.breaker.state == "open"),
+            }
+
+
+def _env_ms(name):
+    value = float(os.environ.get(name, 0))
+    return value / 1000 if value > 0 else None
+
+
+policies = {
+    "openai.chat": Policy("openai.chat", attempts=3),
+    "openai.embed": Policy(
+        "openai.embed", attempts=4, hedge_after=_env_ms("HEDGE_EMBED_AFTER_MS")
+    ),
+    "astra.read": Policy(
+        "astra.read", attempts=3, hedge_after=_env_ms("HEDGE_ASTRA_READ_AFTER_MS")
+    ),
+    "astra.write": Policy("astra.write", attempts=3),
+    "s3": Policy("s3", attempts=3),
+}
+# Reads and writes share one breaker: it is the same service being down
+policies["astra.write"].breaker = policies["astra.read"].breaker
+
+
+def stats():
+    return {name: policy.stats() for name, policy in policies.items()}
+
+
+def _check(policy):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before calling {policy.name}")
+    if not policy.breaker.allow():
+        policy.count("rejected")
+        raise CircuitOpenError(f"{policy.name} is unavailable (circuit open)")
+
+
+def _give_up(policy, attempt, error):
+    """Return the delay before the next attempt, or None to stop retrying."""
+    policy.count("failures")
+    if not is_retryable(error):
+        if status_code(error) is not None:
+            # The dependency answered, the request was bad (a 400, a 401...)
+            policy.breaker.record_success()
+        return None
+    policy.breaker.record_failure()
+    if attempt + 1 >= policy.attempts or policy.breaker.state == "open":
+        return None
+    delay = policy.delay(attempt, error)
+    left = remaining()
+    if left is not None and delay >= left:
+        logger.warning(f"{policy.name}: no time left to retry after {error!r}")
+        return None
+    policy.count("retries")
+    logger.warning(f"{policy.name} failed ({error!r}), retrying in {delay:.2f}s")
+    return delay
+
+
+def _hedged(policy, func, args, kwargs):
+    primary = _hedge_executor.submit(
+        contextvars.copy_context().run, func, *args, **kwargs
+    )
+    done, _ = wait([primary], timeout=policy.hedge_after)
+    if done:
+        return primary.result()
+    policy.count("hedges")
+    hedge = _hedge_executor.submit(
+        contextvars.copy_context().run, func, *args, **kwargs
+    )
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            raise DeadlineExceeded(f"Deadline exceeded waiting for {policy.name}")
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    policy.count("hedge_wins")
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call(name, func, *args, idempotent=False, **kwargs):
+    """Call func(*args, **kwargs) under the named dependency's policy.
+
+    Retries transient failures with jittered exponential backoff (or the
+    server's Retry-After, if longer) while the deadline allows, and fails
+    fast with CircuitOpenError while the dependency's circuit is open.
+    Idempotent calls are hedged if the policy has hedge_after set.
+    """
+    policy = policies[name]
+    policy.count("calls")
+    attempt = 0
+    while True:
+        _check(policy)
+        try:
+            if idempotent and policy.hedge_after is not None:
+                result = _hedged(policy, func, args, kwargs)
+            else:
+                result = func(*args, **kwargs)
+        except Exception as e:
+            delay = _give_up(policy, attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        else:
+            policy.breaker.record_success()
+            return result
+        finally:
+            policy.breaker.release()
+
+
+async def _ahedged(policy, factory):
+    primary = asyncio.ensure_future(factory())
+    done, _ = await asyncio.wait({primary}, timeout=policy.hedge_after)
+    if done:
+        return primary.result()
+    policy.count("hedges")
+    hedge = asyncio.ensure_future(factory())
+    pending = {primary, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                raise DeadlineExceeded(f"Deadline exceeded waiting for {policy.name}")
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        policy.count("hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def acall(name, factory, idempotent=False):
+    """Async counterpart of call(). factory() returns a fresh awaitable per attempt."""
+    policy = policies[name]
+    policy.count("calls")
+    attempt = 0
+    while True:
+        _check(policy)
+        try:
+            if idempotent and policy.hedge_after is not None:
+                result = await _ahedged(policy, factory)
+            else:
+                result = await asyncio.wait_for(factory(), timeout=remaining())
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError) and (remaining() or 1) <= 0:
+                e = DeadlineExceeded(f"Deadline exceeded waiting for {policy.name}")
+            delay = _give_up(policy, attempt, e)
+            if delay is None:
+                raise e
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        else:
+            policy.breaker.record_success()
+            return result
+        finally:
+            policy.breaker.release()
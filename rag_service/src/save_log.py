@@ -0,0 +1,290 @@
+import datetime
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+lg = logger.info
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS saves (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    message_id TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    received_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    claimed_at REAL,
+    claimed_by INTEGER,
+    finished_at REAL,
+    last_error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS saves_due ON saves (status, next_attempt_at);
+"""
+
+_COLUMNS = (
+    "id, kind, message_id, payload, status, attempts, received_at, "
+    "next_attempt_at, finished_at, last_error, result"
+)
+
+
+def _iso(ts):
+    if ts is None:
+        return None
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+def _message_key(payload):
+    # Message ids are only unique within a chat, so key them by tenant
+    message_id = str(payload.get("message_id"))
+    if payload.get("tenant"):
+        message_id = f"{payload['tenant']}/{message_id}"
+    return message_id
+
+
+class SaveLog:
+    """Append-only SQLite log of incoming saves and updates.
+
+    Every write request is appended (and committed) before it is
+    acknowledged, then processed from the log. An entry moves from pending
+    to running when a process claims it, and to done or, after max_attempts,
+    to failed. A failed attempt puts it back to pending with exponential
+    backoff. Claims expire after lease seconds, so entries held by a process
+    that died are picked up again. The file can be shared by several server
+    processes; claiming happens in one write transaction.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_attempts=20,
+        base_delay=5.0,
+        max_delay=600.0,
+        lease=900.0,
+        retention=7 * 24 * 3600,
+    ):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.retention = retention
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(_SCHEMA)
+        lg(f"Save log at {path}: {self.stats()}")
+
+    def append(self, kind, payload, claimed=False):
+        """Durably record a save ("save" or "update") and return its id.
+
+        With claimed=True the entry starts out running for this process,
+        for callers that process it right away.
+        """
+        now = time.time()
+        message_id = _message_key(payload)
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO saves (kind, message_id, payload, status, received_at, "
+                "next_attempt_at, claimed_at, claimed_by) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    message_id,
+                    json.dumps(payload),
+                    "running" if claimed else "pending",
+                    now,
+                    now,
+                    now if claimed else None,
+                    os.getpid() if claimed else None,
+                ),
+            )
+            return cursor.lastrowid
+
+    def claim(self, limit=32):
+        """Mark entries as running for this process and return them.
+
+        Claims up to limit entries that are due, oldest first. An update is
+        held back while an earlier save of the same message is unprocessed.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Reclaim entries whose process never reported back
+                self._db.execute(
+                    "UPDATE saves SET status = 'pending' "
+                    "WHERE status = 'running' AND claimed_at < ?",
+                    (now - self.lease,),
+                )
+                rows = self._db.execute(
+                    f"SELECT {_COLUMNS} FROM saves AS s "
+                    "WHERE status = 'pending' AND next_attempt_at <= ? "
+                    "AND NOT (kind = 'update' AND EXISTS ("
+                    "  SELECT 1 FROM saves AS e WHERE e.message_id = s.message_id "
+                    "  AND e.kind = 'save' AND e.id < s.id "
+                    "  AND e.status IN ('pending', 'running'))) "
+                    "ORDER BY id LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE saves SET status = 'running', claimed_at = ?, "
+                    "claimed_by = ? WHERE id = ?",
+                    [(now, os.getpid(), row[0]) for row in rows],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return [self._entry(row) for row in rows]
+
+    def has_unfinished_save(self, payload):
+        """Whether a save of the payload's message is still pending or running."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM saves WHERE message_id = ? AND kind = 'save' "
+                "AND status IN ('pending', 'running') LIMIT 1",
+                (_message_key(payload),),
+            ).fetchone()
+        return row is not None
+
+    def complete(self, entry_id, result):
+        with self._lock:
+            self._db.execute(
+                "UPDATE saves SET status = 'done', finished_at = ?, result = ?, "
+                "last_error = NULL WHERE id = ?",
+                (time.time(), json.dumps(result), entry_id),
+            )
+
+    def fail(self, entry_id, error):
+        """Record a failed attempt; returns the delay until the next one, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT attempts FROM saves WHERE id = ?", (entry_id,)
+            ).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if attempts >= self.max_attempts:
+                self._db.execute(
+                    "UPDATE saves SET status = 'failed', attempts = ?, "
+                    "finished_at = ?, last_error = ? WHERE id = ?",
+                    (attempts, time.time(), str(error), entry_id),
+                )
+                return None
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+            delay += random.uniform(0, delay / 4)
+            self._db.execute(
+                "UPDATE saves SET status = 'pending', attempts = ?, "
+                "next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time() + delay, str(error), entry_id),
+            )
+            return delay
+
+    def release(self, entry_ids):
+        """Hand claimed entries back without counting an attempt."""
+        marks = ",".join("?" * len(entry_ids))
+        with self._lock:
+            self._db.execute(
+                "UPDATE saves SET status = 'pending', claimed_at = NULL "
+                f"WHERE status = 'running' AND id IN ({marks})",
+                list(entry_ids),
+            )
+
+    def retry(self, entry_ids):
+        """Make failed or backed-off entries due again right away."""
+        marks = ",".join("?" * len(entry_ids))
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE saves SET status = 'pending', next_attempt_at = ?, "
+                "attempts = CASE status WHEN 'failed' THEN 0 ELSE attempts END "
+                f"WHERE status IN ('pending', 'failed') AND id IN ({marks})",
+                [time.time(), *entry_ids],
+            )
+            return cursor.rowcount
+
+    def get(self, entry_id):
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {_COLUMNS} FROM saves WHERE id = ?", (entry_id,)
+            ).fetchone()
+        return self._entry(row) if row else None
+
+    def backlog(self, status=("pending", "running", "failed"), limit=100):
+        """Unfinished entries, oldest first, for inspection."""
+        marks = ",".join("?" * len(status))
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {_COLUMNS} FROM saves WHERE status IN ({marks}) "
+                "ORDER BY id LIMIT ?",
+                [*status, limit],
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def prune(self):
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM saves WHERE status = 'done' AND finished_at < ?",
+                (time.time() - self.retention,),
+            )
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            counts = dict(
+                self._db.execute(
+                    "SELECT status, COUNT(*) FROM saves GROUP BY status"
+                ).fetchall()
+            )
+            oldest = self._db.execute(
+                "SELECT MIN(received_at) FROM saves "
+                "WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+        return {
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "failed": counts.get("failed", 0),
+            "done": counts.get("done", 0),
+            # Age of the oldest unprocessed save: how far replay is behind
+            "replay_lag_seconds": round(time.time() - oldest, 1) if oldest else 0.0,
+        }
+
+    def _entry(self, row):
+        (
+            entry_id,
+            kind,
+            message_id,
+            payload,
+            status,
+            attempts,
+            received_at,
+            next_attempt_at,
+            finished_at,
+            last_error,
+            result,
+        ) = row
+        return {
+            "save_id": entry_id,
+            "kind": kind,
+            "message_id": message_id,
+            "payload": json.loads(payload),
+            "status": status,
+            "attempts": attempts,
+            "received_ts": _iso(received_at),
+            "next_attempt_ts": _iso(next_attempt_at) if status == "pending" else None,
+            "finished_ts": _iso(finished_at),
+            "last_error": last_error,
+            "result": json.loads(result) if result else None,
+        }
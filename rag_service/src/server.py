@@ -0,0 +1,335 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+import api
+import jobs
+import rate_limiter
+import resilience
+import service
+import tenants
+import tracing
+from aiohttp import web
+from loguru import logger
+
+# Production server: the same endpoints as main.py on aiohttp, with the ask
+# path awaiting the async OpenAI client and astrapy's async collection so one
+# process can hold many asks in flight. Ingestion still runs on the job
+# queue's worker threads.
+#
+# RAG_WORKERS > 1 starts that many processes sharing the port (SO_REUSEPORT).
+# Each process has its own job queue, so /jobs/<id> lookups are only reliable
+# with a single worker. /saves/<save_id> reads the save log the workers share.
+
+RAG_WORKERS = int(os.environ.get("RAG_WORKERS", 1))
+JOB_POLL_INTERVAL = 0.25
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), "templates", "index.html")
+
+lg = logger.info
+conn_d = service.conn_d
+
+
+@web.middleware
+async def request_context(request, handler):
+    # tele_service passes X-Request-ID so one Telegram message can be followed
+    # end to end
+    request_id = tracing.set_request_id(request.headers.get("X-Request-ID"))
+    resilience.set_deadline(service.REQUEST_DEADLINE)
+    # Someone is waiting: OpenAI calls go ahead of saves and backfills
+    rate_limiter.set_lane("interactive")
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        # Streamed responses set it themselves before their headers go out
+        if not response.prepared:
+            response.headers["X-Request-ID"] = request_id
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        tracing.observe(
+            "rag_http_request_duration_seconds",
+            time.perf_counter() - start,
+            endpoint=resource.canonical if resource else "unmatched",
+            method=request.method,
+            status=status,
+        )
+
+
+async def read_json(request):
+    data = await request.json()
+    # ensure message is converted to json if it was recieved as str
+    if isinstance(data, str):
+        data = json.loads(data)
+    return data
+
+
+async def index(request):
+    return web.FileResponse(TEMPLATE_PATH)
+
+
+async def healthcheck(request):
+    return web.json_response({"message": service.healthcheck_message()})
+
+
+async def ready(request):
+    # Readiness, unlike /healthcheck (liveness): 503 until Astra and the clients are up
+    report = service.readiness_report()
+    return web.json_response(report, status=200 if report["ready"] else 503)
+
+
+def not_ready(e):
+    logger.warning(f"Rejecting request: {e}")
+    return web.json_response(
+        {"message": "Server is starting, please retry"}, status=503
+    )
+
+
+def unknown_tenant(e):
+    logger.warning(f"Rejecting request: {e}")
+    return web.json_response({"message": "Unknown tenant"}, status=403)
+
+
+def get_tenant(request):
+    # tele_service sends the tenant of the chat; without one, the default tenant
+    return service.get_tenant(request.headers.get("X-Tenant-ID"))
+
+
+async def stats(request):
+    return web.json_response(service.collect_stats())
+
+
+async def metrics(request):
+    return web.Response(
+        text=service.render_metrics(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def accept_write(request, kind):
+    data = await read_json(request)
+    lg(f"RECV: {data}")
+    payload = {"message_id": data.get("message_id"), "text": data.get("text")}
+
+    # Enrichment, embedding and writes happen on the worker pool. Accepting
+    # the write still blocks (the save log append is a synchronous SQLite
+    # commit, and the first _id imports astrapy), so it runs on a thread
+    try:
+        tenant = get_tenant(request)
+        response = await asyncio.to_thread(service.accept_write, kind, payload, tenant)
+    except tenants.UnknownTenantError as e:
+        return unknown_tenant(e)
+    except jobs.QueueFullError as e:
+        logger.warning(f"Rejecting {kind}: {e}")
+        return web.json_response(
+            {"message": "Ingestion queue is full, please retry"}, status=503
+        )
+    except service.NotReadyError as e:
+        return not_ready(e)
+    return web.json_response(response, status=202)
+
+
+async def send_message(request):
+    return await accept_write(request, "save")
+
+
+async def update_message(request):
+    # Edited Telegram messages: the note with the same message_id is revised in place
+    return await accept_write(request, "update")
+
+
+async def list_saves(request):
+    # Backlog of the save log: ?status=pending,running,failed&limit=100
+    log = conn_d.get("save_log")
+    if log is None:
+        return web.json_response({"message": "Save log is disabled"}, status=404)
+    status = request.query.get("status", "pending,running,failed").split(",")
+    limit = int(request.query.get("limit", 100))
+    return web.json_response({**log.stats(), "saves": log.backlog(status, limit)})
+
+
+async def get_save(request):
+    save_id = int(request.match_info["save_id"])
+    log = conn_d.get("save_log")
+    entry = log.get(save_id) if log is not None else None
+    if entry is None:
+        return web.json_response({"message": f"Unknown save: {save_id}"}, status=404)
+    return web.json_response(entry)
+
+
+async def retry_saves(request):
+    # Make failed or backed-off saves due now: {"save_ids": [...]}
+    log = conn_d.get("save_log")
+    if log is None:
+        return web.json_response({"message": "Save log is disabled"}, status=404)
+    save_ids = (await read_json(request)).get("save_ids") or []
+    return web.json_response({"retried": log.retry(save_ids) if save_ids else 0})
+
+
+async def get_job(request):
+    # ?wait=<seconds> long-polls until the job finishes, without holding a thread
+    job_id = request.match_info["job_id"]
+    deadline = time.monotonic() + min(float(request.query.get("wait", 0)), 60)
+    job = service.job_queue.get(job_id)
+    while (
+        job is not None
+        and job["status"] not in ("done", "failed")
+        and time.monotonic() < deadline
+    ):
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        job = service.job_queue.get(job_id)
+    if job is None:
+        return web.json_response({"message": f"Unknown job: {job_id}"}, status=404)
+    return web.json_response(job)
+
+
+async def get_message(request):
+    data = await read_json(request)
+    lg(data)
+    text = data.get("text")
+    try:
+        tenant = get_tenant(request)
+        service.check_connected(tenant)
+    except tenants.UnknownTenantError as e:
+        return unknown_tenant(e)
+    except service.NotReadyError as e:
+        return not_ready(e)
+    embedding, cached, docs = await service.aprepare_answer(tenant, text)
+    if cached is not None:
+        return web.json_response(cached)
+
+    response = await api.aaugmented_generation(
+        prompt=text,
+        docs=docs,
+        collection=tenant.async_collection,
+        mirrors=tenant.mirrors,
+    )
+    service.cache_answer(tenant, embedding, response, docs)
+    return web.json_response(response)
+
+
+def sse_event(event):
+    return f"data: {json.dumps(event)}\n\n".encode("utf-8")
+
+
+async def get_message_stream(request):
+    """Same contract as /get_message, but streams the answer as server-sent events.
+
+    Events are {"type": "token" | "references", "text": ...}, followed by
+    {"type": "done", "ttft_ms": ..., "total_ms": ...} or {"type": "error"}.
+    """
+    data = await read_json(request)
+    lg(data)
+    text = data.get("text")
+    start = time.perf_counter()
+    try:
+        tenant = get_tenant(request)
+        service.check_connected(tenant)
+    except tenants.UnknownTenantError as e:
+        return unknown_tenant(e)
+    except service.NotReadyError as e:
+        return not_ready(e)
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "X-Request-ID": tracing.get_request_id(),
+        }
+    )
+    await response.prepare(request)
+
+    ttft_ms = None
+    try:
+        embedding, cached, docs = await service.aprepare_answer(tenant, text)
+        if cached is not None:
+            ttft_ms = (time.perf_counter() - start) * 1000
+            await response.write(sse_event({"type": "token", "text": cached}))
+        else:
+            answer = ""
+            async for kind, chunk in api.aaugmented_generation_stream(
+                prompt=text,
+                docs=docs,
+                collection=tenant.async_collection,
+                mirrors=tenant.mirrors,
+            ):
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - start) * 1000
+                answer += chunk
+                await response.write(sse_event({"type": kind, "text": chunk}))
+            service.cache_answer(tenant, embedding, answer, docs)
+            tracing.record("ask.stream", (time.perf_counter() - start) * 1000)
+        total_ms = (time.perf_counter() - start) * 1000
+        lg(f"Streamed answer: ttft {ttft_ms:.0f} ms, total {total_ms:.0f} ms")
+        await response.write(
+            sse_event({"type": "done", "ttft_ms": ttft_ms, "total_ms": total_ms})
+        )
+    except ConnectionResetError:
+        lg("Client disconnected while streaming")
+        return response
+    except Exception as e:
+        logger.exception(f"Streaming answer failed: {e}")
+        await response.write(
+            sse_event({"type": "error", "text": "Server error, please retry"})
+        )
+    await response.write_eof()
+    return response
+
+
+def create_app():
+    app = web.Application(middlewares=[request_context])
+    app.router.add_get("/", index)
+    app.router.add_get("/healthcheck", healthcheck)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_post("/send_message", send_message)
+    app.router.add_post("/update", update_message)
+    app.router.add_get("/saves", list_saves)
+    app.router.add_get(r"/saves/{save_id:\d+}", get_save)
+    app.router.add_post("/saves/retry", retry_saves)
+    app.router.add_get("/jobs/{job_id}", get_job)
+    app.router.add_post("/get_message", get_message)
+    app.router.add_post("/get_message_stream", get_message_stream)
+    return app
+
+
+def serve(host, port, reuse_port=False):
+    service.setup()
+    lg(f"Serving on {host}:{port} (pid {os.getpid()})")
+    web.run_app(
+        create_app(),
+        host=host,
+        port=port,
+        reuse_port=reuse_port,
+        access_log=None,
+        print=None,
+    )
+
+
+def run(host="0.0.0.0", port=5000, workers=None):
+    workers = workers or RAG_WORKERS
+    if workers <= 1:
+        serve(host, port)
+        return
+
+    # Spawned, so every worker opens its own connections and SQLite handles
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=serve, args=(host, port, True), daemon=True)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    lg(f"Started {workers} server workers")
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,805 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import answer_cache
+import api
+import batcher
+import clients
+import context_packer
+import domain_router
+import jobs
+import lexical_index
+import llm_helper
+import rate_limiter
+import resilience
+import save_log
+import tenants
+import tracing
+import vector_index
+from loguru import logger
+
+# Runtime state and request helpers shared by the Flask app (main.py) and the
+# async server (server.py). setup() fills conn_d once per process.
+
+# Tag every log line with the request id it belongs to
+logger.configure(
+    patcher=lambda record: record["extra"].update(request_id=tracing.get_request_id())
+)
+logger.remove()
+logger.add(
+    sys.stderr,
+    format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | "
+    "<level>{level: <8}</level> | <magenta>{extra[request_id]}</magenta> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>",
+    level=os.environ.get("LOG_LEVEL", "INFO"),
+)
+
+lg = logger.info
+
+# Docs retrieved per question; the context packer trims them to the prompt budget
+RETRIEVAL_TOP_N = int(os.environ.get("RETRIEVAL_TOP_N", 5))
+
+# Time budgets for every OpenAI, Astra and S3 call made on behalf of a request
+# or a save job, retries included (see resilience.py). REQUEST_DEADLINE stays
+# under the bot's ASK_TIMEOUT so the user gets an error instead of silence.
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", 55))
+SAVE_DEADLINE = float(os.environ.get("SAVE_DEADLINE", 120))
+
+conn_d = {}
+
+# Saves arriving within SAVE_BATCH_WAIT_MS of each other are prepared and
+# inserted together. Job workers only wait on their batch, so there should be
+# at least SAVE_BATCH_SIZE of them.
+SAVE_BATCH_SIZE = int(os.environ.get("SAVE_BATCH_SIZE", 8))
+SAVE_BATCH_WAIT_MS = float(os.environ.get("SAVE_BATCH_WAIT_MS", 50))
+
+job_queue = jobs.JobQueue(
+    workers=int(os.environ.get("INGEST_WORKERS", max(4, 2 * SAVE_BATCH_SIZE))),
+    max_pending=int(os.environ.get("INGEST_QUEUE_SIZE", 100)),
+)
+
+# Every save and update is committed here before it is acknowledged.
+# SAVE_LOG_PATH= (empty) processes writes straight from the job queue instead.
+SAVE_LOG_PATH = os.environ.get("SAVE_LOG_PATH", "data/save_log.sqlite3")
+
+# Enrichment and reference uploads of the notes in a batch
+_batch_executor = ThreadPoolExecutor(
+    max_workers=max(SAVE_BATCH_SIZE, 1) * 2, thread_name_prefix="save-batch"
+)
+
+
+# Vector options of each collection as last checked against Astra. While they
+# match, a restart is ready as soon as it has a collection handle, and the
+# check runs again in the background.
+SCHEMA_CACHE_PATH = os.environ.get("SCHEMA_CACHE_PATH", "data/collection_schema.json")
+COLLECTION_NAME = "core_messages"
+COLLECTION_SCHEMA = {"dimension": 1536, "metric": "dot_product"}
+
+# Tenants and their collections (see tenants.py), from the file tele_service
+# also reads. Set to "" to send every request to the default tenant, on
+# COLLECTION_NAME.
+TENANTS_CONFIG = os.environ.get("TENANTS_CONFIG", tenants.DEFAULT_PATH)
+
+# What /ready waits for; filled in by connect_in_background. Each tenant's
+# schema check is reported by readiness_report.
+readiness = {"collection": False, "clients": False}
+
+# Opening tenants races with the tenants file being reloaded
+_open_lock = threading.Lock()
+
+
+class NotReadyError(Exception):
+    """The request needs the database, which isn't connected yet."""
+
+
+def get_db_connection(endpoint, token, keyspace):
+    return api.connect(endpoint, token, keyspace)
+
+
+def setup():
+    """Set up local state and start connecting in the background.
+
+    Only the tenants' mirrors and the save log are created before this
+    returns, so the server listens (and accepts saves into the log) right
+    away. Astra and the OpenAI and S3 clients come up on a background thread;
+    see readiness.
+    """
+    conn_d["database"] = None
+    if TENANTS_CONFIG and not os.path.exists(TENANTS_CONFIG):
+        # Otherwise every tenant but the default would be refused as unknown
+        raise FileNotFoundError(
+            f"Tenants file {TENANTS_CONFIG} not found; point TENANTS_CONFIG at "
+            "the tenants.json tele_service uses, or set it to '' for one tenant"
+        )
+    conn_d["tenants"] = tenants.TenantRegistry(
+        TENANTS_CONFIG, COLLECTION_NAME, factory=new_tenant
+    )
+
+    conn_d["save_log"] = None
+    if SAVE_LOG_PATH:
+        conn_d["save_log"] = save_log.SaveLog(
+            SAVE_LOG_PATH,
+            max_attempts=int(os.environ.get("SAVE_MAX_ATTEMPTS", 20)),
+        )
+        replay_thread = threading.Thread(
+            target=replay_saves, args=(conn_d["save_log"],)
+        )
+        replay_thread.daemon = True
+        replay_thread.start()
+
+    connect_thread = threading.Thread(target=connect_in_background)
+    connect_thread.daemon = True
+    connect_thread.start()
+    return conn_d
+
+
+def new_tenant(tenant_id, collection_name):
+    """Create a tenant's caches and local indexes, and open it if connected."""
+    tenant = tenants.Tenant(tenant_id, collection_name)
+
+    if int(os.environ.get("ANSWER_CACHE_SIZE", 256)) > 0:
+        tenant.answer_cache = answer_cache.SemanticAnswerCache(
+            threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.9)),
+            max_entries=int(os.environ.get("ANSWER_CACHE_SIZE", 256)),
+            ttl=float(os.environ.get("ANSWER_CACHE_TTL", 3600)),
+        )
+        tenant.mirrors.append(tenant.answer_cache)
+
+    if os.environ.get("LOCAL_VECTOR_INDEX", "false").lower() in ("1", "true"):
+        # LOCAL_INDEX_DIM < 1536 keeps shortened vectors only and reranks the
+        # top LOCAL_INDEX_CANDIDATES with full vectors fetched from Astra. It
+        # saves memory, not time (the rerank costs a round trip), so the
+        # default is the full-precision index.
+        dim = int(os.environ.get("LOCAL_INDEX_DIM", 1536))
+        dtype = os.environ.get("LOCAL_INDEX_DTYPE", "float32")
+        max_age = float(os.environ.get("LOCAL_INDEX_MAX_AGE", 3600))
+        if dim < 1536:
+            tenant.index = vector_index.ReducedVectorIndex(
+                dim=dim,
+                dtype=dtype,
+                max_age=max_age,
+                candidates=int(os.environ.get("LOCAL_INDEX_CANDIDATES", 40)),
+            )
+        else:
+            tenant.index = vector_index.LocalVectorIndex(
+                dim=1536, dtype=dtype, max_age=max_age
+            )
+        tenant.mirrors.append(tenant.index)
+        tenant.scanned.append(tenant.index)
+
+    if os.environ.get("DOMAIN_ROUTER", "true").lower() in ("1", "true"):
+        tenant.router = domain_router.DomainRouter(
+            dim=1536,
+            min_score=float(os.environ.get("DOMAIN_ROUTER_MIN_SCORE", 0.3)),
+            min_margin=float(os.environ.get("DOMAIN_ROUTER_MIN_MARGIN", 0.02)),
+        )
+        tenant.mirrors.append(tenant.router)
+        tenant.scanned.append(tenant.router)
+
+    if os.environ.get("LEXICAL_INDEX", "true").lower() in ("1", "true"):
+        tenant.lexical = lexical_index.LexicalIndex(
+            max_terms=int(os.environ.get("LEXICAL_FAST_PATH_MAX_TERMS", 3)),
+            max_hits=int(os.environ.get("LEXICAL_FAST_PATH_MAX_HITS", 5)),
+        )
+        tenant.mirrors.append(tenant.lexical)
+        tenant.scanned.append(tenant.lexical)
+
+    if conn_d.get("database") is not None:
+        open_tenant(tenant)
+    return tenant
+
+
+def connect_in_background():
+    """Open the tenants' collections, then warm up clients and keep-alive."""
+    conn_d["database"] = get_db_connection(
+        endpoint=os.environ["ASTRA_API_ENDPOINT"],
+        token=os.environ["ASTRA_API_TOKEN"],
+        keyspace="telegram_rag",
+    )
+    for tenant in conn_d["tenants"].all():
+        open_tenant(tenant)
+    readiness["collection"] = True
+
+    warm_up()
+
+    # Start keep-alive in a separate thread
+    query_thread = threading.Thread(target=keep_alive)
+    query_thread.daemon = True
+    query_thread.start()
+
+
+def open_tenant(tenant):
+    """Get the tenant's collection handle and start checking and mirroring it."""
+    with _open_lock:
+        if tenant.collection is not None:
+            return
+        database = conn_d["database"]
+        # A handle needs no request; check_collection validates it below
+        collection = database.get_collection(tenant.collection_name)
+        # Same collection on astrapy's async client, for the async server's handlers
+        tenant.async_collection = collection.to_async()
+        tenant.collection = collection
+
+    cache_key = (
+        f"{os.environ['ASTRA_API_ENDPOINT']}/telegram_rag/{tenant.collection_name}"
+    )
+    if _read_schema_cache().get(cache_key) == COLLECTION_SCHEMA:
+        lg(f"Schema of {tenant.collection_name} matches the cached check")
+        tenant.schema_checked = True
+    schema_thread = threading.Thread(
+        target=validate_collection, args=(database, tenant, cache_key)
+    )
+    schema_thread.daemon = True
+    schema_thread.start()
+
+    if tenant.scanned:
+        # One thread per tenant, so a large collection's scan delays no one else
+        mirror_thread = threading.Thread(target=keep_mirrors_fresh, args=(tenant,))
+        mirror_thread.daemon = True
+        mirror_thread.start()
+
+
+def validate_collection(database, tenant, cache_key, max_delay=60):
+    # Retried until Astra answers; a mismatched schema keeps the server unready
+    delay = 1
+    while not tenant.closed:
+        try:
+            schema = api.check_collection(
+                database, tenant.collection_name, **COLLECTION_SCHEMA
+            )
+        except ValueError as e:
+            logger.error(f"Collection check failed: {e}")
+            tenant.schema_checked = False
+            return
+        except Exception as e:
+            logger.warning(f"Could not check the collection, retrying in {delay}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            continue
+        tenant.schema_checked = True
+        _write_schema_cache(cache_key, schema)
+        lg(f"Collection {tenant.collection_name} checked: {schema}")
+        return
+
+
+def _read_schema_cache():
+    try:
+        with open(SCHEMA_CACHE_PATH, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_schema_cache(cache_key, schema):
+    try:
+        if os.path.dirname(SCHEMA_CACHE_PATH):
+            os.makedirs(os.path.dirname(SCHEMA_CACHE_PATH), exist_ok=True)
+        with open(SCHEMA_CACHE_PATH, "w") as file:
+            json.dump({**_read_schema_cache(), cache_key: schema}, file)
+    except OSError as e:
+        logger.warning(f"Could not cache the collection schema: {e}")
+
+
+def warm_up():
+    """Create the OpenAI and S3 clients and load the tokenizer before a request."""
+    start = time.perf_counter()
+    try:
+        llm_helper.initialize_embeddings()
+        clients.get_openai_client()
+        clients.get_async_openai_clients()
+    except Exception as e:
+        logger.error(f"Could not create the OpenAI clients: {e}")
+        return
+    # Token counts are taken on the event loop of the async server
+    context_packer.load_tokenizer(llm_helper.CHAT_MODEL)
+    try:
+        clients.get_s3_client()
+    except Exception as e:
+        # Uploads retry creating it; answers just go without references
+        logger.warning(f"Could not create the S3 client: {e}")
+    readiness["clients"] = True
+    lg(f"Clients ready in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def readiness_report():
+    registry = conn_d.get("tenants")
+    checked = (
+        {t.tenant_id: t.schema_checked for t in registry.all()} if registry else {}
+    )
+    report = {**readiness, "schema": bool(checked) and all(checked.values())}
+    return {"ready": all(report.values()), **report, "tenants": checked}
+
+
+def get_tenant(tenant_id=None):
+    """The tenant a request is for; None means the default tenant.
+
+    Raises:
+        tenants.UnknownTenantError: if the tenants file has no such tenant
+    """
+    return conn_d["tenants"].get(tenant_id)
+
+
+def check_connected(tenant):
+    if tenant.collection is None:
+        raise NotReadyError("Not connected to the database yet")
+
+
+def healthcheck_message():
+    return f"Server is connected to: {conn_d.get('database')}"
+
+
+def _doc_id(payload):
+    # Saves replayed from the save log keep the _id they were given on arrival
+    return uuid.UUID(payload["_id"]) if payload.get("_id") else None
+
+
+def ingest_message(payload, progress):
+    if save_batcher is not None:
+        return save_batcher.submit((payload, progress)).result()
+    # Writes logged before tenants existed carry no tenant: the default one
+    tenant = get_tenant(payload.get("tenant"))
+    docs = [
+        api.prepare_doc(
+            payload["message_id"],
+            payload["text"],
+            on_stage=progress,
+            router=tenant.router,
+            _id=_doc_id(payload),
+        )
+    ]
+    lg(f"LLM parsed text")
+    progress("inserting")
+    response = api.insert_docs(tenant.collection, docs, mirrors=tenant.mirrors)
+    lg(f"Insert to DB complete: {response}")
+    return {"inserted_ids": [str(doc["_id"]) for doc in docs]}
+
+
+def ingest_batch(items):
+    """MicroBatcher handler: prepare and insert a batch of (payload, progress)."""
+    # Batcher threads don't run in the context of the jobs that fill them
+    with resilience.deadline(SAVE_DEADLINE), rate_limiter.lane("ingest"):
+        return _ingest_batch(items)
+
+
+def _ingest_batch(items):
+    # Each tenant's notes go to its own collection, so split the batch by tenant
+    groups = {}
+    for i, (payload, _) in enumerate(items):
+        groups.setdefault(payload.get("tenant"), []).append(i)
+    results = [None] * len(items)
+    for tenant_id, positions in groups.items():
+        try:
+            tenant = get_tenant(tenant_id)
+        except tenants.UnknownTenantError as e:
+            for i in positions:
+                results[i] = e
+            continue
+        tenant_results = _ingest_tenant_batch(tenant, [items[i] for i in positions])
+        for i, result in zip(positions, tenant_results):
+            results[i] = result
+    return results
+
+
+def _ingest_tenant_batch(tenant, items):
+    from astrapy.exceptions import InsertManyException
+
+    def on_stage(stage):
+        for _, progress in items:
+            progress(stage)
+
+    results = api.prepare_docs(
+        [(payload["message_id"], payload["text"]) for payload, _ in items],
+        _batch_executor,
+        on_stage=on_stage,
+        router=tenant.router,
+        ids=[_doc_id(payload) for payload, _ in items],
+    )
+    docs = [doc for doc in results if not isinstance(doc, Exception)]
+    if not docs:
+        return results
+    on_stage("inserting")
+    try:
+        api.insert_docs(tenant.collection, docs, mirrors=tenant.mirrors)
+        inserted = {doc["_id"] for doc in docs}
+        error = None
+    except InsertManyException as e:
+        inserted = api.inserted_ids(e, docs)
+        error = e
+    lg(
+        f"Inserted {len(inserted)} of a batch of {len(items)} notes "
+        f"for {tenant.tenant_id}"
+    )
+    for i, result in enumerate(results):
+        if not isinstance(result, Exception):
+            results[i] = (
+                {"inserted_ids": [str(result["_id"])]}
+                if result["_id"] in inserted
+                else error
+            )
+    return results
+
+
+save_batcher = None
+if SAVE_BATCH_SIZE > 1:
+    save_batcher = batcher.MicroBatcher(
+        ingest_batch,
+        max_items=SAVE_BATCH_SIZE,
+        max_wait=SAVE_BATCH_WAIT_MS / 1000,
+        max_batches=int(os.environ.get("SAVE_BATCH_CONCURRENCY", 2)),
+        name="save-batch",
+    )
+
+
+def update_message(payload, progress):
+    # Edits of a message that was never saved are saved as new notes
+    tenant = get_tenant(payload.get("tenant"))
+    progress("looking up")
+    doc = api.find_by_message_id(tenant.collection, payload["message_id"])
+    if doc is None:
+        lg(f"No note for message {payload['message_id']}, saving it instead")
+        return ingest_message(payload, progress)
+
+    changes = api.revise_doc(
+        doc, payload["text"], on_stage=progress, router=tenant.router
+    )
+    if not changes:
+        lg(f"Note {doc['_id']} is unchanged, skipping update")
+        return {"updated_ids": [], "unchanged_ids": [str(doc["_id"])]}
+    progress("updating")
+    response = api.update_doc(tenant.collection, doc, changes, mirrors=tenant.mirrors)
+    lg(f"Updated {sorted(changes)} of {doc['_id']}: {response}")
+    return {"updated_ids": [str(doc["_id"])], "changed_fields": sorted(changes)}
+
+
+WRITE_HANDLERS = {"save": ingest_message, "update": update_message}
+
+# Saves handed to the job queue and not finished yet, by tenant and message
+# id. An edit sent seconds after its message would otherwise run while the
+# save is still being enriched, find no note and be saved as a second one.
+_saves_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _message_key(payload):
+    return payload.get("tenant"), str(payload["message_id"])
+
+
+def _save_in_flight(payload):
+    with _in_flight_lock:
+        return _saves_in_flight.get(_message_key(payload))
+
+
+def _submit_write(kind, payload, func, job_payload):
+    """job_queue.submit for a write; a save is tracked until its job ends.
+
+    Raises:
+        jobs.QueueFullError: if the job queue is full
+    """
+    if kind != "save":
+        return job_queue.submit(func, job_payload)
+    key = _message_key(payload)
+    done = threading.Event()
+    with _in_flight_lock:
+        _saves_in_flight[key] = done
+
+    def finished():
+        done.set()
+        with _in_flight_lock:
+            if _saves_in_flight.get(key) is done:
+                del _saves_in_flight[key]
+
+    def job(job_payload, progress):
+        try:
+            return func(job_payload, progress)
+        finally:
+            finished()
+
+    try:
+        return job_queue.submit(job, job_payload)
+    except jobs.QueueFullError:
+        finished()
+        raise
+
+
+def run_write(kind, payload, progress):
+    # Jobs run in a copy of the request's context; they get their own deadline
+    # and wait behind asks for OpenAI
+    with resilience.deadline(SAVE_DEADLINE, inherit=False), rate_limiter.lane("ingest"):
+        done = _save_in_flight(payload) if kind == "update" else None
+        if done is not None and not done.is_set():
+            progress("waiting for save")
+            if not done.wait(resilience.remaining()):
+                raise resilience.DeadlineExceeded(
+                    f"Save of message {payload['message_id']} still running"
+                )
+        return WRITE_HANDLERS[kind](payload, progress)
+
+
+def accept_write(kind, payload, tenant):
+    """Record a save or update for the tenant and queue it for processing.
+
+    With the save log enabled the write is committed to it before this
+    returns, so it is never lost: if the job queue is full it is left for the
+    replayer, and a failed attempt is retried with backoff.
+
+    Returns:
+        dict: job_id (None when deferred to the replayer), save_id, status
+
+    Raises:
+        NotReadyError: without the save log, until the database is connected
+    """
+    payload = {**payload, "tenant": tenant.tenant_id}
+    log = conn_d.get("save_log")
+    if log is None:
+        check_connected(tenant)
+        job_id = _submit_write(
+            kind, payload, functools.partial(run_write, kind), payload
+        )
+        return {"job_id": job_id, "save_id": None, "status": "queued"}
+
+    if kind == "save":
+        payload = {**payload, "_id": str(api.uuid8())}
+    if tenant.collection is None:
+        save_id = log.append(kind, payload)
+        lg(f"Not connected to the database yet, save {save_id} left for the replayer")
+        return {"job_id": None, "save_id": save_id, "status": "deferred"}
+    if (
+        kind == "update"
+        and _save_in_flight(payload) is None
+        and log.has_unfinished_save(payload)
+    ):
+        # The save is waiting in the log (or running in another process); the
+        # replayer holds updates until the save before them is done
+        save_id = log.append(kind, payload)
+        lg(f"Message {payload['message_id']} not saved yet, update {save_id} deferred")
+        return {"job_id": None, "save_id": save_id, "status": "deferred"}
+    save_id = log.append(kind, payload, claimed=True)
+    entry = log.get(save_id)
+    try:
+        job_id = _submit_write(kind, payload, process_logged, entry)
+    except jobs.QueueFullError:
+        log.release([save_id])
+        lg(f"Ingestion queue is full, save {save_id} left for the replayer")
+        return {"job_id": None, "save_id": save_id, "status": "deferred"}
+    return {"job_id": job_id, "save_id": save_id, "status": "queued"}
+
+
+def process_logged(entry, progress):
+    """Job function for a save log entry: run it and record the outcome."""
+    log = conn_d["save_log"]
+    save_id = entry["save_id"]
+    try:
+        result = run_write(entry["kind"], entry["payload"], progress)
+    except Exception as e:
+        delay = log.fail(save_id, e)
+        if delay is None:
+            logger.error(f"Save {save_id} failed for good: {e}")
+            raise
+        logger.warning(f"Save {save_id} failed, retrying in {delay:.0f}s: {e}")
+        return {"save_id": save_id, "deferred": True, "retry_in_s": round(delay)}
+    log.complete(save_id, result)
+    return {**result, "save_id": save_id}
+
+
+def replay_saves(log, interval=5, prune_every=3600):
+    """Feed due save log entries to the job queue, in arrival order."""
+    last_prune = 0.0
+    while True:
+        claimed = []
+        try:
+            if time.time() - last_prune > prune_every:
+                log.prune()
+                last_prune = time.time()
+            # Leave room for new requests in the job queue
+            room = job_queue.capacity() - SAVE_BATCH_SIZE
+            if room > 0 and readiness["collection"]:
+                claimed = log.claim(limit=room)
+            for i, entry in enumerate(claimed):
+                try:
+                    _submit_write(
+                        entry["kind"], entry["payload"], process_logged, entry
+                    )
+                except jobs.QueueFullError:
+                    log.release([e["save_id"] for e in claimed[i:]])
+                    break
+            if claimed:
+                lg(f"Replaying {len(claimed)} saves from the save log")
+        except Exception as e:
+            logger.warning(f"Save log replay failed: {e}")
+        # Keep draining while there is a backlog
+        time.sleep(interval if len(claimed) < SAVE_BATCH_SIZE else 0.1)
+
+
+def collect_stats():
+    response = {
+        "embedding_cache": llm_helper.embedding_cache.stats(),
+        "jobs": job_queue.stats(),
+        "openai_connections": clients.connection_stats(),
+        "dependencies": resilience.stats(),
+        "openai_limiter": rate_limiter.stats(),
+    }
+    if save_batcher is not None:
+        response["save_batcher"] = save_batcher.stats()
+    if conn_d.get("save_log") is not None:
+        response["save_log"] = conn_d["save_log"].stats()
+    if conn_d.get("tenants") is not None:
+        response["tenants"] = {
+            tenant.tenant_id: tenant.stats() for tenant in conn_d["tenants"].all()
+        }
+    return response
+
+
+def render_metrics():
+    # Numeric /stats values are exposed as gauges next to the stage histograms
+    gauges = {}
+    stats = collect_stats()
+    for component, values in stats.items():
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                labels = (("component", component), ("name", name))
+                gauges[("rag_component_stat", labels)] = value
+    for tenant_id, components in stats.get("tenants", {}).items():
+        for component, values in components.items():
+            if not isinstance(values, dict):
+                continue
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    labels = (
+                        ("tenant", tenant_id),
+                        ("component", component),
+                        ("name", name),
+                    )
+                    gauges[("rag_tenant_stat", labels)] = value
+    for kind, values in stats["openai_limiter"].items():
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                labels = (("kind", kind), ("name", name))
+                gauges[("rag_openai_limiter_stat", labels)] = value
+    for dependency, values in resilience.stats().items():
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                labels = (("dependency", dependency), ("name", name))
+                gauges[("rag_dependency_stat", labels)] = value
+    return tracing.render_metrics(gauges)
+
+
+def check_answer_cache(tenant, embedding):
+    # Near-repeat questions are answered from the tenant's semantic cache
+    cache = tenant.answer_cache
+    if cache is not None and embedding is not None:
+        cached = cache.lookup(embedding)
+        if cached is not None:
+            lg("Answered from semantic cache")
+            return cached
+    return None
+
+
+def embed_and_check_cache(tenant, text):
+    """Embed the question and look for a near-repeat in the semantic cache.
+
+    Returns:
+        tuple: (embedding, cached answer or None)
+    """
+    with tracing.span("ask.embed"):
+        embedding = llm_helper.vectorize_text(text, llm_helper.initialize_embeddings())
+    return embedding, check_answer_cache(tenant, embedding)
+
+
+async def aembed_and_check_cache(tenant, text):
+    """Async counterpart of embed_and_check_cache."""
+    with tracing.span("ask.embed"):
+        embedding = await llm_helper.avectorize_text(
+            text, llm_helper.initialize_embeddings()
+        )
+    return embedding, check_answer_cache(tenant, embedding)
+
+
+def log_retrieved(docs):
+    lg(f"Retrieved {[(str(doc.id), doc.title) for doc in docs]}")
+
+
+def retrieve_docs(tenant, text, embedding):
+    docs = api.retrieve_hybrid_search(
+        text=text,
+        top_n=RETRIEVAL_TOP_N,
+        collection=tenant.collection,
+        index=tenant.index,
+        embedding=embedding,
+        router=tenant.router,
+        lexical=tenant.lexical,
+        fast_path=False,
+    )
+    log_retrieved(docs)
+    return docs
+
+
+async def aretrieve_docs(tenant, text, embedding):
+    docs = await api.aretrieve_hybrid_search(
+        text=text,
+        top_n=RETRIEVAL_TOP_N,
+        collection=tenant.async_collection,
+        index=tenant.index,
+        embedding=embedding,
+        router=tenant.router,
+        lexical=tenant.lexical,
+        fast_path=False,
+    )
+    log_retrieved(docs)
+    return docs
+
+
+def prepare_answer(tenant, text):
+    """Find what is needed to answer a question from the tenant's notes.
+
+    Quoted-phrase and name lookups go straight to the lexical index,
+    skipping the embedding and the semantic cache; every other question is
+    answered from vector results fused with the lexical ones.
+
+    Returns:
+        tuple: (embedding, cached answer, docs). Either the cached answer or
+            docs is set; embedding is None on the lexical fast path.
+    """
+    docs = api.lexical_fast_path(tenant.lexical, text, top_n=RETRIEVAL_TOP_N)
+    if docs:
+        log_retrieved(docs)
+        return None, None, docs
+    embedding, cached = embed_and_check_cache(tenant, text)
+    if cached is not None:
+        return embedding, cached, None
+    return embedding, None, retrieve_docs(tenant, text, embedding)
+
+
+async def aprepare_answer(tenant, text):
+    """Async counterpart of prepare_answer."""
+    docs = api.lexical_fast_path(tenant.lexical, text, top_n=RETRIEVAL_TOP_N)
+    if docs:
+        log_retrieved(docs)
+        return None, None, docs
+    embedding, cached = await aembed_and_check_cache(tenant, text)
+    if cached is not None:
+        return embedding, cached, None
+    return embedding, None, await aretrieve_docs(tenant, text, embedding)
+
+
+def cache_answer(tenant, embedding, response, docs):
+    cache = tenant.answer_cache
+    if cache is not None and embedding is not None:
+        # Lexical matches aren't limited to the query's domain, so a note in
+        # any domain could change an answer that used them
+        lexical = tenant.lexical is not None and tenant.lexical.is_fresh()
+        cache.store(embedding, response, docs, any_domain=lexical)
+
+
+def keep_alive(interval=300):
+    while True:
+        # Any collection will do: this keeps the database awake
+        open_tenants = [t for t in conn_d["tenants"].all() if t.collection is not None]
+        if open_tenants:
+            api.liveness_check(open_tenants[0].collection)
+        time.sleep(interval)
+
+
+def keep_mirrors_fresh(tenant, interval=60):
+    # Rebuild every scannable mirror from one full scan whenever any is stale.
+    # Retrieval falls back to Astra / the LLM until then. Notes saved while
+    # the scan runs are re-added after the rebuild (see begin_build).
+    while not tenant.closed:
+        if not all(mirror.is_fresh() for mirror in tenant.scanned):
+            try:
+                for mirror in tenant.scanned:
+                    mirror.begin_build()
+                docs = list(api.scan_collection(tenant.collection))
+                for mirror in tenant.scanned:
+                    mirror.build(docs)
+            except Exception as e:
+                logger.warning(
+                    f"Failed to build local mirrors of {tenant.tenant_id}: {e}"
+                )
+        time.sleep(interval)
@@ -0,0 +1,175 @@
+import json
+import os
+import re
+import threading
+import time
+
+from loguru import logger
+
+lg = logger.info
+
+# Tenants and the collection each one's notes live in, read from the
+# tenants.json at the root of the repo, which tele_service reads too (the
+# Dockerfile copies it into both images; mount over it to edit it live):
+#
+#     {"tenants": {"default": {"collection": "core_messages", ...}, "alice": {}}}
+#
+# A tenant without a collection gets notes_<tenant_id>. Every tenant has its
+# own Astra collection and its own caches and local indexes, so a large corpus
+# never sits in the path of another tenant's searches. The file is re-read
+# when it changes, so tenants can be added without a restart.
+
+DEFAULT_TENANT = "default"
+DEFAULT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "tenants.json"
+)
+_NAME = re.compile(r"^[A-Za-z0-9_]{1,48}$")
+
+
+class UnknownTenantError(Exception):
+    pass
+
+
+def load(path, default_collection):
+    """Read the tenants file into {tenant_id: collection name}.
+
+    Without a file there is a single tenant, DEFAULT_TENANT, whose notes are
+    in default_collection.
+
+    Raises:
+        ValueError: if the file isn't valid JSON, a tenant id or collection
+            name isn't a valid Astra name, or two tenants share a collection
+    """
+    if not path or not os.path.exists(path):
+        return {DEFAULT_TENANT: default_collection}
+    with open(path, "r") as file:
+        config = json.load(file)
+    tenants = {}
+    for tenant_id, options in (config.get("tenants") or {}).items():
+        name = (options or {}).get("collection")
+        if name is None:
+            name = (
+                default_collection
+                if tenant_id == DEFAULT_TENANT
+                else f"notes_{tenant_id}"
+            )
+        for value in (tenant_id, name):
+            if not _NAME.match(value):
+                raise ValueError(f"Invalid name {value!r} for tenant {tenant_id!r}")
+        if name in tenants.values():
+            raise ValueError(f"Tenant {tenant_id!r} shares collection {name!r}")
+        tenants[tenant_id] = name
+    return tenants
+
+
+class Tenant:
+    """One tenant's collection handles and the local mirrors built from it."""
+
+    def __init__(self, tenant_id, collection_name):
+        self.tenant_id = tenant_id
+        self.collection_name = collection_name
+        self.collection = None
+        self.async_collection = None
+        self.answer_cache = None
+        self.index = None
+        self.router = None
+        self.lexical = None
+        self.mirrors = []
+        # Mirrors that are built from a full scan of the collection
+        self.scanned = []
+        self.schema_checked = False
+        # Set once the tenant is removed from the file; its threads stop
+        self.closed = False
+
+    def stats(self):
+        stats = {
+            "collection": self.collection_name,
+            "connected": self.collection is not None,
+            "schema_checked": self.schema_checked,
+        }
+        for name, mirror in (
+            ("answer_cache", self.answer_cache),
+            ("vector_index", self.index),
+            ("domain_router", self.router),
+            ("lexical_index", self.lexical),
+        ):
+            if mirror is not None:
+                stats[name] = mirror.stats()
+        return stats
+
+
+class TenantRegistry:
+    """The tenants in the tenants file, re-read when the file changes.
+
+    The file's modification time is checked at most every check_every
+    seconds, on lookup. New tenants are created with factory(tenant_id,
+    collection_name); a tenant that is removed or moved to another collection
+    is marked closed. If the file fails to parse the error is logged and the
+    current tenants are kept.
+    """
+
+    def __init__(self, path, default_collection, factory=Tenant, check_every=5.0):
+        self.path = path
+        self.default_collection = default_collection
+        self.factory = factory
+        self.check_every = check_every
+        self._tenants = {}
+        self._mtime = None
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.reload()
+
+    def get(self, tenant_id=None):
+        """The tenant with this id; None means DEFAULT_TENANT.
+
+        Raises:
+            UnknownTenantError: if there is no such tenant
+        """
+        self._check_file()
+        tenant = self._tenants.get(tenant_id or DEFAULT_TENANT)
+        if tenant is None:
+            raise UnknownTenantError(f"Unknown tenant: {tenant_id or DEFAULT_TENANT}")
+        return tenant
+
+    def all(self):
+        self._check_file()
+        return list(self._tenants.values())
+
+    def reload(self):
+        with self._lock:
+            self._mtime = self._file_mtime()
+            try:
+                config = load(self.path, self.default_collection)
+            except (OSError, ValueError) as e:
+                logger.error(
+                    f"Could not load {self.path}, keeping current tenants: {e}"
+                )
+                return
+            tenants = {}
+            for tenant_id, name in config.items():
+                tenant = self._tenants.get(tenant_id)
+                if tenant is None or tenant.collection_name != name:
+                    tenant = self.factory(tenant_id, name)
+                tenants[tenant_id] = tenant
+            removed = [
+                tenant
+                for tenant_id, tenant in self._tenants.items()
+                if tenants.get(tenant_id) is not tenant
+            ]
+            self._tenants = tenants
+        for tenant in removed:
+            tenant.closed = True
+        lg(f"Tenants: {', '.join(f'{t} -> {n}' for t, n in config.items())}")
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime if self.path else None
+        except OSError:
+            return None
+
+    def _check_file(self):
+        if time.monotonic() - self._checked_at < self.check_every:
+            return
+        self._checked_at = time.monotonic()
+        if self._file_mtime() != self._mtime:
+            self.reload()
@@ -0,0 +1,153 @@
+import contextvars
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from loguru import logger
+
+# In-process record of how long each pipeline stage and external call takes.
+# Stage names are dotted, e.g. "save.enrich", "llm.generate" or "astra.find".
+# Durations feed Prometheus-style histograms (rendered by render_metrics) and
+# a window of the most recent MAX_SAMPLES raw samples per stage for the
+# benchmarks.
+
+MAX_SAMPLES = 10_000
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_histograms = {}
+_counters = defaultdict(float)
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def set_request_id(request_id):
+    request_id_var.set(request_id or new_request_id())
+    return request_id_var.get()
+
+
+def get_request_id():
+    return request_id_var.get()
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment("rag_stage_errors_total", stage=name)
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        record(name, duration_ms)
+        logger.debug(f"[{get_request_id()}] span {name}: {duration_ms:.1f} ms")
+
+
+def record(name, duration_ms):
+    with _lock:
+        _samples[name].append(duration_ms)
+    observe("rag_stage_duration_seconds", duration_ms / 1000, stage=name)
+
+
+def observe(metric, value, **labels):
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                "buckets": [0] * len(BUCKETS),
+                "sum": 0.0,
+                "count": 0,
+            }
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def increment(metric, amount=1, **labels):
+    with _lock:
+        _counters[(metric, tuple(sorted(labels.items())))] += amount
+
+
+def record_usage(prompt, usage):
+    """Count the token usage reported on an OpenAI response."""
+    if usage is None:
+        return
+    increment("rag_llm_tokens_total", usage.prompt_tokens, prompt=prompt, type="prompt")
+    increment(
+        "rag_llm_tokens_total",
+        usage.completion_tokens or 0,
+        prompt=prompt,
+        type="completion",
+    )
+
+
+def samples():
+    """Return {stage: [duration_ms, ...]} for every stage seen so far."""
+    with _lock:
+        return {name: list(durations) for name, durations in _samples.items()}
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+        _histograms.clear()
+        _counters.clear()
+
+
+def _labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+def render_metrics(gauges=None):
+    """Render histograms, counters and optional gauges in Prometheus text format.
+
+    Args:
+        gauges (dict): {(metric, labels tuple): value} to expose as gauges
+    """
+    lines = []
+    with _lock:
+        histograms = {
+            k: dict(v, buckets=list(v["buckets"])) for k, v in _histograms.items()
+        }
+        counters = dict(_counters)
+
+    seen = set()
+    for (metric, labels), histogram in sorted(histograms.items()):
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} histogram")
+            seen.add(metric)
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            lines.append(f"{metric}_bucket{_labels(labels, le=bound)} {count}")
+        lines.append(
+            f'{metric}_bucket{_labels(labels, le="+Inf")} {histogram["count"]}'
+        )
+        lines.append(f"{metric}_sum{_labels(labels)} {histogram['sum']:.6f}")
+        lines.append(f"{metric}_count{_labels(labels)} {histogram['count']}")
+
+    for (metric, labels), value in sorted(counters.items()):
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} counter")
+            seen.add(metric)
+        lines.append(f"{metric}{_labels(labels)} {value:g}")
+
+    for (metric, labels), value in sorted((gauges or {}).items()):
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} gauge")
+            seen.add(metric)
+        lines.append(f"{metric}{_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
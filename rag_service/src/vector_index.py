@@ -0,0 +1,218 @@
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+from records import DocRecord
+
+lg = logger.info
+
+
+def reduce_dimensions(vectors, dim):
+    """Shorten text-embedding-3 vectors to their first dim components.
+
+    The models are trained so that a prefix of the embedding, re-normalized,
+    is itself an embedding; this is what the API returns when asked for
+    `dimensions=dim`, so the short vector needs no second embeddings call.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)[..., :dim]
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def rerank(vector, docs, vectors, top_n):
+    """Reorder candidate docs by dot product with their full vectors.
+
+    Args:
+        docs (list): DocRecords
+        vectors (dict): _id -> full $vector. Candidates without one (deleted
+            since the index was built) are dropped.
+
+    Returns:
+        list: the top_n records, with similarity set to the full-vector score
+    """
+    kept = [doc for doc in docs if vectors.get(doc.id) is not None]
+    if not kept:
+        return []
+    matrix = np.asarray([vectors[doc.id] for doc in kept], dtype=np.float32)
+    scores = matrix @ np.asarray(vector, dtype=np.float32)
+    order = np.argsort(-scores)[:top_n]
+    return [kept[i].replace(similarity=float(scores[i])) for i in order]
+
+
+class LocalVectorIndex:
+    """In-process mirror of a collection's vectors for brute-force top-k search.
+
+    Vectors live in one contiguous float32 (or float16) matrix, one row per
+    document, so a query is a single vectorized dot product. Documents are kept
+    alongside as hydrated DocRecords so results can be served without going
+    back to Astra. The index is built from a full scan and kept in sync by
+    calling add() after every insert. It reports itself stale until the first
+    build completes and again once max_age seconds have passed since then,
+    so that writes from other processes are eventually picked up.
+    """
+
+    def __init__(self, dim=1536, dtype="float32", max_age=3600):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.max_age = max_age
+        self.synced_at = None
+        self._lock = threading.RLock()
+        self._added = None
+        self._reset()
+
+    def _reset(self):
+        self._matrix = np.zeros((0, self.dim), dtype=self.dtype)
+        self._size = 0
+        self._docs = []
+        self._rows = {}
+        self._domains = np.zeros(0, dtype=np.int32)
+        self._domain_codes = {}
+
+    def __len__(self):
+        return self._size
+
+    def is_fresh(self):
+        if self.synced_at is None:
+            return False
+        return self.max_age is None or time.time() - self.synced_at < self.max_age
+
+    def build(self, docs):
+        """Rebuild the index from an iterable of documents (with $vector)."""
+        start = time.perf_counter()
+        fresh = self._empty()
+        fresh.add(docs)
+        with self._lock:
+            self._matrix = fresh._matrix
+            self._size = fresh._size
+            self._docs = fresh._docs
+            self._rows = fresh._rows
+            self._domains = fresh._domains
+            self._domain_codes = fresh._domain_codes
+            added, self._added = self._added, None
+            if added:
+                self.add(added)
+            self.synced_at = time.time()
+        lg(
+            f"Local vector index built: {self._size} docs in "
+            f"{(time.perf_counter() - start) * 1000:.0f} ms"
+        )
+
+    def begin_build(self):
+        """Remember the docs add()ed from now on, to re-add them after build().
+
+        Call it before scanning the collection for build(): the scan may not
+        see docs inserted while it runs, and build() would drop them.
+        """
+        with self._lock:
+            self._added = []
+
+    def _empty(self):
+        return LocalVectorIndex(self.dim, self.dtype, self.max_age)
+
+    def _row_vector(self, vector):
+        return vector
+
+    def stats(self):
+        with self._lock:
+            return {
+                "docs": self._size,
+                "dim": self.dim,
+                "dtype": self.dtype.name,
+                "matrix_bytes": int(self._matrix[: self._size].nbytes),
+                "fresh": self.is_fresh(),
+            }
+
+    def add(self, docs):
+        docs = list(docs)
+        with self._lock:
+            if self._added is not None:
+                self._added.extend(docs)
+            for doc in docs:
+                vector = doc.get("$vector")
+                if vector is None:
+                    continue
+                row = self._rows.get(doc["_id"])
+                if row is None:
+                    row = self._size
+                    self._grow(row + 1)
+                    self._rows[doc["_id"]] = row
+                    self._docs.append(None)
+                    self._size += 1
+                self._matrix[row] = self._row_vector(vector)
+                self._docs[row] = DocRecord.from_doc(doc)
+                self._domains[row] = self._domain_code(doc.get("domain"))
+
+    def set_reference_urls(self, urls):
+        """Store the reference_url written back for docs, from {_id: url}."""
+        with self._lock:
+            for doc_id, url in urls.items():
+                row = self._rows.get(doc_id)
+                if row is not None:
+                    self._docs[row] = self._docs[row].replace(reference_url=url)
+
+    def search(self, vector, top_n, domain=None):
+        """Return the top_n DocRecords by dot product, optionally within a domain."""
+        query = np.asarray(self._row_vector(vector), dtype=np.float32)
+        with self._lock:
+            # Scoring every row and masking is cheaper than gathering a
+            # domain's rows into a new matrix first
+            scores = self._matrix[: self._size] @ query
+            rows = np.arange(self._size)
+            if domain:
+                code = self._domain_codes.get(domain)
+                if code is None:
+                    return []
+                rows = np.flatnonzero(self._domains[: self._size] == code)
+                scores = scores[rows]
+            if len(rows) == 0:
+                return []
+            k = min(top_n, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                self._docs[rows[i]].replace(similarity=float(scores[i])) for i in top
+            ]
+
+    def _grow(self, size):
+        capacity = self._matrix.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2, 64)
+        matrix = np.zeros((capacity, self.dim), dtype=self.dtype)
+        matrix[: self._size] = self._matrix[: self._size]
+        domains = np.zeros(capacity, dtype=np.int32)
+        domains[: self._size] = self._domains[: self._size]
+        self._matrix = matrix
+        self._domains = domains
+
+    def _domain_code(self, domain):
+        code = self._domain_codes.get(domain)
+        if code is None:
+            code = len(self._domain_codes)
+            self._domain_codes[domain] = code
+        return code
+
+
+class ReducedVectorIndex(LocalVectorIndex):
+    """First stage of two-stage retrieval: a LocalVectorIndex of short vectors.
+
+    Keeps only the first dim components of each embedding (see
+    reduce_dimensions), so the mirror is 1536 / dim times smaller than a
+    full LocalVectorIndex. Its ranking is approximate: callers search for
+    `candidates` docs and rerank those with their full vectors (see
+    api.vector_search).
+    """
+
+    def __init__(self, dim=256, dtype="float32", max_age=3600, candidates=40):
+        self.candidates = candidates
+        super().__init__(dim=dim, dtype=dtype, max_age=max_age)
+
+    def _empty(self):
+        return ReducedVectorIndex(self.dim, self.dtype, self.max_age, self.candidates)
+
+    def _row_vector(self, vector):
+        return reduce_dimensions(vector, self.dim)
+
+    def stats(self):
+        return {**super().stats(), "candidates": self.candidates}
@@ -0,0 +1,68 @@
+import pytest
+
+import answer_cache
+from records import DocRecord
+
+QUESTION = [1.0, 0.0, 0.0]
+SAME_QUESTION = [0.95, 0.05, 0.0]
+OTHER_QUESTION = [0.0, 1.0, 0.0]
+
+
+@pytest.fixture
+def cache():
+    return answer_cache.SemanticAnswerCache(threshold=0.9, max_entries=2)
+
+
+def store(cache, docs=(("n1", "life"),), **kwargs):
+    records = [DocRecord(doc_id, domain=domain) for doc_id, domain in docs]
+    cache.store(QUESTION, "answer", records, **kwargs)
+
+
+def test_a_similar_question_hits(cache):
+    store(cache)
+    assert cache.lookup(SAME_QUESTION) == "answer"
+    assert cache.stats()["hits"] == 1
+
+
+def test_a_different_question_misses(cache):
+    assert cache.lookup(QUESTION) is None
+    store(cache)
+    assert cache.lookup(OTHER_QUESTION) is None
+    assert cache.stats()["misses"] == 2
+
+
+def test_the_least_recently_used_answer_is_evicted(cache):
+    store(cache)
+    cache.store(OTHER_QUESTION, "other", [DocRecord("n2", domain="life")])
+    assert cache.lookup(QUESTION) == "answer"
+    cache.store([0.0, 0.0, 1.0], "third", [DocRecord("n3", domain="life")])
+    assert cache.lookup(OTHER_QUESTION) is None
+    assert cache.lookup(QUESTION) == "answer"
+
+
+@pytest.mark.parametrize(
+    "inserted",
+    [
+        {"_id": "n1", "domain": "lessons"},
+        {"_id": "n2", "domain": "life"},
+    ],
+)
+def test_a_note_of_the_same_doc_or_domain_invalidates(cache, inserted):
+    store(cache)
+    cache.add([inserted])
+    assert cache.lookup(QUESTION) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_a_note_of_another_domain_keeps_the_answer(cache):
+    store(cache)
+    cache.add([{"_id": "n2", "domain": "lessons"}])
+    assert cache.lookup(QUESTION) == "answer"
+
+
+# Lexical matches aren't filtered by domain; no docs means nothing matched
+@pytest.mark.parametrize("kwargs", [{"any_domain": True}, {"docs": ()}])
+def test_an_answer_open_to_any_domain_is_dropped_on_every_insert(cache, kwargs):
+    store(cache, **kwargs)
+    cache.add([{"_id": "n2", "domain": "lessons"}])
+    assert cache.lookup(QUESTION) is None
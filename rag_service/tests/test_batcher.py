@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+
+import batcher
+
+
+class Handler:
+    """Records each batch and answers item * 10, or the item if it's an error."""
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        if self.error is not None:
+            raise self.error
+        return [item if isinstance(item, Exception) else item * 10 for item in items]
+
+
+def test_a_full_batch_is_flushed_without_waiting():
+    handler = Handler()
+    micro = batcher.MicroBatcher(handler, max_items=3, max_wait=10)
+    start = time.monotonic()
+    futures = [micro.submit(i) for i in range(3)]
+    assert [future.result(timeout=2) for future in futures] == [0, 10, 20]
+    assert time.monotonic() - start < 2
+    assert handler.batches == [[0, 1, 2]]
+
+
+def test_a_partial_batch_is_flushed_after_max_wait():
+    handler = Handler()
+    micro = batcher.MicroBatcher(handler, max_items=100, max_wait=0.05)
+    futures = [micro.submit(i) for i in range(2)]
+    assert [future.result(timeout=2) for future in futures] == [0, 10]
+    assert handler.batches == [[0, 1]]
+    assert micro.stats()["mean_batch"] == 2
+
+
+def test_items_from_many_threads_share_batches():
+    handler = Handler()
+    micro = batcher.MicroBatcher(handler, max_items=8, max_wait=0.1)
+    results = {}
+
+    def submit(i):
+        results[i] = micro.submit(i).result(timeout=2)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {i: i * 10 for i in range(8)}
+    assert len(handler.batches) < 8
+
+
+def test_an_item_error_fails_only_that_item():
+    micro = batcher.MicroBatcher(Handler(), max_items=3, max_wait=10)
+    futures = [micro.submit(1), micro.submit(ValueError("bad note")), micro.submit(3)]
+    assert futures[0].result(timeout=2) == 10
+    with pytest.raises(ValueError, match="bad note"):
+        futures[1].result(timeout=2)
+    assert futures[2].result(timeout=2) == 30
+    assert micro.stats()["failed_items"] == 1
+
+
+def test_a_handler_error_reaches_every_caller():
+    micro = batcher.MicroBatcher(
+        Handler(error=ConnectionError("Astra down")), max_items=2, max_wait=10
+    )
+    futures = [micro.submit(1), micro.submit(2)]
+    for future in futures:
+        with pytest.raises(ConnectionError, match="Astra down"):
+            future.result(timeout=2)
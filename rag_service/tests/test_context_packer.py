@@ -0,0 +1,90 @@
+import pytest
+
+import context_packer
+from records import DocRecord
+
+MODEL = "gpt-4o-mini"
+
+
+@pytest.fixture(params=["estimate", "tiktoken"])
+def tokenizer(request, monkeypatch):
+    if request.param == "estimate":
+        monkeypatch.setattr(context_packer, "_encoding", lambda model: None)
+    elif not context_packer.load_tokenizer(MODEL):
+        pytest.skip("tiktoken can't load its files here")
+    return request.param
+
+
+def doc(i, content):
+    return DocRecord(
+        f"n{i}",
+        message_id=i,
+        title=f"Note {i}",
+        update_ts="2024-07-01",
+        content=content,
+    )
+
+
+def packer(max_tokens, passage_tokens=50):
+    return context_packer.ContextPacker(
+        max_tokens=max_tokens, passage_tokens=passage_tokens, model=MODEL
+    )
+
+
+def count(text):
+    return context_packer.count_tokens(text, MODEL)
+
+
+def test_the_context_fits_the_budget(tokenizer):
+    docs = [
+        doc(i, "\n\n".join(f"Paragraph {j} of note {i} about gym." for j in range(20)))
+        for i in range(10)
+    ]
+    context, stats = packer(300).pack("gym", docs)
+    assert count(context) <= 300
+    assert stats["tokens"] <= 300
+    assert stats["docs"] >= 2
+
+
+def test_each_doc_gets_its_most_relevant_passage_first(tokenizer):
+    notes = [
+        doc(1, "Groceries: eggs and milk.\n\nSquats on Monday, deadlifts on Friday."),
+        doc(2, "Lunch with Priya.\n\nShe recommended a deadlifts coach."),
+    ]
+    header_tokens = sum(count(packer(0).header(note)) for note in notes)
+    # Room for exactly the one passage of each doc that mentions deadlifts
+    budget = (
+        header_tokens
+        + count("\n---\n")
+        + count("Squats on Monday, deadlifts on Friday.\n")
+        + count("She recommended a deadlifts coach.\n")
+    )
+    context, stats = packer(budget).pack("deadlifts", notes)
+    assert "deadlifts on Friday" in context
+    assert "deadlifts coach" in context
+    assert "Groceries" not in context
+    assert stats["passages"] == 2
+
+
+def test_the_passage_that_crosses_the_budget_is_truncated(tokenizer):
+    note = doc(1, " ".join(f"word{i}" for i in range(400)))
+    budget = count(packer(0).header(note)) + 20
+    context, stats = packer(budget, passage_tokens=1000).pack("word1", [note])
+    assert stats["truncated"] == 1
+    assert context.endswith(" ...")
+    assert count(context) <= budget
+
+
+def test_long_paragraphs_are_split_by_sentence(tokenizer):
+    text = " ".join(f"Sentence number {i} is here." for i in range(40))
+    passages = context_packer.split_passages(text, 30, MODEL)
+    assert len(passages) > 1
+    assert all(count(passage) <= 30 for passage in passages)
+    assert " ".join(passages) == text
+
+
+def test_near_duplicate_passages_are_packed_once(tokenizer):
+    text = "Squats on Monday, deadlifts on Friday."
+    context, stats = packer(500).pack("squats", [doc(1, text), doc(2, text)])
+    assert context.count(text) == 1
+    assert stats["duplicates"] == 1
@@ -0,0 +1,44 @@
+import pytest
+
+import api
+import domain_router
+
+
+def vector(*components):
+    return [*components, *[0.0] * (4 - len(components))]
+
+
+@pytest.fixture
+def router():
+    router = domain_router.DomainRouter(dim=4, min_docs=2)
+    router.build(
+        [
+            {"_id": i, "domain": domain, "$vector": vector(*v)}
+            for i, (domain, v) in enumerate(
+                [
+                    ("life", (1.0, 0.1)),
+                    ("life", (0.9, 0.0)),
+                    ("lessons", (0.0, 1.0)),
+                    ("lessons", (0.1, 0.9)),
+                ]
+            )
+        ]
+    )
+    return router
+
+
+def test_a_query_is_routed_to_the_nearest_centroid(router):
+    assert router.route(vector(0.1, 1.0), lambda: "asked the LLM") == "lessons"
+    assert router.route(vector(0.0, 0.0, 1.0), lambda: "asked the LLM") == (
+        "asked the LLM"
+    )
+
+
+def test_a_saved_doc_keeps_the_domain_enrichment_gave_it(router):
+    doc = {"raw_content": "a note", "domain": "life", "$vector": vector(0.0, 1.0)}
+    assert api.stored_domain(doc, router=router) == "life"
+
+
+def test_the_router_stands_in_when_enrichment_gave_no_domain(router):
+    doc = {"raw_content": "a note", "domain": None, "$vector": vector(0.0, 1.0)}
+    assert api.stored_domain(doc, router=router) == "lessons"
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import embedding_cache
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "embeddings.sqlite3")
+
+
+def test_texts_differing_only_in_whitespace_share_an_entry():
+    cache = embedding_cache.EmbeddingCache()
+    cache.put("small", "lunch  with\nPriya ", [1.0, 2.0])
+    assert cache.get("small", "lunch with Priya").tolist() == [1.0, 2.0]
+    assert cache.get("large", "lunch with Priya") is None
+
+
+def test_the_least_recently_used_vector_is_evicted():
+    cache = embedding_cache.EmbeddingCache(max_entries=2)
+    cache.put("m", "a", [1.0])
+    cache.put("m", "b", [2.0])
+    assert cache.get("m", "a") is not None
+    cache.put("m", "c", [3.0])
+    assert cache.get("m", "b") is None
+    assert cache.get("m", "a") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_vectors_survive_a_restart(db_path):
+    embedding_cache.EmbeddingCache(db_path=db_path).put("m", "a", [0.5, 0.25])
+
+    cache = embedding_cache.EmbeddingCache(db_path=db_path)
+    vector = cache.get("m", "a")
+    assert vector.dtype == np.float32
+    assert vector.tolist() == [0.5, 0.25]
+    assert cache.get("m", "a") is not None
+    assert cache.stats()["disk_hits"] == 1
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_an_evicted_vector_is_read_back_from_disk(db_path):
+    cache = embedding_cache.EmbeddingCache(max_entries=1, db_path=db_path)
+    cache.put("m", "a", [1.0])
+    cache.put("m", "b", [2.0])
+    assert cache.get("m", "a").tolist() == [1.0]
+    assert cache.stats()["disk_hits"] == 1
@@ -0,0 +1,39 @@
+import asyncio
+
+import api
+
+
+class Collection:
+    def __init__(self):
+        self.requests = []
+
+    def find(self, filter, limit, **kwargs):
+        ids = filter["_id"]["$in"]
+        assert len(ids) <= api.IN_LIMIT and limit == len(ids)
+        self.requests.append(len(ids))
+        return [{"_id": i, "$vector": [float(i)]} for i in ids]
+
+
+class AsyncCollection(Collection):
+    def find(self, filter, limit, **kwargs):
+        docs = super().find(filter, limit, **kwargs)
+
+        async def cursor():
+            for doc in docs:
+                yield doc
+
+        return cursor()
+
+
+def test_fetch_vectors_splits_the_ids():
+    collection = Collection()
+    vectors = api.fetch_vectors(collection, list(range(250)))
+    assert collection.requests == [100, 100, 50]
+    assert vectors == {i: [float(i)] for i in range(250)}
+
+
+def test_afetch_vectors_splits_the_ids():
+    collection = AsyncCollection()
+    vectors = asyncio.run(api.afetch_vectors(collection, list(range(250))))
+    assert sorted(collection.requests) == [50, 100, 100]
+    assert vectors == {i: [float(i)] for i in range(250)}
@@ -0,0 +1,76 @@
+import uuid
+
+import pytest
+from astrapy.exceptions import DataAPIErrorDescriptor, InsertManyException
+from astrapy.results import InsertManyResult
+
+import api
+import service
+import tenants
+
+IDS = [uuid.uuid4() for _ in range(3)]
+
+
+def error(code, _id):
+    return DataAPIErrorDescriptor(
+        {
+            "errorCode": code,
+            "message": f"Failed to insert document with _id '{_id}': {code}",
+        }
+    )
+
+
+class Collection:
+    """Inserts the first doc; the rest already exist or fail as given."""
+
+    def __init__(self, codes):
+        self.codes = codes
+
+    def insert_many(self, docs, **kwargs):
+        errors = [error(code, doc["_id"]) for doc, code in zip(docs[1:], self.codes)]
+        raise InsertManyException(
+            "insert_many failed",
+            InsertManyResult(raw_results=[], inserted_ids=[docs[0]["_id"]]),
+            error_descriptors=errors,
+            detailed_error_descriptors=[],
+        )
+
+
+class Mirror:
+    def __init__(self):
+        self.ids = []
+
+    def add(self, docs):
+        self.ids.extend(doc["_id"] for doc in docs)
+
+
+@pytest.fixture(autouse=True)
+def prepared(monkeypatch):
+    def prepare_docs(texts, executor, on_stage=None, router=None, ids=None):
+        return [{"_id": _id, "raw_content": text} for _id, (_, text) in zip(ids, texts)]
+
+    monkeypatch.setattr(api, "prepare_docs", prepare_docs)
+
+
+def ingest(codes):
+    tenant = tenants.Tenant("alice", "notes_alice")
+    tenant.collection = Collection(codes)
+    tenant.mirrors = [Mirror()]
+    items = [
+        ({"message_id": i, "text": f"note {i}", "_id": str(_id)}, lambda stage: None)
+        for i, _id in enumerate(IDS)
+    ]
+    return service._ingest_tenant_batch(tenant, items), tenant.mirrors[0]
+
+
+def test_docs_that_already_exist_count_as_inserted():
+    results, mirror = ingest(["DOCUMENT_ALREADY_EXISTS"] * 2)
+    assert results == [{"inserted_ids": [str(_id)]} for _id in IDS]
+    assert mirror.ids == IDS
+
+
+def test_only_the_doc_that_failed_fails_alongside_existing_ones():
+    results, mirror = ingest(["DOCUMENT_ALREADY_EXISTS", "SERVER_UNHANDLED_ERROR"])
+    assert results[:2] == [{"inserted_ids": [str(_id)]} for _id in IDS[:2]]
+    assert isinstance(results[2], InsertManyException)
+    assert mirror.ids == IDS[:2]
@@ -0,0 +1,43 @@
+import pytest
+
+import lexical_index
+
+
+@pytest.fixture
+def index():
+    index = lexical_index.LexicalIndex()
+    notes = [
+        "Lunch with Priya Raman, she moved to the data team",
+        "Gym routine changes: squats on Monday, deadlifts on Friday",
+        "Invoice INV-2041 paid, ask @omar for the receipt",
+        "New gym routine changes from the coach",
+    ]
+    index.build(
+        [
+            {"_id": i, "cleaned_content": text, "raw_content": text}
+            for i, text in enumerate(notes)
+        ]
+    )
+    return index
+
+
+@pytest.mark.parametrize(
+    "question, expected",
+    [
+        ("What did I note about Priya Raman?", 0),
+        ("Priya Raman?", 0),
+        ("what about INV-2041", 2),
+        ("what about @omar", 2),
+        ('what did I say about "deadlifts on friday"', 1),
+    ],
+)
+def test_name_and_phrase_lookups_take_the_fast_path(index, question, expected):
+    assert [doc.id for doc in index.exact_match(question, 3)] == [expected]
+
+
+@pytest.mark.parametrize(
+    "question",
+    ["gym routine changes?", "Gym routine changes?", "what did priya say"],
+)
+def test_other_questions_fall_back_to_search(index, question):
+    assert index.exact_match(question, 3) == []
@@ -0,0 +1,116 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import clients
+import llm_helper
+import rate_limiter
+import resilience
+
+
+class Completions:
+    def __init__(self, chunks=None, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    def create(self, **kwargs):
+        if self.error is not None:
+            raise self.error
+        if kwargs.get("stream"):
+            return iter(self.chunks)
+        return SimpleNamespace(usage=usage(30), choices=[])
+
+
+class AsyncCompletions(Completions):
+    async def create(self, **kwargs):
+        response = super().create(**kwargs)
+        if not kwargs.get("stream"):
+            return response
+
+        async def stream():
+            for chunk in response:
+                yield chunk
+
+        return stream()
+
+
+def client(completions):
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+def usage(total):
+    return SimpleNamespace(prompt_tokens=total, completion_tokens=0, total_tokens=total)
+
+
+def chunk(text=None, total=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=text))] if text else []
+    return SimpleNamespace(
+        choices=choices, usage=usage(total) if total is not None else None
+    )
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    # A tiny refill rate, so the bucket only moves by what the calls take
+    limiter = rate_limiter.Limiter("chat", rpm=0, tpm=6, burst_seconds=1_000_000)
+    monkeypatch.setitem(rate_limiter.limiters, "chat", limiter)
+    monkeypatch.setitem(
+        resilience.policies, "openai.chat", resilience.Policy("openai.chat", attempts=1)
+    )
+    return limiter
+
+
+def spent(limiter):
+    return round(limiter.tokens.capacity - limiter.tokens.available)
+
+
+def use(monkeypatch, completions):
+    monkeypatch.setattr(clients, "get_openai_client", lambda: client(completions))
+    monkeypatch.setattr(
+        clients,
+        "get_async_openai_client",
+        lambda: client(AsyncCompletions(completions.chunks, completions.error)),
+    )
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_a_failed_call_gives_its_tokens_back(limiter, monkeypatch, use_async):
+    use(monkeypatch, Completions(error=ConnectionError("reset")))
+    with pytest.raises(llm_helper.LLMError):
+        if use_async:
+            asyncio.run(llm_helper.acall_openai_response("system", "user"))
+        else:
+            llm_helper.call_openai_response("system", "user")
+    assert spent(limiter) == 0
+
+
+def test_a_call_is_charged_its_usage(limiter, monkeypatch):
+    use(monkeypatch, Completions())
+    llm_helper.call_openai_response("system", "user")
+    assert spent(limiter) == 30
+
+
+def test_a_finished_stream_is_charged_its_usage(limiter, monkeypatch):
+    use(monkeypatch, Completions([chunk("hel"), chunk("lo"), chunk(total=40)]))
+    assert "".join(llm_helper.stream_openai_response("system", "user")) == "hello"
+    assert spent(limiter) == 40
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_a_stream_cut_off_partway_is_settled(limiter, monkeypatch, use_async):
+    use(monkeypatch, Completions([chunk("hel"), chunk("lo"), chunk(total=40)]))
+
+    async def first_async():
+        stream = llm_helper.astream_openai_response("system", "user")
+        delta = await stream.__anext__()
+        await stream.aclose()
+        return delta
+
+    if use_async:
+        assert asyncio.run(first_async()) == "hel"
+    else:
+        stream = llm_helper.stream_openai_response("system", "user")
+        assert next(stream) == "hel"
+        stream.close()
+    assert spent(limiter) == 0
@@ -0,0 +1,21 @@
+import asyncio
+import threading
+
+import rate_limiter
+
+
+def test_async_waiter_granted_by_another_thread_wakes_up():
+    # 0.1 tokens a second: the async waiter's own timer is ten seconds out
+    limiter = rate_limiter.Limiter("test", rpm=0, tpm=6, burst_seconds=1)
+    limiter.tokens.available = 0
+
+    async def run():
+        waiter = asyncio.ensure_future(limiter.aacquire(1))
+        await asyncio.sleep(0.05)
+        with limiter._cond:
+            limiter.tokens.available = 5
+        # This thread's dispatch lets the queued async waiter through first
+        threading.Thread(target=limiter.acquire, args=(1,)).start()
+        return await asyncio.wait_for(waiter, 2)
+
+    assert asyncio.run(run()).granted
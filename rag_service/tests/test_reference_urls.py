@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import api
+import lexical_index
+import resilience
+import vector_index
+
+NOTE = {
+    "_id": "n1",
+    "cleaned_title": "Lunch with Priya",
+    "cleaned_content": "Lunch with Priya Raman",
+    "raw_content": "Lunch with Priya Raman",
+    "$vector": [1.0, 0.0, 0.0, 0.0],
+}
+
+
+class Collection:
+    def __init__(self):
+        self.updates = []
+
+    def update_one(self, filter, update, **kwargs):
+        self.updates.append((filter["_id"], update["$set"]["reference_url"]))
+
+
+class AsyncCollection(Collection):
+    async def update_one(self, filter, update, **kwargs):
+        super().update_one(filter, update, **kwargs)
+
+
+class DownCollection(Collection):
+    def update_one(self, filter, update, **kwargs):
+        super().update_one(filter, update, **kwargs)
+        raise TimeoutError("Astra timed out")
+
+
+class AsyncDownCollection(DownCollection):
+    async def update_one(self, filter, update, **kwargs):
+        super().update_one(filter, update, **kwargs)
+
+
+@pytest.fixture
+def mirrors():
+    index = vector_index.LocalVectorIndex(dim=4)
+    lexical = lexical_index.LexicalIndex()
+    index.build([NOTE])
+    lexical.build([NOTE])
+    return index, lexical
+
+
+@pytest.fixture
+def published(monkeypatch):
+    published = []
+
+    def publish_record(doc):
+        published.append(doc.id)
+        doc.reference_url = f"https://notes.example/{doc.id}.html"
+        return doc.reference_url
+
+    monkeypatch.setattr(api, "publish_record", publish_record)
+    return published
+
+
+def search(mirrors):
+    index, lexical = mirrors
+    return [index.search(NOTE["$vector"], 1)[0], lexical.search("Priya", 1)[0]]
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_an_old_note_is_published_once(mirrors, published, use_async):
+    collection = AsyncCollection() if use_async else Collection()
+    for _ in range(2):
+        docs = search(mirrors)
+        if use_async:
+            links = asyncio.run(
+                api.aupload_to_s3_workflow(docs, collection, mirrors=mirrors)
+            )
+        else:
+            links = api.upload_to_s3_workflow(docs, collection, mirrors=mirrors)
+        assert links == ["https://notes.example/n1.html"] * 2
+
+    # Once for each mirror's copy of the record, on the first answer only
+    assert published == ["n1", "n1"]
+    assert len(collection.updates) == 2
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_a_failed_write_back_still_answers(mirrors, published, use_async, monkeypatch):
+    monkeypatch.setitem(
+        resilience.policies, "astra.write", resilience.Policy("astra.write", attempts=1)
+    )
+    collection = AsyncDownCollection() if use_async else DownCollection()
+    docs = search(mirrors)
+    if use_async:
+        links = asyncio.run(api.aupload_to_s3_workflow(docs, collection, mirrors))
+    else:
+        links = api.upload_to_s3_workflow(docs, collection, mirrors)
+
+    assert links == ["https://notes.example/n1.html"] * 2
+    assert len(collection.updates) == 2
+    # The mirrors still know the page was published
+    assert [doc.reference_url for doc in search(mirrors)] == links
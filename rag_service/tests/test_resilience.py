@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+import resilience
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def fail(error):
+    raise error
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    policy = resilience.Policy(
+        "test", attempts=1, failure_threshold=1, reset_timeout=0.01
+    )
+    monkeypatch.setitem(resilience.policies, "test", policy)
+    return policy
+
+
+def open_circuit(policy):
+    with pytest.raises(StatusError):
+        resilience.call("test", fail, StatusError(503))
+    assert policy.breaker.state == "open"
+    time.sleep(0.02)
+
+
+def test_probe_answered_with_a_client_error_closes_the_circuit(policy):
+    open_circuit(policy)
+    with pytest.raises(StatusError):
+        resilience.call("test", fail, StatusError(400))
+    assert policy.breaker.state == "closed"
+    assert resilience.call("test", lambda: "ok") == "ok"
+
+
+@pytest.mark.parametrize(
+    "error",
+    [resilience.DeadlineExceeded("deadline"), ValueError("bad response")],
+)
+def test_probe_failing_without_an_answer_lets_the_next_call_probe(policy, error):
+    open_circuit(policy)
+    with pytest.raises(type(error)):
+        resilience.call("test", fail, error)
+    assert policy.breaker.state == "half_open"
+    assert resilience.call("test", lambda: "ok") == "ok"
+    assert policy.breaker.state == "closed"
+
+
+def test_cancelled_async_probe_lets_the_next_call_probe(policy):
+    open_circuit(policy)
+
+    async def run():
+        probe = asyncio.ensure_future(
+            resilience.acall("test", lambda: asyncio.sleep(10))
+        )
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        return await resilience.acall("test", lambda: asyncio.sleep(0, "ok"))
+
+    assert asyncio.run(run()) == "ok"
+    assert policy.breaker.state == "closed"
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import server
+import service
+import tenants
+
+
+def write(path, config, mtime=None):
+    path.write_text(json.dumps({"tenants": config}))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / "tenants.json"
+    write(path, {"default": {}, "alice": {}, "bob": {"collection": "bobs_notes"}})
+    return path
+
+
+def registry(path, check_every=0):
+    return tenants.TenantRegistry(str(path), "core_messages", check_every=check_every)
+
+
+def test_each_tenant_has_its_own_collection(path):
+    reg = registry(path)
+    assert reg.get().collection_name == "core_messages"
+    assert reg.get("alice").collection_name == "notes_alice"
+    assert reg.get("bob").collection_name == "bobs_notes"
+    assert reg.get("alice") is not reg.get("bob")
+    assert len({id(tenant) for tenant in reg.all()}) == 3
+
+
+def test_an_unknown_tenant_is_rejected(path):
+    with pytest.raises(tenants.UnknownTenantError):
+        registry(path).get("nobody")
+
+
+def test_without_a_file_there_is_only_the_default_tenant(tmp_path):
+    reg = registry(tmp_path / "missing.json")
+    assert [t.tenant_id for t in reg.all()] == [tenants.DEFAULT_TENANT]
+    with pytest.raises(tenants.UnknownTenantError):
+        reg.get("alice")
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"alice": {"collection": "notes-alice"}},
+        {"alice": {}, "bob": {"collection": "notes_alice"}},
+        {"../alice": {}},
+    ],
+)
+def test_invalid_or_shared_collections_are_refused(tmp_path, config):
+    path = tmp_path / "tenants.json"
+    write(path, config)
+    with pytest.raises(ValueError):
+        tenants.load(str(path), "core_messages")
+
+
+def test_a_changed_file_adds_and_closes_tenants(path):
+    reg = registry(path)
+    alice, bob = reg.get("alice"), reg.get("bob")
+    write(path, {"default": {}, "alice": {}, "carol": {}}, mtime=1)
+    assert reg.get("carol").collection_name == "notes_carol"
+    assert reg.get("alice") is alice
+    assert bob.closed
+    with pytest.raises(tenants.UnknownTenantError):
+        reg.get("bob")
+
+
+def test_a_broken_file_keeps_the_current_tenants(path):
+    reg = registry(path)
+    path.write_text("{not json")
+    os.utime(path, (1, 1))
+    assert reg.get("alice").collection_name == "notes_alice"
+
+
+def test_the_server_rejects_an_unknown_tenant(path, monkeypatch):
+    monkeypatch.setitem(service.conn_d, "tenants", registry(path))
+
+    async def post(tenant_id):
+        async with TestClient(TestServer(server.create_app())) as client:
+            response = await client.post(
+                "/get_message",
+                json={"text": "what did I lift?"},
+                headers={"X-Tenant-ID": tenant_id},
+            )
+            return response.status
+
+    assert asyncio.run(post("nobody")) == 403
+    # A known tenant gets past the check, to the not-connected error
+    assert asyncio.run(post("alice")) == 503
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+import api
+import save_log
+import service
+import tenants
+
+
+class Notes(dict):
+    def __init__(self):
+        super().__init__()
+        self.saving = threading.Event()
+
+
+@pytest.fixture
+def notes(monkeypatch):
+    """A slow save and an update that saves again if it finds no note."""
+    notes = Notes()
+    saving = notes.saving
+
+    def save(payload, progress):
+        saving.set()
+        threading.Event().wait(0.2)
+        notes.setdefault(payload["message_id"], []).append(payload["text"])
+        return {"inserted_ids": [payload["message_id"]]}
+
+    def update(payload, progress):
+        if payload["message_id"] not in notes:
+            return save(payload, progress)
+        notes[payload["message_id"]][-1] = payload["text"]
+        return {"updated_ids": [payload["message_id"]]}
+
+    monkeypatch.setitem(service.WRITE_HANDLERS, "save", save)
+    monkeypatch.setitem(service.WRITE_HANDLERS, "update", update)
+    return notes
+
+
+@pytest.fixture
+def tenant():
+    tenant = tenants.Tenant("alice", "notes_alice")
+    tenant.collection = object()
+    return tenant
+
+
+@pytest.mark.parametrize("with_log", [False, True])
+def test_edit_right_after_save_updates_the_note(
+    notes, tenant, with_log, tmp_path, monkeypatch
+):
+    log = save_log.SaveLog(str(tmp_path / "saves.sqlite3")) if with_log else None
+    monkeypatch.setitem(service.conn_d, "save_log", log)
+
+    saved = service.accept_write("save", {"message_id": 7, "text": "helo"}, tenant)
+    assert notes.saving.wait(1)
+    edited = service.accept_write("update", {"message_id": 7, "text": "hello"}, tenant)
+
+    assert service.job_queue.wait(edited["job_id"], 5)["status"] == "done"
+    assert service.job_queue.get(saved["job_id"])["status"] == "done"
+    assert notes[7] == ["hello"]
+
+
+def test_a_replayed_save_keeps_the_id_it_was_given():
+    _id = api.uuid8()
+    assert service._doc_id({"message_id": 7, "_id": str(_id)}) == _id
+    assert service._doc_id({"message_id": 7}) is None
@@ -1,17 +1,84 @@
-from dataclasses import dataclass
-from typing import List
+import json
+import os
+import time
 
+from loguru import logger
 
-@dataclass
-class UserConfig:
-    username: str
-    allowed_chat_id_hash: List[int]
+# Who may use the bot, and as which tenant, from the tenants.json at the root
+# of the repo, which rag_service reads too:
+#
+#     {"tenants": {"default": {"username": "...", "allowed_chat_id_hash": ["..."]}}}
+#
+# A chat belongs to the tenant whose allowed_chat_id_hash lists it (and, if
+# the tenant sets a username, only when sent by that user). The file is
+# re-read when it changes, so the team can be edited without a restart.
 
-
-# Example usage
-user_config = UserConfig(
-    username="meowingcats",
-    allowed_chat_id_hash=[
-        "a03b85dc0a3680a79c0c0155accaef1d10c605760838c98f35338efa1fcc45e9",
-    ],
+DEFAULT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "tenants.json"
 )
+
+
+def load(path):
+    """Read the tenants file into {chat_id_hash: (tenant_id, username)}.
+
+    Raises:
+        ValueError: if the file isn't valid JSON or a chat is listed twice
+    """
+    with open(path, "r") as file:
+        config = json.load(file)
+    chats = {}
+    for tenant_id, options in (config.get("tenants") or {}).items():
+        for chat_id_hash in options.get("allowed_chat_id_hash", []):
+            if chat_id_hash in chats:
+                raise ValueError(f"Chat {chat_id_hash[:12]}... is in two tenants")
+            chats[chat_id_hash] = (tenant_id, options.get("username"))
+    return chats
+
+
+class TenantConfig:
+    """The tenants file, re-read at most every check_every seconds if it changed.
+
+    If the file fails to parse the error is logged and the previous
+    tenants stay in place.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, check_every=5.0):
+        self.path = path
+        self.check_every = check_every
+        self._chats = {}
+        self._mtime = None
+        self._checked_at = float("-inf")
+
+    def tenant_for(self, credentials):
+        """The tenant id of an authenticated chat, or None."""
+        self._check_file()
+        tenant_id, username = self._chats.get(
+            credentials.get("chat_id_hash"), (None, None)
+        )
+        if username is not None and credentials.get("username") != username:
+            return None
+        return tenant_id
+
+    def _check_file(self):
+        if time.monotonic() - self._checked_at < self.check_every:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            if self._mtime is not None:
+                logger.error(
+                    f"Could not read {self.path}, keeping current tenants: {e}"
+                )
+            self._mtime = None
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            self._chats = load(self.path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load {self.path}, keeping current tenants: {e}")
+            return
+        tenants = sorted({tenant_id for tenant_id, _ in self._chats.values()})
+        logger.info(f"Loaded {len(self._chats)} chats of tenants {tenants}")
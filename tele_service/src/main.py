@@ -3,13 +3,15 @@ import configparser
 import hashlib
 import json
 import os
+import time
 
-import requests
+import config
+import rag_client
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters.command import Command
 from aiogram.types import Message
-from config import user_config
 from dotenv import load_dotenv
 from loguru import logger
 
@@ -27,6 +29,23 @@ else:
 # token – Telegram Bot token Obtained from telegram @BotFather
 token = os.environ["TELEGRAM_BOT_TOKEN"]
 
+# Who may use the bot and as which tenant; edits to the file apply without a restart
+tenant_config = config.TenantConfig(
+    os.environ.get("TENANTS_CONFIG", config.DEFAULT_PATH)
+)
+
+# Per-call timeouts (seconds) for requests to the RAG service
+HEALTHCHECK_TIMEOUT = float(os.environ.get("HEALTHCHECK_TIMEOUT", 5))
+SAVE_TIMEOUT = float(os.environ.get("SAVE_TIMEOUT", 10))
+ASK_TIMEOUT = float(os.environ.get("ASK_TIMEOUT", 60))
+# Seconds each /jobs request long-polls for; the server caps it
+JOB_POLL_WAIT = float(os.environ.get("JOB_POLL_WAIT", 5))
+
+# Stream answers into one message, editing it at most every STREAM_EDIT_INTERVAL
+# seconds to stay within the Bot API's edit rate limits
+STREAM_ANSWERS = os.environ.get("STREAM_ANSWERS", "true").lower() in ("1", "true")
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))
+
 bot = Bot(token)
 dp = Dispatcher()
 
@@ -37,7 +56,7 @@ async def cmd_start(message: types.Message):
 
     credentials = get_creds(message)
     response = f""""Hello, I'm a bot that can save and retrieve your notes with semantic search.
-    To authenticate, add your details to the config.py file:
+    To authenticate, add your details to a tenant in the tenants.json file:
     username: {credentials.get("username")}
     chat_id_hash: {credentials.get("chat_id_hash")}
     
@@ -64,22 +83,43 @@ def hash_string(input_string: str) -> str:
 
 
 def auth(credentials):
-    if credentials.get("username") == user_config.username:
-        if credentials.get("chat_id_hash") in user_config.allowed_chat_id_hash:
-            return True
-    return False
+    # The tenant the chat belongs to, or None if it isn't allowed
+    return tenant_config.tenant_for(credentials)
 
 
 @dp.message(Command("healthcheck"))
 async def cmd_start(message: types.Message):
 
-    if not auth(get_creds(message)):
+    tenant = auth(get_creds(message))
+    if tenant is None:
         response = f"Denied. Unauthenticated user."
 
     else:
-        healthcheck = requests.get(url + "/healthcheck").json().get("message")
-        response = f"""User and chat authenticated. 
+        try:
+            _, body = await rag_client.get(
+                url + "/healthcheck",
+                timeout=HEALTHCHECK_TIMEOUT,
+                request_id=rag_client.new_request_id(message.message_id),
+            )
+            healthcheck = body.get("message")
+            status, body = await rag_client.get(
+                url + "/ready",
+                timeout=HEALTHCHECK_TIMEOUT,
+                request_id=rag_client.new_request_id(message.message_id),
+            )
+            if status == 200:
+                readiness = "ready"
+            else:
+                waiting = [
+                    name for name, ok in body.items() if name != "ready" and not ok
+                ]
+                readiness = f"starting (waiting for {', '.join(waiting) or 'server'})"
+        except rag_client.RagServiceError:
+            healthcheck = "unreachable"
+            readiness = "unknown"
+        response = f"""User and chat authenticated (tenant {tenant}).
         Server status: {healthcheck}
+        Readiness: {readiness}
         """
     await message.answer(response)
 
@@ -87,7 +127,8 @@ async def cmd_start(message: types.Message):
 @dp.message(Command("save"))
 async def save_doc(message: types.Message):
 
-    if not auth(get_creds(message)):
+    tenant = auth(get_creds(message))
+    if tenant is None:
         response = f"Denied. Unauthenticated user."
         await message.answer(response)
         return
@@ -95,23 +136,123 @@ async def save_doc(message: types.Message):
     payload = {}
     payload["message_id"] = message.message_id
     payload["text"] = message.text.replace("/save ", "")
-
-    lg(payload)
-
-    send_message = requests.post(url + "/send_message", json=payload)
-    if send_message.status_code == 200:
-        response = send_message.json()
+    request_id = rag_client.new_request_id(message.message_id)
+
+    lg(f"[{request_id}] {payload}")
+
+    try:
+        async with rag_client.chat_slot(message.chat.id):
+            status, response = await rag_client.post(
+                url + "/send_message",
+                payload,
+                timeout=SAVE_TIMEOUT,
+                request_id=request_id,
+                tenant=tenant,
+            )
+    except rag_client.RagServiceError:
+        status = None
+    if status == 202 and response.get("job_id") is None:
+        # Logged but not yet queued, the RAG service replays it shortly
+        await message.answer("Message received, will be saved shortly")
+    elif status == 202:
         lg(response)
-        await message.answer("Message saved")
+        reply = await message.answer("Saving message ...")
+        # Don't hold the handler while the RAG service enriches the note
+        asyncio.create_task(notify_when_saved(reply, response["job_id"], request_id))
     else:
         await message.answer("Server error, please retry")
     # Save
 
 
+async def notify_when_saved(
+    reply: types.Message,
+    job_id: str,
+    request_id: str = None,
+    wait: int = 60,
+    done_text: str = "Message saved",
+):
+    # Poll in short long-polls, so no request holds a server thread for long
+    deadline = time.monotonic() + wait
+    job = {}
+    while time.monotonic() < deadline:
+        try:
+            status, job = await rag_client.get(
+                f"{url}/jobs/{job_id}",
+                timeout=JOB_POLL_WAIT + 5,
+                params={"wait": JOB_POLL_WAIT},
+                request_id=request_id,
+            )
+        except rag_client.RagServiceError:
+            job = {}
+            break
+        if status == 404:
+            # Unknown or expired: asking again won't change that
+            job = {"status": "unknown"}
+            break
+        if job.get("status") in ("done", "failed"):
+            break
+    lg(job)
+    if (job.get("result") or {}).get("deferred"):
+        # The note is in the save log and is retried until it goes through
+        await reply.edit_text(
+            "Message received, will finish saving once the service recovers"
+        )
+    elif job.get("status") == "done":
+        await reply.edit_text(done_text)
+    elif job.get("status") == "failed":
+        await reply.edit_text("Server error while saving, please retry")
+    elif job.get("status") == "unknown":
+        await reply.edit_text(
+            f"Lost track of the save (job {job_id}), please check it went through"
+        )
+    else:
+        await reply.edit_text(f"Still saving message (job {job_id})")
+
+
+@dp.edited_message(F.text.startswith("/save"))
+async def update_doc(message: types.Message):
+
+    tenant = auth(get_creds(message))
+    if tenant is None:
+        return
+
+    payload = {}
+    payload["message_id"] = message.message_id
+    payload["text"] = message.text.replace("/save ", "")
+    request_id = rag_client.new_request_id(message.message_id)
+
+    lg(f"[{request_id}] edited {payload}")
+
+    try:
+        async with rag_client.chat_slot(message.chat.id):
+            status, response = await rag_client.post(
+                url + "/update",
+                payload,
+                timeout=SAVE_TIMEOUT,
+                request_id=request_id,
+                tenant=tenant,
+            )
+    except rag_client.RagServiceError:
+        status = None
+    if status == 202 and response.get("job_id") is None:
+        await message.reply("Edit received, will be applied shortly")
+    elif status == 202:
+        lg(response)
+        reply = await message.reply("Updating note ...")
+        asyncio.create_task(
+            notify_when_saved(
+                reply, response["job_id"], request_id, done_text="Note updated"
+            )
+        )
+    else:
+        await message.reply("Server error while updating, please edit again")
+
+
 @dp.message(F.text)
 async def retrieve_doc(message: types.Message):
 
-    if not auth(get_creds(message)):
+    tenant = auth(get_creds(message))
+    if tenant is None:
         response = f"Denied. Unauthenticated user."
         await message.answer(response)
         return
@@ -120,13 +261,27 @@ async def retrieve_doc(message: types.Message):
     payload = {}
     payload["message_id"] = message.message_id
     payload["text"] = message.text
-    lg(payload)
-    get_message = requests.post(url + "/get_message", json=payload)
-    lg(get_message)
-
-    if get_message.status_code == 200:
-        response = get_message.json()
+    request_id = rag_client.new_request_id(message.message_id)
+    lg(f"[{request_id}] {payload}")
+    if STREAM_ANSWERS:
+        async with rag_client.chat_slot(message.chat.id):
+            await stream_answer(message, payload, request_id, tenant)
+        return
 
+    try:
+        async with rag_client.chat_slot(message.chat.id):
+            status, response = await rag_client.post(
+                url + "/get_message",
+                payload,
+                timeout=ASK_TIMEOUT,
+                request_id=request_id,
+                tenant=tenant,
+            )
+    except rag_client.RagServiceError:
+        status = None
+    lg(status)
+
+    if status == 200:
         lg(response)
 
         escape_response = response
@@ -136,6 +291,56 @@ async def retrieve_doc(message: types.Message):
         await message.answer(text="Server error, please retry")
 
 
+async def edit_reply(reply: types.Message, text: str):
+    try:
+        await reply.edit_text(text)
+    except TelegramBadRequest as e:
+        # "message is not modified" and friends are harmless here
+        logger.warning(f"Failed to edit reply: {e}")
+
+
+async def stream_answer(
+    message: types.Message, payload: dict, request_id: str = None, tenant: str = None
+):
+    start = time.perf_counter()
+    reply = await message.answer("...")
+    text = ""
+    shown = ""
+    last_edit = time.monotonic()
+    try:
+        async for event in rag_client.stream_events(
+            url + "/get_message_stream",
+            payload,
+            timeout=ASK_TIMEOUT,
+            request_id=request_id,
+            tenant=tenant,
+        ):
+            if event["type"] in ("token", "references"):
+                if not text:
+                    elapsed_ms = (time.perf_counter() - start) * 1000
+                    lg(f"First token after {elapsed_ms:.0f} ms")
+                text += event["text"]
+            elif event["type"] == "error":
+                await edit_reply(reply, event["text"])
+                return
+            elif event["type"] == "done":
+                lg(
+                    f"Server ttft {event['ttft_ms']:.0f} ms, "
+                    f"total {event['total_ms']:.0f} ms"
+                )
+
+            if text != shown and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                await edit_reply(reply, text)
+                shown = text
+                last_edit = time.monotonic()
+    except rag_client.RagServiceError:
+        await edit_reply(reply, "Server error, please retry")
+        return
+
+    if text != shown:
+        await edit_reply(reply, text)
+
+
 # @dp.message(F.text)
 # async def receive_prompt(message: Message):
 #     print(message)
@@ -147,6 +352,7 @@ async def retrieve_doc(message: types.Message):
 
 # initialize polling to wait for incoming messages
 async def main():
+    dp.shutdown.register(rag_client.close)
     await dp.start_polling(bot)
 
 
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+
+import aiohttp
+from loguru import logger
+
+# One pooled aiohttp session for every call to the RAG service, so handlers
+# never block the aiogram event loop.
+
+RAG_POOL_SIZE = int(os.environ.get("RAG_POOL_SIZE", 20))
+PER_CHAT_CONCURRENCY = int(os.environ.get("PER_CHAT_CONCURRENCY", 3))
+
+_session = None
+# A chat's slot is dropped once no request holds or waits on it
+_chat_slots = weakref.WeakValueDictionary()
+
+
+class RagServiceError(Exception):
+    pass
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=RAG_POOL_SIZE, keepalive_timeout=60)
+        )
+    return _session
+
+
+async def close():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+@asynccontextmanager
+async def chat_slot(chat_id):
+    """Bound how many requests a single chat can have in flight at once."""
+    slot = _chat_slots.get(chat_id)
+    if slot is None:
+        slot = _chat_slots[chat_id] = asyncio.Semaphore(PER_CHAT_CONCURRENCY)
+    async with slot:
+        yield
+
+
+def new_request_id(message_id=None):
+    # Sent as X-Request-ID so rag_service logs and metrics can be tied to a message
+    suffix = uuid.uuid4().hex[:8]
+    return f"{message_id}-{suffix}" if message_id is not None else suffix
+
+
+def _headers(request_id, tenant=None):
+    headers = {"X-Request-ID": request_id} if request_id else {}
+    # The RAG service keeps each tenant's notes, caches and indexes apart
+    if tenant:
+        headers["X-Tenant-ID"] = tenant
+    return headers
+
+
+async def request(method, url, timeout, request_id=None, tenant=None, **kwargs):
+    try:
+        async with get_session().request(
+            method,
+            url,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers=_headers(request_id, tenant),
+            **kwargs,
+        ) as response:
+            body = await response.json(content_type=None)
+            return response.status, body
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"{method} {url} failed: {e!r}")
+        raise RagServiceError(str(e)) from e
+
+
+async def get(url, timeout=10, params=None, request_id=None, tenant=None):
+    return await request(
+        "GET", url, timeout, request_id=request_id, tenant=tenant, params=params
+    )
+
+
+async def post(url, payload, timeout=10, request_id=None, tenant=None):
+    return await request(
+        "POST", url, timeout, request_id=request_id, tenant=tenant, json=payload
+    )
+
+
+async def stream_events(url, payload, timeout=60, request_id=None, tenant=None):
+    """POST and yield the server-sent events of a streaming endpoint."""
+    try:
+        async with get_session().post(
+            url,
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers=_headers(request_id, tenant),
+        ) as response:
+            if response.status != 200:
+                raise RagServiceError(f"{url} returned {response.status}")
+            async for line in response.content:
+                line = line.decode("utf-8").strip()
+                if line.startswith("data: "):
+                    yield json.loads(line[len("data: ") :])
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"POST {url} failed: {e!r}")
+        raise RagServiceError(str(e)) from e